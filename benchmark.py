@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import instrumentation
+from pdf_processor import close_documents, document_lock, open_document, render_page
+from image_analyzer import LayoutElement, analyze_layout, analyze_spatial_relationships, classify_elements, \
+    contour_bboxes, granularity_kernel_size, preprocess_image
+from synthetic_pdf import PAGE_SIZES, generate_pdf
+
+# Benchmarked stages, in pipeline order
+STAGES = ('render', 'preprocess', 'detect', 'classify', 'relationships')
+# Latency percentiles reported for every stage
+PERCENTILES = (50, 90, 99)
+# Metrics compared against a baseline; a regression is a value above baseline * (1 + tolerance)
+COMPARED_METRICS = ('p50', 'p90', 'peak_bytes')
+DEFAULT_TOLERANCE = 0.15
+
+
+def run_benchmark(pdf_path, pages=None, zoom=1, granularity=50, repeat=3, warmup=1, memory=True):
+    """
+    Time every stage of the analysis pipeline on the pages of a PDF.
+
+    Stage durations come from the instrumentation spans the pipeline already
+    emits: detect is the dilation and contour search, without the classification
+    done inside detect_layout_elements. Rendering bypasses the page cache.
+
+    :param pdf_path: Path to the PDF file
+    :param pages: Page numbers (0-indexed) to benchmark, all pages if None
+    :param zoom: Render zoom factor
+    :param granularity: Layout granularity
+    :param repeat: Timed runs per page
+    :param warmup: Untimed runs over all pages before timing
+    :param memory: Also run every page once under tracemalloc for per-stage peak memory
+    :return: Dictionary with the configuration, per-stage statistics and totals
+    """
+    doc, _ = open_document(pdf_path)
+    pages = list(pages) if pages is not None else list(range(len(doc)))
+    for _ in range(warmup):
+        for page_number in pages:
+            _run_page(doc, page_number, zoom, granularity)
+
+    samples = {stage: [] for stage in STAGES}
+    totals = []
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for page_number in pages:
+            durations = _run_page(doc, page_number, zoom, granularity)
+            for stage in STAGES:
+                samples[stage].append(durations[stage])
+            totals.append(sum(durations.values()))
+    elapsed = time.perf_counter() - start_time
+
+    peaks = _measure_memory(doc, pages, zoom, granularity) if memory else {}
+    stages = {stage: _summarize(samples[stage]) for stage in STAGES}
+    for stage in STAGES:
+        stages[stage]['peak_bytes'] = peaks.get(stage)
+    return {
+        'config': {
+            'pdf': os.path.basename(pdf_path),
+            'pages': len(pages),
+            'zoom': zoom,
+            'granularity': granularity,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'stages': stages,
+        'total': _summarize(totals),
+        'pages_per_second': len(totals) / max(elapsed, 1e-9),
+        'peak_rss': instrumentation.peak_memory()
+    }
+
+
+def _run_page(doc, page_number, zoom, granularity):
+    """Render and analyze one page, returning the duration of every stage in seconds."""
+    sink = instrumentation.MemorySink()
+    previous = instrumentation.set_sink(sink)
+    try:
+        with instrumentation.span('render'):
+            with document_lock():
+                image = render_page(doc[page_number], zoom, 'gray')
+        analyze_layout(image, granularity)
+    finally:
+        instrumentation.set_sink(previous)
+
+    def duration(name):
+        return sum(record['duration'] for record in sink.spans(name))
+
+    return {
+        'render': duration('render'),
+        'preprocess': duration('preprocess_image'),
+        'detect': duration('detect_layout_elements') - duration('classify_elements'),
+        'classify': duration('classify_elements'),
+        'relationships': duration('analyze_spatial_relationships')
+    }
+
+
+def _measure_memory(doc, pages, zoom, granularity):
+    """Return the largest tracemalloc peak of every stage over the pages."""
+    peaks = dict.fromkeys(STAGES, 0)
+
+    def measure(stage, function, *args):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        result = function(*args)
+        peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1] - baseline)
+        return result
+
+    def render(page_number):
+        with document_lock():
+            return render_page(doc[page_number], zoom, 'gray')
+
+    def detect(binary):
+        kernel_size = granularity_kernel_size(binary.shape, granularity)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+        dilated = cv2.dilate(binary, kernel, iterations=1)
+        contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return contour_bboxes(contours)
+
+    def relationships(bboxes, types):
+        elements = [LayoutElement(element_type, tuple(bbox)) for element_type, bbox in zip(types, bboxes.tolist())]
+        return analyze_spatial_relationships(elements)
+
+    tracemalloc.start()
+    try:
+        for page_number in pages:
+            image = measure('render', render, page_number)
+            binary = measure('preprocess', preprocess_image, image)
+            bboxes = measure('detect', detect, binary)
+            types = measure('classify', classify_elements, binary, bboxes, granularity)
+            measure('relationships', relationships, bboxes, types)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def _summarize(durations):
+    """Throughput and latency statistics of a list of durations in seconds."""
+    values = np.asarray(durations, dtype=np.float64)
+    summary = {
+        'count': len(values),
+        'total': float(values.sum()),
+        'mean': float(values.mean()) if len(values) else 0.0,
+        'min': float(values.min()) if len(values) else 0.0,
+        'max': float(values.max()) if len(values) else 0.0,
+        'per_second': len(values) / float(values.sum()) if values.sum() > 0 else None
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = float(np.percentile(values, percentile)) if len(values) else 0.0
+    return summary
+
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare benchmark results against a baseline run.
+
+    :param results: Results of run_benchmark
+    :param baseline: Results of an earlier run_benchmark, e.g. from load_results
+    :param tolerance: Allowed relative increase, 0.15 meaning 15% slower or larger
+    :return: List of regressions, each a dictionary with stage, metric, baseline, current and ratio
+    """
+    regressions = []
+    for stage in STAGES + ('total',):
+        current = results['total'] if stage == 'total' else results['stages'].get(stage, {})
+        previous = baseline['total'] if stage == 'total' else baseline['stages'].get(stage, {})
+        for metric in COMPARED_METRICS:
+            if current.get(metric) is None or not previous.get(metric):
+                continue
+            ratio = current[metric] / previous[metric]
+            if ratio > 1 + tolerance:
+                regressions.append({'stage': stage, 'metric': metric, 'baseline': previous[metric],
+                                    'current': current[metric], 'ratio': ratio})
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{results['config']['pages']} page(s) x {results['config']['repeat']} run(s), "
+          f"{results['pages_per_second']:.2f} pages/second")
+    print(f"  {'stage':<14}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'vs p50':>10}")
+    for stage in STAGES + ('total',):
+        summary = results['total'] if stage == 'total' else results['stages'][stage]
+        peak = summary.get('peak_bytes')
+        peak = f"{peak / 1024 / 1024:.1f}" if peak is not None else '-'
+        change = '-'
+        if baseline is not None:
+            previous = baseline['total'] if stage == 'total' else baseline['stages'].get(stage, {})
+            if previous.get('p50'):
+                change = f"{(summary['p50'] / previous['p50'] - 1) * 100:+.0f}%"
+        print(f"  {stage:<14}{summary['p50'] * 1000:>10.2f}{summary['p90'] * 1000:>10.2f}"
+              f"{summary['p99'] * 1000:>10.2f}{peak:>10}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on a real or synthetic PDF.")
+    parser.add_argument('pdf_path', nargs='?', help="PDF file to benchmark. Default: a generated synthetic PDF")
+    parser.add_argument('--zoom', type=float, default=1, help="Render zoom factor")
+    parser.add_argument('--granularity', type=int, default=50, help="Layout granularity (1-100)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per page")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the tracemalloc pass")
+    parser.add_argument('--output', help="Save the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against results saved by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative regression against the baseline, e.g. 0.15 for 15%%")
+    synthetic = parser.add_argument_group('synthetic PDF')
+    synthetic.add_argument('--pages', type=int, default=10, help="Number of pages")
+    synthetic.add_argument('--page-size', default='letter', choices=sorted(PAGE_SIZES), help="Page size")
+    synthetic.add_argument('--text-blocks', type=int, default=6, help="Text blocks per page")
+    synthetic.add_argument('--images', type=int, default=1, help="Raster images per page")
+    synthetic.add_argument('--rules', type=int, default=3, help="Horizontal rules per page")
+    synthetic.add_argument('--tables', type=int, default=1, help="Table-like grids per page")
+    synthetic.add_argument('--seed', type=int, default=0, help="Seed of the generated layout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = args.pdf_path
+        if pdf_path is None:
+            pdf_path = generate_pdf(os.path.join(directory, 'synthetic.pdf'), args.pages, args.page_size,
+                                    args.text_blocks, args.images, args.rules, args.tables, args.seed)
+        results = run_benchmark(pdf_path, zoom=args.zoom, granularity=args.granularity, repeat=args.repeat,
+                                memory=not args.no_memory)
+        if args.pdf_path is None:
+            results['config']['synthetic'] = {key: getattr(args, key) for key in
+                                              ('pages', 'page_size', 'text_blocks', 'images', 'rules', 'tables',
+                                               'seed')}
+        close_documents()
+    baseline = load_results(args.baseline) if args.baseline else None
+    print_results(results, baseline)
+    if args.output:
+        save_results(results, args.output)
+    if baseline is not None:
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression['stage']} {regression['metric']} {regression['baseline']:.4g} -> "
+                  f"{regression['current']:.4g} ({(regression['ratio'] - 1) * 100:+.0f}%)")
+        sys.exit(1 if regressions else 0)
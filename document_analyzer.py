@@ -0,0 +1,289 @@
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import fitz  # PyMuPDF
+
+import instrumentation
+from pdf_processor import document_lock, open_document, render_page
+from image_analyzer import RELATIONSHIP_TYPES, ElementTable, RelationshipTable
+from layout_cache import LayoutCache, page_key
+from pyramid_analyzer import pyramid_layout
+from stage_graph import PageStages
+from vector_analyzer import analyze_page
+
+# Per-process state of the pool workers. Each worker opens the document once
+# in its initializer and keeps it open for every page it is handed.
+_worker_doc = None
+_worker_cache = None
+
+
+def _init_worker(pdf_path, trace_path=None, cache_config=None):
+    """Open the document (and the layout cache, given its directory and size) once per worker process."""
+    global _worker_doc, _worker_cache
+    if trace_path:
+        instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path))
+    # The pool already uses every core, so keep OpenCV from spawning its own
+    # threads on top of it.
+    cv2.setNumThreads(1)
+    _worker_doc = fitz.open(pdf_path)
+    _worker_cache = LayoutCache(*cache_config) if cache_config else None
+
+
+def _analyze_page(page_number, zoom, granularity, mode='raster', method='contours', coarse_scale=None):
+    """Render and analyze one page with the worker's open document."""
+    return _analyze_doc_page(_worker_doc, page_number, zoom, granularity, _worker_cache, mode, method, coarse_scale)
+
+
+def _analyze_doc_page(doc, page_number, zoom, granularity, cache=None, mode='raster', method='contours',
+                      coarse_scale=None):
+    """Render and analyze one page of an open document, unless the layout cache has it."""
+    _check_pyramid(mode, method, coarse_scale)
+    start_time = time.perf_counter()
+    with instrumentation.span('page', page_number=page_number, zoom=zoom):
+        key = layout = None
+        if cache is not None:
+            # The 'auto' choice depends only on the page content, which the key already covers
+            params = {'mode': mode} if mode != 'raster' else {}
+            if method != 'contours':
+                params['method'] = method
+            if coarse_scale is not None:
+                params['coarse_scale'] = coarse_scale
+            key = page_key(doc, page_number, zoom=zoom, granularity=granularity, **params)
+            layout = cache.get(key)
+        if layout is not None:
+            instrumentation.count('layout_cache.hits')
+            elapsed = time.perf_counter() - start_time
+            layout.update(page_number=page_number, elapsed=elapsed, cached=True,
+                          timings={'render': 0.0, 'analyze': 0.0, 'total': elapsed})
+            return layout
+        if coarse_scale is not None:
+            # The coarse and refinement renders are only recorded in the trace
+            render_time = 0.0
+            layout = pyramid_layout(doc.load_page(page_number), zoom, granularity, coarse_scale)
+            layout['source'] = 'pyramid'
+        elif mode == 'raster':
+            page = doc.load_page(page_number)
+            stages = PageStages(lambda zoom, colorspace: render_page(page, zoom, colorspace))
+            with instrumentation.span('render'):
+                stages.get('grayscale', zoom)
+            render_time = time.perf_counter() - start_time
+            layout = stages.layout(zoom, granularity, method)
+            layout['source'] = 'raster'
+        else:
+            # Vector pages are not rendered at all, and the render time of
+            # rasterized ones is only recorded in the trace
+            render_time = 0.0
+            layout = analyze_page(doc.load_page(page_number), zoom, granularity, mode, method)
+        if cache is not None:
+            cache.put(key, layout)
+    elapsed = time.perf_counter() - start_time
+    layout['page_number'] = page_number
+    layout['cached'] = False
+    layout['elapsed'] = elapsed
+    layout['timings'] = {'render': render_time, 'analyze': elapsed - render_time, 'total': elapsed}
+    return layout
+
+
+def _check_pyramid(mode, method, coarse_scale):
+    """Reject the analysis options pyramid analysis cannot honor."""
+    if coarse_scale is not None and (mode != 'raster' or method != 'contours'):
+        raise ValueError(f"Pyramid analysis segments raster renders with contours, "
+                         f"got mode {mode!r} and method {method!r}")
+
+
+def analyze_pdf_page(pdf_path, page_number, zoom=1, granularity=50, cache=None, mode='raster', method='contours',
+                     coarse_scale=None):
+    """
+    Analyze one page of a PDF file using the open document this process keeps for it.
+
+    :param pdf_path: Path to the PDF file
+    :param page_number: Page number (0-indexed)
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity passed to analyze_layout
+    :param cache: Optional LayoutCache
+    :param mode: 'raster', 'vector' or 'auto'
+    :param method: Segmentation of rendered pages, 'contours' or 'xy_cut'
+    :param coarse_scale: Analyze with pyramid_layout at this coarse scale instead of at full resolution
+    :return: Layout dictionary (elements, relationships, page_number, timings, cached)
+    """
+    with document_lock():
+        # Opened under the lock, so another thread cannot evict and close it before it is used
+        doc, _ = open_document(pdf_path)
+        return _analyze_doc_page(doc, page_number, zoom, granularity, cache, mode, method, coarse_scale)
+
+
+def resolve_pages(pages, total_pages):
+    """Validate the requested 0-indexed page numbers (all pages by default)."""
+    if pages is None:
+        return list(range(total_pages))
+    pages = list(pages)
+    for page_number in pages:
+        if page_number < 0 or page_number >= total_pages:
+            raise ValueError(f"Invalid page number {page_number}. The document has {total_pages} pages.")
+    return pages
+
+
+def resolve_workers(workers, page_count):
+    """Number of worker processes to use: the requested number, or one per core, but no more than the pages."""
+    return max(1, min(workers or os.cpu_count() or 1, page_count or 1))
+
+
+def iter_page_layouts(pdf_path, pages=None, zoom=1, granularity=50, workers=None, lookahead=None,
+                      trace_path=None, cache=None, mode='raster', method='contours', coarse_scale=None):
+    """
+    Lazily analyze pages of a PDF file, yielding one layout at a time in page order.
+
+    At most `lookahead` pages are rendered or analyzed ahead of the consumer,
+    so memory stays flat however long the document is. Closing the generator
+    early cancels the pages that have not started yet.
+
+    :param pdf_path: Path to the PDF file
+    :param pages: Iterable of page numbers to analyze (0-indexed), all pages if None
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity passed to analyze_layout
+    :param workers: Number of worker processes, os.cpu_count() if None
+    :param lookahead: Maximum number of pages in flight, twice the number of workers if None
+    :param trace_path: Optional JSON-lines file receiving the stage timings of every worker
+    :param cache: Optional LayoutCache; pages found in it are neither rendered nor analyzed
+    :param mode: 'raster', 'vector' or 'auto' (vector for born-digital pages, raster for scans)
+    :param method: Segmentation of rendered pages, 'contours' or 'xy_cut'
+    :param coarse_scale: Analyze with pyramid_layout at this coarse scale instead of at full resolution
+    :return: Generator of layout dictionaries (elements, relationships, page_number, timings, cached)
+    """
+    _check_pyramid(mode, method, coarse_scale)
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    pages = resolve_pages(pages, total_pages)
+    workers = resolve_workers(workers, len(pages))
+
+    if workers == 1:
+        previous_sink = instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path)) if trace_path else None
+        try:
+            with fitz.open(pdf_path) as doc:
+                for page_number in pages:
+                    yield _analyze_doc_page(doc, page_number, zoom, granularity, cache, mode, method, coarse_scale)
+        finally:
+            if trace_path:
+                instrumentation.set_sink(previous_sink).close()
+        return
+
+    lookahead = max(lookahead or workers * 2, 1)
+    remaining = iter(pages)
+    in_flight = deque()
+    cache_config = (cache.directory, cache.max_bytes) if cache is not None else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(pdf_path, trace_path, cache_config)) as executor:
+        try:
+            for page_number in remaining:
+                in_flight.append(executor.submit(_analyze_page, page_number, zoom, granularity, mode, method,
+                                                 coarse_scale))
+                if len(in_flight) >= lookahead:
+                    break
+            while in_flight:
+                layout = in_flight.popleft().result()
+                page_number = next(remaining, None)
+                if page_number is not None:
+                    in_flight.append(executor.submit(_analyze_page, page_number, zoom, granularity, mode, method,
+                                                     coarse_scale))
+                yield layout
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def analyze_document(pdf_path, pages=None, zoom=1, granularity=50, workers=None, trace_path=None, cache=None,
+                     mode='raster', method='contours', coarse_scale=None):
+    """
+    Analyze the layout of many pages of a PDF file in parallel.
+
+    Pages are spread across a process pool in which every worker keeps its own
+    copy of the document open, so only page numbers and the (small) layout
+    results cross process boundaries. Use iter_page_layouts to process
+    documents whose results should not be held in memory all at once.
+
+    :param pdf_path: Path to the PDF file
+    :param pages: Iterable of page numbers to analyze (0-indexed), all pages if None
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity passed to analyze_layout
+    :param workers: Number of worker processes, os.cpu_count() if None
+    :param trace_path: Optional JSON-lines file receiving the stage timings of every worker
+    :param cache: Optional LayoutCache shared by all workers
+    :param mode: 'raster', 'vector' or 'auto' (vector for born-digital pages, raster for scans)
+    :param method: Segmentation of rendered pages, 'contours' or 'xy_cut'
+    :param coarse_scale: Analyze with pyramid_layout at this coarse scale instead of at full resolution
+    :return: Dictionary with the per-page layouts (in page order) and throughput figures
+    """
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    pages = resolve_pages(pages, total_pages)
+    workers = resolve_workers(workers, len(pages))
+
+    print(f"Analyzing {len(pages)} pages with {workers} worker(s)...")
+    start_time = time.time()
+    results = list(iter_page_layouts(pdf_path, pages, zoom, granularity, workers, trace_path=trace_path,
+                                     cache=cache, mode=mode, method=method, coarse_scale=coarse_scale))
+    elapsed = time.time() - start_time
+    pages_per_second = len(pages) / elapsed if elapsed > 0 else float('inf')
+    print(f"Analyzed {len(pages)} pages in {elapsed:.2f} seconds ({pages_per_second:.2f} pages/second)")
+
+    return {
+        'pdf_path': pdf_path,
+        'total_pages': total_pages,
+        'pages': results,
+        'workers': workers,
+        'elapsed': elapsed,
+        'pages_per_second': pages_per_second
+    }
+
+
+def layout_to_dict(layout):
+    """Convert a page layout to plain JSON-serializable types."""
+    elements = ElementTable.from_elements(layout['elements'])
+    relationships = RelationshipTable.from_tuples(layout['relationships'], len(elements))
+    record = {
+        'elements': [{'type': element_type, 'bbox': bbox}
+                     for element_type, bbox in zip(elements.type_names, elements.bboxes.tolist())],
+        'relationships': [[i, j, RELATIONSHIP_TYPES[code]] for i, j, code in
+                          zip(relationships.sources().tolist(), relationships.indices.tolist(),
+                              relationships.kinds.tolist())]
+    }
+    if layout.get('template') is not None:
+        # Elements reused from the document's repeated letterhead, footer or form skeleton
+        for element, is_template in zip(record['elements'], layout['template'].tolist()):
+            element['template'] = is_template
+    for key in ('page_number', 'timings', 'cached', 'source'):
+        if key in layout:
+            record[key] = layout[key]
+    if layout.get('reading_order') is not None:
+        record['reading_order'] = layout['reading_order'].to_dict()
+    return record
+
+
+def write_layouts_jsonl(layouts, output):
+    """
+    Stream page layouts to a JSON-lines file, one line per page as each page arrives.
+
+    :param layouts: Iterable of layouts, typically iter_page_layouts(...)
+    :param output: Path of the file to write, '-' for stdout, or an open text file
+    :return: Number of pages written
+    """
+    if output == '-':
+        return _write_jsonl(layouts, sys.stdout)
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'w', encoding='utf-8') as file:
+            return _write_jsonl(layouts, file)
+    return _write_jsonl(layouts, output)
+
+
+def _write_jsonl(layouts, file):
+    written = 0
+    for layout in layouts:
+        file.write(json.dumps(layout_to_dict(layout)) + '\n')
+        file.flush()
+        written += 1
+    return written
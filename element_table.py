@@ -0,0 +1,255 @@
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Tuple
+
+import numpy as np
+
+try:
+    import pyarrow
+except ImportError:  # Arrow export is optional
+    pyarrow = None
+
+# Element type names, indexed by the codes classify_bboxes() returns
+ELEMENT_TYPES = ('text_block', 'short_text', 'image', 'table', 'line', 'unknown')
+# Relationship names, indexed by the codes find_relationships() returns
+RELATIONSHIP_TYPES = ('horizontally_aligned', 'vertically_aligned', 'contains', 'contained_by')
+
+ElementType = IntEnum('ElementType', {name.upper(): code for code, name in enumerate(ELEMENT_TYPES)})
+RelationshipKind = IntEnum('RelationshipKind', {name.upper(): code for code, name in enumerate(RELATIONSHIP_TYPES)})
+
+
+@dataclass
+class LayoutElement:
+    type: str
+    bbox: Tuple[int, int, int, int]  # x, y, width, height
+
+
+def _type_codes(types, names):
+    """Turn type names or codes into an array of codes."""
+    if isinstance(types, (str, int)):
+        types = (types,)
+    return np.array([names.index(t) if isinstance(t, str) else int(t) for t in types], dtype=np.int8)
+
+
+class ElementTable:
+    """
+    Layout elements stored column-wise in NumPy arrays.
+
+    bboxes is an (n, 4) int32 array of x, y, width, height, stored in column
+    (Fortran) order so that every coordinate is a contiguous column, types an int8
+    array of ELEMENT_TYPES codes and density the ink density of every
+    element (NaN where it is not known, e.g. for tables built from LayoutElements). Iterating,
+    or indexing with an integer, yields LayoutElements, so code written for
+    lists of elements keeps working; indexing with a mask or an index array
+    returns another ElementTable.
+    """
+
+    __slots__ = ('bboxes', 'types', 'density')
+
+    def __init__(self, bboxes, types, density=None):
+        self.bboxes = np.asfortranarray(np.asarray(bboxes, dtype=np.int32).reshape(-1, 4))
+        self.types = np.asarray(types, dtype=np.int8).reshape(-1)
+        if density is None:
+            density = np.full(len(self.types), np.nan, dtype=np.float32)
+        self.density = np.asarray(density, dtype=np.float32).reshape(-1)
+        if not len(self.bboxes) == len(self.types) == len(self.density):
+            raise ValueError("bboxes, types and density must have the same length")
+
+    @classmethod
+    def from_elements(cls, elements):
+        """Build a table from LayoutElements (or return an ElementTable as it is)."""
+        if isinstance(elements, cls):
+            return elements
+        elements = list(elements)
+        return cls([element.bbox for element in elements], [ELEMENT_TYPES.index(element.type) for element in elements])
+
+    @property
+    def x(self):
+        return self.bboxes[:, 0]
+
+    @property
+    def y(self):
+        return self.bboxes[:, 1]
+
+    @property
+    def w(self):
+        return self.bboxes[:, 2]
+
+    @property
+    def h(self):
+        return self.bboxes[:, 3]
+
+    @property
+    def type_names(self):
+        return [ELEMENT_TYPES[code] for code in self.types.tolist()]
+
+    @property
+    def nbytes(self):
+        """Bytes held by the table's arrays."""
+        return self.bboxes.nbytes + self.types.nbytes + self.density.nbytes
+
+    def __len__(self):
+        return len(self.types)
+
+    def __iter__(self):
+        for code, bbox in zip(self.types.tolist(), self.bboxes.tolist()):
+            yield LayoutElement(ELEMENT_TYPES[code], tuple(bbox))
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return LayoutElement(ELEMENT_TYPES[self.types[index]], tuple(self.bboxes[index].tolist()))
+        return ElementTable(self.bboxes[index], self.types[index], self.density[index])
+
+    def __repr__(self):
+        return f'ElementTable({len(self)} elements)'
+
+    def elements(self):
+        """Return the elements as a list of LayoutElements."""
+        return list(self)
+
+    def of_type(self, *types):
+        """Return a boolean mask of the elements of any of the given types (names or codes)."""
+        return np.isin(self.types, _type_codes(types, ELEMENT_TYPES))
+
+    def in_region(self, x0, y0, x1, y1, contained=True):
+        """
+        Return a boolean mask of the elements inside (or, with contained=False, overlapping) a region.
+
+        :param x0, y0, x1, y1: Region corners in page pixels
+        """
+        x, y, w, h = self.bboxes.T
+        if contained:
+            return (x >= x0) & (y >= y0) & (x + w <= x1) & (y + h <= y1)
+        return (x < x1) & (y < y1) & (x + w > x0) & (y + h > y0)
+
+    def of_size(self, min_width=0, min_height=0, max_width=None, max_height=None, min_area=0):
+        """Return a boolean mask of the elements within the given size bounds."""
+        w, h = self.w, self.h
+        mask = (w >= min_width) & (h >= min_height) & (w.astype(np.int64) * h >= min_area)
+        if max_width is not None:
+            mask &= w <= max_width
+        if max_height is not None:
+            mask &= h <= max_height
+        return mask
+
+    def type_counts(self):
+        """Return the number of elements of every type, keyed by type name."""
+        counts = np.bincount(self.types, minlength=len(ELEMENT_TYPES)).tolist()
+        return dict(zip(ELEMENT_TYPES, counts))
+
+    def to_npz(self, path, relationships=None, compressed=False):
+        """
+        Save the columns (and optionally a RelationshipTable) as arrays in a .npz file.
+
+        The arrays are written as they are, without converting them to Python objects.
+        """
+        arrays = {'bboxes': self.bboxes, 'types': self.types, 'density': self.density}
+        if relationships is not None:
+            arrays.update(relationships.arrays())
+        (np.savez_compressed if compressed else np.savez)(path, **arrays)
+
+    @classmethod
+    def from_npz(cls, path):
+        """Load what to_npz() saved; returns (ElementTable, RelationshipTable or None)."""
+        with np.load(path) as data:
+            table = cls(data['bboxes'], data['types'], data['density'])
+            relationships = RelationshipTable(data['indptr'], data['indices'], data['kinds']) \
+                if 'indptr' in data else None
+        return table, relationships
+
+    def to_arrow(self):
+        """
+        Return the columns as a pyarrow.Table, sharing the NumPy buffers.
+
+        The bbox columns of the column-ordered bboxes array, the type codes and
+        the densities are wrapped without copying. Types are a dictionary column
+        over ELEMENT_TYPES. Requires pyarrow.
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for Arrow export")
+        columns = {name: pyarrow.array(self.bboxes[:, k]) for k, name in enumerate('xywh')}
+        columns['type'] = pyarrow.DictionaryArray.from_arrays(pyarrow.array(self.types),
+                                                              pyarrow.array(ELEMENT_TYPES))
+        columns['density'] = pyarrow.array(self.density)
+        return pyarrow.table(columns)
+
+
+class RelationshipTable:
+    """
+    Relationships between elements as a CSR adjacency with RELATIONSHIP_TYPES codes.
+
+    The relationships of element i are indices[indptr[i]:indptr[i + 1]], with
+    their kinds at the same positions; targets are sorted, so iterating yields
+    the (i, j, name) tuples of analyze_spatial_relationships in (i, j) order.
+    """
+
+    __slots__ = ('indptr', 'indices', 'kinds')
+
+    def __init__(self, indptr, indices, kinds):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.kinds = np.asarray(kinds, dtype=np.int8)
+
+    @classmethod
+    def from_pairs(cls, first, second, kinds, count):
+        """Build the adjacency of count elements from (first, second, kind) arrays in any order."""
+        first = np.asarray(first, dtype=np.int64)
+        second = np.asarray(second, dtype=np.int64)
+        kinds = np.asarray(kinds, dtype=np.int8)
+        if len(first) > 1 and not np.all((first[1:] > first[:-1]) |
+                                         ((first[1:] == first[:-1]) & (second[1:] > second[:-1]))):
+            order = np.lexsort((second, first))
+            first, second, kinds = first[order], second[order], kinds[order]
+        indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(first, minlength=count), out=indptr[1:])
+        return cls(indptr, second, kinds)
+
+    @classmethod
+    def from_tuples(cls, relationships, count):
+        """Build the adjacency from (i, j, name) tuples (or return a RelationshipTable as it is)."""
+        if isinstance(relationships, cls):
+            return relationships
+        relationships = list(relationships)
+        return cls.from_pairs([i for i, _, _ in relationships], [j for _, j, _ in relationships],
+                              [RELATIONSHIP_TYPES.index(kind) for _, _, kind in relationships], count)
+
+    @property
+    def count(self):
+        """Number of elements the adjacency covers."""
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        """Bytes held by the table's arrays."""
+        return self.indptr.nbytes + self.indices.nbytes + self.kinds.nbytes
+
+    def sources(self):
+        """Return the first element of every relationship, aligned with indices and kinds."""
+        return np.repeat(np.arange(self.count, dtype=np.int32), np.diff(self.indptr))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i, j, code in zip(self.sources().tolist(), self.indices.tolist(), self.kinds.tolist()):
+            yield i, j, RELATIONSHIP_TYPES[code]
+
+    def __repr__(self):
+        return f'RelationshipTable({len(self)} relationships between {self.count} elements)'
+
+    def neighbours(self, i):
+        """Return the (targets, kinds) arrays of the relationships of element i."""
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:stop], self.kinds[start:stop]
+
+    def of_kind(self, *kinds):
+        """Return the (first, second) arrays of the relationships of any of the given kinds (names or codes)."""
+        mask = np.isin(self.kinds, _type_codes(kinds, RELATIONSHIP_TYPES))
+        return self.sources()[mask], self.indices[mask]
+
+    def kind_counts(self):
+        counts = np.bincount(self.kinds, minlength=len(RELATIONSHIP_TYPES)).tolist()
+        return dict(zip(RELATIONSHIP_TYPES, counts))
+
+    def arrays(self):
+        return {'indptr': self.indptr, 'indices': self.indices, 'kinds': self.kinds}
@@ -1,7 +1,8 @@
 import cv2
+import math
 import numpy as np
 import os
-import threading
+import traceback
 
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -10,36 +11,429 @@ from kivy.uix.checkbox import CheckBox
 from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
+from kivy.graphics import Color, InstructionGroup, Line, Mesh, PopMatrix, PushMatrix, Rectangle, Scale, Translate
 from kivy.graphics.texture import Texture
+from kivy.core.text import Label as CoreLabel
 from kivy.uix.filechooser import FileChooserListView
 from kivy.uix.popup import Popup
+from kivy.uix.recyclelayout import RecycleLayout
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.spinner import Spinner
 from kivy.clock import Clock
+from kivy.properties import BooleanProperty, NumericProperty, StringProperty
 from kivy.uix.slider import Slider
 from kivy.uix.togglebutton import ToggleButton
 from kivy.uix.splitter import Splitter  # Import Splitter
 from kivy.core.window import Window
 
-from pdf_processor import load_pdf, get_total_pages
-from image_analyzer import analyze_layout, preprocess_image
+from pdf_processor import get_total_pages
+from image_analyzer import ELEMENT_TYPES, RELATIONSHIP_TYPES, ElementTable, RelationshipTable
+from page_prefetcher import PagePrefetcher
+from layout_cache import LayoutCache, pdf_page_key
+from stage_graph import StageGraph
+from ui_scheduler import LatestWinsScheduler
+
+# Pages rendered (and, once a page has been analyzed, analyzed) ahead on each side of the current page
+PREFETCH_DEPTH = 2
+# Memory budget of the rendered pages kept for page flips and of their memoized analysis stages
+PREFETCH_CACHE_BYTES = 512 * 1024 * 1024
+# Part of PREFETCH_CACHE_BYTES given to the memoized stages (binary, dilated, ...) rather than to rendered pages
+STAGE_MEMO_BYTES = PREFETCH_CACHE_BYTES // 4
+# Seconds without page slider or zoom changes before the page is rendered
+INPUT_DEBOUNCE = 0.15
+# Threads rendering and analyzing the page on screen
+SCHEDULER_WORKERS = 2
+
+# Overlay colors (RGB, 0-255) of the element types
+ELEMENT_COLORS = {
+    'text_block': (0, 128, 0),  # Dark Green
+    'short_text': (0, 192, 0),  # Light Green
+    'image': (128, 0, 0),      # Dark Red
+    'table': (0, 0, 128),      # Dark Blue
+    'line': (128, 128, 0),     # Olive
+    'unknown': (64, 64, 64)    # Dark Gray
+}
+RELATIONSHIP_COLOR = (128, 0, 128)  # Dark Magenta
+SELECTION_COLOR = (255, 128, 0)  # Orange
+# Opacity of the overlay drawn over the page
+OVERLAY_OPACITY = 0.3
+# Vertices per relationship mesh, an even number below the 16-bit index limit
+MESH_MAX_VERTICES = 65534
+# Results panel: toggle button height, height of the filters and list when expanded, and row height
+RESULTS_TOGGLE_HEIGHT = 40
+RESULTS_PANEL_HEIGHT = 300
+RESULT_ROW_HEIGHT = 24
+# Background of the rows of the selected element (RGBA, 0-1)
+SELECTED_ROW_COLOR = (1, 0.5, 0, 0.35)
+# Filter choices that let every element type or relationship kind through
+ALL_TYPES = 'All types'
+ALL_RELATIONSHIPS = 'All relationships'
+
+
+class ResultRow(RecycleDataViewBehavior, Label):
+    """
+    One row of the results list.
+
+    Rows only hold the kind and table index of what they show; the text is
+    formatted from the layout tables when the row scrolls into view, so the
+    cost of the list depends on the rows on screen, not on the element count.
+    """
+    kind = StringProperty('heading')
+    item = NumericProperty(-1)
+    selected = BooleanProperty(False)
 
-
-class CollapsibleTextInput(BoxLayout):
     def __init__(self, **kwargs):
-        super(CollapsibleTextInput, self).__init__(orientation='vertical', **kwargs)
-        self.toggle_button = ToggleButton(text='Show Analysis Results', size_hint_y=None, height=40)
+        super(ResultRow, self).__init__(halign='left', valign='middle', font_size=13, padding=(5, 0), **kwargs)
+        self.results = None
+        with self.canvas.before:
+            self._background_color = Color(0, 0, 0, 0)
+            self._background = Rectangle()
+        self.bind(pos=self._update_background, size=self._update_background, selected=self._update_background)
+
+    def refresh_view_attrs(self, rv, index, data):
+        if self.results is None:
+            self.results = rv.results
+            self.results.bind(selected=self._on_selection)
+        super(ResultRow, self).refresh_view_attrs(rv, index, data)
+        if self.kind != 'heading':
+            self.text = self.results.row_text(self.kind, self.item)
+        self.bold = self.kind == 'heading'
+        self.selected = self.results.is_selected(self.kind, self.item)
+
+    def on_touch_down(self, touch):
+        if self.collide_point(*touch.pos) and self.kind != 'heading':
+            self.results.select(self.results.row_element(self.kind, self.item), scroll=False, notify=True)
+            return True
+        return super(ResultRow, self).on_touch_down(touch)
+
+    def _on_selection(self, instance, value):
+        self.selected = self.results.is_selected(self.kind, self.item)
+
+    def _update_background(self, *args):
+        self.text_size = self.size
+        self._background.pos = self.pos
+        self._background.size = self.size
+        self._background_color.rgba = SELECTED_ROW_COLOR if self.selected else (0, 0, 0, 0)
+
+
+class _UniformRowOptions:
+    """Sizing options of the rows of a UniformRowLayout, computed when a row is shown instead of stored per row."""
+
+    def __init__(self, layout, count):
+        self.layout = layout
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        layout = self.layout
+        return {'size': [layout.width, layout.row_height], 'size_hint': [None, None],
+                'size_hint_min': [None, None], 'size_hint_max': [None, None],
+                'pos': [layout.x, layout.top - (index + 1) * layout.row_height], 'pos_hint': {},
+                'viewclass': layout.viewclass, 'width_none': False, 'height_none': False}
+
+
+class UniformRowLayout(RecycleLayout):
+    """
+    RecycleView layout manager for a single column of rows of one height.
+
+    RecycleBoxLayout stores sizing options for every row and walks all of them
+    whenever the data changes. With equal rows, the position of any row and
+    the rows inside the viewport follow from the row height, so a layout pass
+    costs the same for a hundred rows as for a million.
+    """
+    row_height = NumericProperty(RESULT_ROW_HEIGHT)
+
+    def compute_sizes_from_data(self, data, flags):
+        self.clear_layout()
+        self.view_opts = _UniformRowOptions(self, len(data))
+
+    def compute_layout(self, data, flags):
+        self._size_needs_update = False
+        self.clear_layout()  # The rows on screen are laid out again at the current width
+        self.height = len(data) * self.row_height
+
+    def compute_visible_views(self, data, viewport):
+        x, y, width, height = viewport
+        first = max(0, int((self.top - y - height) // self.row_height))
+        last = min(len(data), math.ceil((self.top - y) / self.row_height))
+        return range(first, last)
+
+    def get_view_index_at(self, pos):
+        return min(max(0, int((self.top - pos[1]) // self.row_height)), max(0, len(self.view_opts) - 1))
+
+
+class ResultsList(RecycleView):
+    """RecycleView of ResultRows; only the rows in the viewport exist as widgets."""
+
+    def __init__(self, results, **kwargs):
+        super(ResultsList, self).__init__(**kwargs)
+        self.results = results
+        self.add_widget(UniformRowLayout(row_height=RESULT_ROW_HEIGHT, size_hint_y=None))
+        self.viewclass = ResultRow  # Stored on the layout manager, so it must be set after adding it
+
+
+class ResultsView(BoxLayout):
+    """
+    Collapsible, virtualized list of the elements and relationships of a layout.
+
+    The list data is one small dictionary per row (its kind and index in the
+    ElementTable or RelationshipTable), built with the filters applied; the
+    rows on screen format their own text. Selecting a row calls on_select
+    with the index of its element (the first element, for relationships).
+    """
+    selected = NumericProperty(-1)  # Index of the selected element, -1 for none
+
+    def __init__(self, on_select=None, **kwargs):
+        super(ResultsView, self).__init__(orientation='vertical', size_hint_y=None, height=RESULTS_TOGGLE_HEIGHT,
+                                          **kwargs)
+        self.on_select = on_select
+        self.layout = None
+        self.elements = None
+        self.relationships = None
+        self.show_relationships = False
+        self._sources = None
+        self._element_rows = None  # Element indices listed, in row order after the heading
+
+        self.toggle_button = ToggleButton(text='Show Analysis Results', size_hint_y=None, height=RESULTS_TOGGLE_HEIGHT)
         self.toggle_button.bind(on_press=self.toggle_content)
         self.add_widget(self.toggle_button)
-        
-        self.content = TextInput(readonly=True, size_hint_y=None, height=0)
-        self.add_widget(self.content)
-    
+
+        self.content = BoxLayout(orientation='vertical', size_hint_y=None, height=RESULTS_PANEL_HEIGHT)
+        filters = BoxLayout(size_hint_y=None, height=30)
+        self.type_filter = Spinner(text=ALL_TYPES, values=(ALL_TYPES,) + ELEMENT_TYPES)
+        self.relationship_filter = Spinner(text=ALL_RELATIONSHIPS, values=(ALL_RELATIONSHIPS,) + RELATIONSHIP_TYPES)
+        self.type_filter.bind(text=self.rebuild)
+        self.relationship_filter.bind(text=self.rebuild)
+        filters.add_widget(self.type_filter)
+        filters.add_widget(self.relationship_filter)
+        self.content.add_widget(filters)
+        self.list = ResultsList(self)
+        self.content.add_widget(self.list)
+        self.rebuild()
+
     def toggle_content(self, instance):
         if instance.state == 'down':
             instance.text = 'Hide Analysis Results'
-            self.content.height = 200  # or any desired height
+            self.add_widget(self.content)
+            self.height = RESULTS_TOGGLE_HEIGHT + RESULTS_PANEL_HEIGHT
         else:
             instance.text = 'Show Analysis Results'
-            self.content.height = 0
+            self.remove_widget(self.content)
+            self.height = RESULTS_TOGGLE_HEIGHT
+
+    def set_layout(self, layout, show_relationships=False):
+        """List the elements (and relationships, if shown) of a layout, or clear the list when layout is None."""
+        if layout is self.layout and show_relationships == self.show_relationships:
+            return
+        if layout is not self.layout:
+            self.selected = -1  # Toggling the relationships keeps the selection
+        self.layout = layout
+        if layout:
+            self.elements = ElementTable.from_elements(layout['elements'])
+            self.relationships = RelationshipTable.from_tuples(layout['relationships'], len(self.elements))
+            self._sources = self.relationships.sources()
+        else:
+            self.elements = self.relationships = self._sources = None
+        self.show_relationships = show_relationships
+        self.rebuild()
+
+    def rebuild(self, *args):
+        """Rebuild the row data from the layout tables and the filters."""
+        if self.elements is None:
+            self._element_rows = None
+            self.list.data = [{'kind': 'heading', 'text': 'No layout data available'}]
+            return
+        shown = np.ones(len(self.elements), dtype=bool) if self.type_filter.text == ALL_TYPES \
+            else self.elements.of_type(self.type_filter.text)
+        self._element_rows = np.flatnonzero(shown)
+        rows = [{'kind': 'heading', 'text': f'Elements ({len(self._element_rows)} of {len(self.elements)})'}]
+        rows.extend({'kind': 'element', 'item': i} for i in self._element_rows.tolist())
+        if self.show_relationships:
+            # Relationships of the listed elements, of the chosen kind
+            listed = shown[self._sources]
+            if self.relationship_filter.text != ALL_RELATIONSHIPS:
+                listed &= self.relationships.kinds == RELATIONSHIP_TYPES.index(self.relationship_filter.text)
+            relationship_rows = np.flatnonzero(listed)
+            rows.append({'kind': 'heading', 'text': f'Relationships ({len(relationship_rows)} of '
+                                                    f'{len(self.relationships)})'})
+            rows.extend({'kind': 'relationship', 'item': r} for r in relationship_rows.tolist())
+        else:
+            rows.append({'kind': 'heading', 'text': "Relationships are hidden. Check 'Show Relationships' to view."})
+        self.list.data = rows
+
+    def row_text(self, kind, item):
+        if kind == 'element':
+            return f"{item}: {ELEMENT_TYPES[self.elements.types[item]]} at {tuple(self.elements.bboxes[item].tolist())}"
+        return (f"Element {self._sources[item]} is {RELATIONSHIP_TYPES[self.relationships.kinds[item]]} "
+                f"Element {self.relationships.indices[item]}")
+
+    def row_element(self, kind, item):
+        """Return the element a row stands for (the first element of a relationship)."""
+        return item if kind == 'element' else int(self._sources[item])
+
+    def is_selected(self, kind, item):
+        if self.selected < 0 or kind == 'heading' or self.elements is None:
+            return False
+        if kind == 'element':
+            return item == self.selected
+        return self.selected in (self._sources[item], self.relationships.indices[item])
+
+    def select(self, index, scroll=True, notify=False):
+        """
+        Select an element (None clears the selection).
+
+        :param scroll: Scroll its row into view if it passes the type filter
+        :param notify: Pass the selection on to on_select
+        """
+        self.selected = -1 if index is None else int(index)
+        if scroll and index is not None and self._element_rows is not None:
+            position = int(np.searchsorted(self._element_rows, index))
+            if position < len(self._element_rows) and self._element_rows[position] == index:
+                self._scroll_to_row(position + 1)  # After the heading
+        if notify and self.on_select is not None:
+            self.on_select(index)
+
+    def _scroll_to_row(self, row):
+        """Center a row in the viewport; rows all have the same height, so no layout pass is needed."""
+        content_height = len(self.list.data) * RESULT_ROW_HEIGHT
+        overflow = content_height - self.list.height
+        if overflow <= 0:
+            return
+        top = row * RESULT_ROW_HEIGHT - (self.list.height - RESULT_ROW_HEIGHT) / 2
+        self.list.scroll_y = min(1.0, max(0.0, 1 - top / overflow))
+
+
+class LayoutOverlay:
+    """
+    Canvas instructions drawing layout boxes, labels and relationship lines over the page preview.
+
+    The instructions are built once per layout in page pixel coordinates and
+    mapped onto the displayed image by a translate/scale pair, so resizing
+    the window only updates two transforms and toggling the relationships
+    only adds or removes their group. The page texture is never touched.
+    """
+
+    def __init__(self, image_widget):
+        self.image_widget = image_widget
+        self.layout = None
+        self.elements = None
+        self._label_textures = {}
+        self._translate = Translate(0, 0)
+        self._scale = Scale(1, -1, 1)
+        self._boxes = InstructionGroup()
+        self._relationships = None  # Built the first time they are shown
+        self._relationship_layer = InstructionGroup()
+        self._show_relationships = False
+        self._selection = InstructionGroup()
+        group = InstructionGroup()
+        for instruction in (PushMatrix(), self._translate, self._scale, self._boxes, self._relationship_layer,
+                            self._selection, PopMatrix()):
+            group.add(instruction)
+        image_widget.canvas.after.add(group)
+        image_widget.bind(size=self.update_transform, pos=self.update_transform,
+                          texture=self.update_transform)
+
+    def set_layout(self, layout):
+        """Draw the elements of a layout, or clear the overlay when layout is None."""
+        if layout is self.layout:
+            return
+        self.layout = layout
+        self.elements = ElementTable.from_elements(layout['elements']) if layout else None
+        self._boxes.clear()
+        self._relationship_layer.clear()
+        self._selection.clear()
+        self._relationships = None
+        if layout:
+            self._draw_elements(self.elements)
+            self.show_relationships(self._show_relationships)
+        self.update_transform()
+
+    def show_relationships(self, visible):
+        self._show_relationships = visible
+        self._relationship_layer.clear()
+        if visible and self.layout:
+            if self._relationships is None:
+                self._relationships = self._draw_relationships(self.layout)
+            self._relationship_layer.add(self._relationships)
+
+    def select(self, index):
+        """Outline one element in the selection color (None clears the selection)."""
+        self._selection.clear()
+        if index is None or self.elements is None:
+            return
+        red, green, blue = SELECTION_COLOR
+        self._selection.add(Color(red / 255, green / 255, blue / 255, 1))
+        self._selection.add(Line(rectangle=tuple(self.elements.bboxes[index].tolist()), width=2))
+
+    def element_at(self, x, y):
+        """Return the index of the smallest element under a point in widget coordinates, or None."""
+        if self.elements is None or not self._scale.x:
+            return None
+        page_x = (x - self._translate.x) / self._scale.x
+        page_y = (y - self._translate.y) / self._scale.y
+        hits = np.flatnonzero(self.elements.in_region(page_x, page_y, page_x, page_y, contained=False))
+        if not len(hits):
+            return None
+        areas = self.elements.w[hits].astype(np.int64) * self.elements.h[hits]
+        return int(hits[np.argmin(areas)])
+
+    def update_transform(self, *args):
+        """Map page pixels (origin top-left) onto the image as displayed (origin bottom-left)."""
+        widget = self.image_widget
+        texture = widget.texture
+        if texture is None:
+            return
+        display_width, display_height = widget.norm_image_size
+        scale = display_width / texture.width
+        self._translate.x = widget.center_x - display_width / 2
+        self._translate.y = widget.center_y + display_height / 2
+        self._scale.x = scale
+        self._scale.y = -scale
+
+    def _draw_elements(self, elements):
+        for element in elements:
+            x, y, w, h = element.bbox
+            red, green, blue = ELEMENT_COLORS.get(element.type, ELEMENT_COLORS['unknown'])
+            self._boxes.add(Color(red / 255, green / 255, blue / 255, OVERLAY_OPACITY))
+            self._boxes.add(Line(rectangle=(x, y, w, h), width=1))
+            # Filled label background with the type name in white
+            self._boxes.add(Rectangle(pos=(x, y - 20), size=(len(element.type) * 8, 20)))
+            texture = self._label_texture(element.type)
+            self._boxes.add(Color(1, 1, 1, OVERLAY_OPACITY))
+            self._boxes.add(Rectangle(texture=texture, pos=(x, y - 18), size=texture.size))
+
+    def _draw_relationships(self, layout):
+        """Return every relationship line as a single mesh."""
+        elements = self.elements
+        relationships = RelationshipTable.from_tuples(layout['relationships'], len(elements))
+        centers = elements.bboxes[:, :2] + elements.bboxes[:, 2:] // 2
+        # Each line is two (x, y, u, v) vertices: the centers of both elements
+        lines = np.zeros((len(relationships), 2, 4), dtype=np.float32)
+        lines[:, 0, :2] = centers[relationships.sources()]
+        lines[:, 1, :2] = centers[relationships.indices]
+        vertices = lines.ravel().tolist()
+        group = InstructionGroup()
+        red, green, blue = RELATIONSHIP_COLOR
+        group.add(Color(red / 255, green / 255, blue / 255, OVERLAY_OPACITY))
+        # Mesh indices are 16-bit, so split dense pages over several meshes
+        for start in range(0, len(vertices), MESH_MAX_VERTICES * 4):
+            chunk = vertices[start:start + MESH_MAX_VERTICES * 4]
+            group.add(Mesh(vertices=chunk, indices=list(range(len(chunk) // 4)), mode='lines'))
+        return group
+
+    def _label_texture(self, text):
+        texture = self._label_textures.get(text)
+        if texture is None:
+            label = CoreLabel(text=text, font_size=12)
+            label.refresh()
+            texture = label.texture
+            texture.flip_vertical()  # The overlay transform flips the y axis
+            self._label_textures[text] = texture
+        return texture
+
 
 class PDFAnalyzerGUI(BoxLayout):
     def __init__(self, **kwargs):
@@ -52,6 +446,8 @@ class PDFAnalyzerGUI(BoxLayout):
         # Splitter configuration for left image pane 
         left_splitter = Splitter(sizable_from='right', min_size=100, max_size=2000, size_hint=(1, 1))
         self.image_preview = Image(allow_stretch=True, keep_ratio=True)
+        self.overlay = LayoutOverlay(self.image_preview)
+        self.image_preview.bind(on_touch_down=self.on_preview_touch)
         left_splitter.add_widget(self.image_preview)
         self.add_widget(left_splitter)
 
@@ -110,7 +506,7 @@ class PDFAnalyzerGUI(BoxLayout):
         right_pane.add_widget(slider_layout)
 
         # Layout data display (collapsible)
-        self.layout_data_display = CollapsibleTextInput(size_hint_y=None, height=40)
+        self.layout_data_display = ResultsView(on_select=self.overlay.select)
         right_pane.add_widget(self.layout_data_display)
 
         # Bottom controls
@@ -143,7 +539,27 @@ class PDFAnalyzerGUI(BoxLayout):
         self.loading_popup = Popup(title='Analyzing...', content=Label(text='Please wait...'), size_hint=(0.8, 0.2))
 
         self.current_image = None
+        self._image_view = None  # (pdf_path, page_number, zoom, preprocessed) of current_image
+        # The page texture is uploaded once per page, zoom and preprocessing state
+        self._page_texture = None
+        self._page_texture_key = None
         self.layout_data = None
+        # Memoized render, binary, dilated, ... images of recent pages, shared with the prefetcher,
+        # so preview and analysis compute each of them once and a new granularity starts at dilation
+        self.stages = StageGraph(max_bytes=STAGE_MEMO_BYTES)
+        self._resegment_trigger = Clock.create_trigger(self.resegment, 0.05)
+        self._page_trigger = Clock.create_trigger(self._load_requested_page, INPUT_DEBOUNCE)
+        self._requested_page = None
+        # Renders and analyses of the page on screen. A newer request on the
+        # same channel supersedes the older one, whose result is then dropped.
+        self.scheduler = LatestWinsScheduler(SCHEDULER_WORKERS,
+                                             deliver=lambda call: Clock.schedule_once(lambda dt: call()))
+        # Once a page has been analyzed, every page shown is analyzed too
+        self.follow_analysis = False
+        # Layouts persist across sessions, so reopening a document skips analysis
+        self.layout_cache = LayoutCache()
+        self.prefetcher = PagePrefetcher(depth=PREFETCH_DEPTH, cache_bytes=PREFETCH_CACHE_BYTES - STAGE_MEMO_BYTES,
+                                         layout_cache=self.layout_cache, stages=self.stages)
         self.pdf_path = None
         self.total_pages = 1
         self.zoom_value = 1 # zoom value starts at 1 (100%)
@@ -168,7 +584,16 @@ class PDFAnalyzerGUI(BoxLayout):
         self.zoom_value = max(0.25, value)  # Ensuring zoom doesn't go below 0.25 (25%)
         self.zoom_label.text = f'Zoom: {int(self.zoom_value * 100)}%'
         if self.pdf_path:
-            self.load_page(int(self.current_page_input.text))
+            self.request_page(int(self.current_page_input.text))
+
+    def request_page(self, page_number):
+        """Load a page once the slider or zoom buttons have been still for INPUT_DEBOUNCE seconds."""
+        self._requested_page = page_number
+        self._page_trigger.cancel()
+        self._page_trigger()
+
+    def _load_requested_page(self, dt):
+        self.load_page(self._requested_page)
 
     def show_file_chooser(self, instance):
         content = BoxLayout(orientation='vertical')
@@ -203,29 +628,113 @@ class PDFAnalyzerGUI(BoxLayout):
             self.page_inc_button.disabled = (self.total_pages == 1)
         except Exception as e:
             print(f"Error loading PDF: {str(e)}")
-            import traceback
             traceback.print_exc()
 
+    def current_view(self):
+        """Return the (pdf_path, page_number, zoom) the controls show."""
+        return self.pdf_path, int(self.current_page_input.text), self.zoom_value
+
     def load_page(self, page_number):
         try:
-            self.current_image, _ = load_pdf(self.pdf_path, page_number - 1, self.zoom_value)
-            print(f"Image shape: {self.current_image.shape}")
+            # The controls follow the request at once; the page is rendered on
+            # the scheduler, and a newer page or zoom request supersedes it
             self.current_page_input.text = str(page_number)
             self.page_slider.value = page_number
-            self.update_image_preview()
-            if self.layout_data:
-                self.layout_data = None
-                self.update_layout_data_display()  # Clear the layout data display
-                self.analyze_layout()  # Re-analyze layout if there was previous data
-            
-            # Update increment/decrement button states
             self.page_dec_button.disabled = (page_number == 1)
             self.page_inc_button.disabled = (page_number == self.total_pages)
+            self.submit_render()
+            if self.follow_analysis:
+                self.layout_data = None
+                self.overlay.set_layout(None)  # Boxes of the previous page
+                self.update_layout_data_display()  # Clear the layout data display
+                self.request_page_analysis(page_number)
+            granularity = int(self.granularity_slider.value) if self.follow_analysis else None
+            self.prefetcher.prefetch_around(self.pdf_path, page_number - 1, self.total_pages, self.zoom_value,
+                                            granularity)
         except Exception as e:
             print(f"Error loading page: {str(e)}")
-            import traceback
             traceback.print_exc()
 
+    def submit_render(self):
+        """Render the page the controls show, as preprocessed if the checkbox is on, superseding earlier renders."""
+        self.scheduler.submit('render', self._render_page, self.current_view(), self.preprocess_checkbox.active,
+                              on_done=self.show_page_image, on_error=self.on_task_error)
+
+    def _render_page(self, token, view, preprocessed):
+        """
+        Return the image to display for a page, off the UI thread.
+
+        Rendered pages come from the shared page cache, so stepping back to a
+        page or zoom level seen before does not re-render it. The preprocessed
+        preview is the binary image analysis thresholds too, so showing it
+        first saves analysis that step.
+
+        :return: Tuple of (view plus the preprocessed flag, RGB image)
+        """
+        pdf_path, page_number, zoom = view
+        stages = self.stages.page(pdf_path, page_number - 1)
+        if preprocessed:
+            image = cv2.cvtColor(stages.get('binary', zoom), cv2.COLOR_GRAY2RGB)
+        else:
+            image = stages.get('render', zoom)
+        return view + (preprocessed,), image
+
+    def show_page_image(self, result):
+        self._image_view, self.current_image = result
+        self.update_image_preview()
+
+    def request_page_analysis(self, page_number):
+        # Use the layout prefetched for this page if there is one, otherwise
+        # analyze it on the scheduler, superseding any earlier analysis
+        granularity = int(self.granularity_slider.value)
+        layout = self.prefetcher.get_layout(self.pdf_path, page_number - 1, self.zoom_value, granularity)
+        if layout is not None:
+            self.scheduler.cancel('analysis')
+            self.show_page_layout((self.current_view(), layout))
+            return
+        self.scheduler.submit('analysis', self._analyze_page, self.current_view(), granularity,
+                              on_done=self.show_page_layout, on_error=self.on_task_error)
+
+    def _analyze_page(self, token, view, granularity, persist=True):
+        """
+        Analyze a page stage by stage, stopping at the first stage boundary after a newer request.
+
+        Analysis works on a grayscale render of the page, not on the displayed
+        color page. Stages already computed for the page, such as the binary
+        image of the preview or of an earlier granularity, are reused.
+
+        :param persist: Look the layout up in the layout cache and store it there; live re-segmentation does not
+        :return: Tuple of (view, layout)
+        """
+        pdf_path, page_number, zoom = view
+        cache_key = None
+        if persist:
+            cache_key = pdf_page_key(pdf_path, page_number - 1, zoom=zoom, granularity=granularity)
+            layout = self.layout_cache.get(cache_key)
+            if layout is not None:
+                return view, layout
+        stages = self.stages.page(pdf_path, page_number - 1)
+        for stage in ('grayscale', 'binary', 'dilated', 'contours', 'elements'):
+            stages.get(stage, zoom, granularity)
+            token.check()
+        layout = stages.layout(zoom, granularity)
+        if cache_key is not None:
+            self.layout_cache.put(cache_key, layout)
+        return view, layout
+
+    def show_page_layout(self, result):
+        view, layout = result
+        self.loading_popup.dismiss()
+        if view != self.current_view():
+            return  # Analysis of a page or zoom level the user has already left
+        self.layout_data = layout
+        self.update_image_preview()
+        self.update_layout_data_display()
+
+    def on_task_error(self, error):
+        print(f"Error: {str(error)}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.loading_popup.dismiss()
 
     def on_window_resize(self, instance, width, height):
         # This method will be called whenever the window size changes
@@ -247,138 +756,74 @@ class PDFAnalyzerGUI(BoxLayout):
     def on_page_slider(self, instance, value):
         page = int(value)
         if page != int(self.current_page_input.text):
-            self.load_page(page)
+            self.request_page(page)
 
     def on_preprocess_change(self, instance, value):
         if self.current_image is not None:
-            self.update_image_preview()
+            self.submit_render()
 
     def on_relationship_change(self, instance, value):
+        self.overlay.show_relationships(value)
         if self.layout_data:
-            self.update_image_preview()
+            self.update_layout_data_display()
 
     def on_granularity_change(self, instance, value):
-        # We don't need to do anything here, as the value will be used in start_analysis
-        pass
+        # Once the page has been analyzed, re-segment live while the slider moves
+        if self.layout_data:
+            self._resegment_trigger()
+
+    def resegment(self, dt):
+        if self.layout_data:
+            self.scheduler.submit('analysis', self._analyze_page, self.current_view(),
+                                  int(self.granularity_slider.value), persist=False,
+                                  on_done=self.show_page_layout, on_error=self.on_task_error)
 
     def start_analysis(self, instance):
         if self.current_image is not None:
             self.loading_popup.open()
-            threading.Thread(target=self.analyze_layout).start()
-
-    def analyze_layout(self):
-        try:
-            image = preprocess_image(self.current_image) if self.preprocess_checkbox.active else self.current_image
-            granularity = int(self.granularity_slider.value)
-            self.layout_data = analyze_layout(image, granularity)
-            Clock.schedule_once(self.update_ui_after_analysis)
-        except Exception as e:
-            print(f"Error analyzing layout: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            Clock.schedule_once(lambda dt: self.loading_popup.dismiss())
-
-    def update_ui_after_analysis(self, dt):
-        self.loading_popup.dismiss()
-        self.update_image_preview()
-        self.update_layout_data_display()
+            self.follow_analysis = True
+            self.request_page_analysis(int(self.current_page_input.text))
 
     def update_image_preview(self):
         if self.current_image is not None:
-            image = self.current_image.copy()
-            if self.preprocess_checkbox.active:
-                image = preprocess_image(image)
-            
-            image = self.prepare_image_for_display(image)
-
-            buf = image.tobytes()
-            texture = Texture.create(size=(image.shape[1], image.shape[0]), colorfmt='rgb')
-            texture.blit_buffer(buf, colorfmt='rgb', bufferfmt='ubyte')
-            self.image_preview.texture = texture
-
-    def prepare_image_for_display(self, image):
-        # Ensure the image is in RGB format
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        
-        # Apply layout if available
-        if self.layout_data:
-            image = self.apply_layout_to_image(image)
-        
-        # Flip the image vertically
-        image = cv2.flip(image, 0)
-        
-        return image
-
-    def apply_layout_to_image(self, image):
-        if not self.layout_data:
-            return image
-
-        overlay = image.copy()
-        elements = self.layout_data['elements']
-        relationships = self.layout_data['relationships']
-
-        # Draw bounding boxes for elements
-        colors = {
-            'text_block': (0, 128, 0),  # Dark Green
-            'short_text': (0, 192, 0),  # Light Green
-            'image': (128, 0, 0),      # Dark Blue
-            'table': (0, 0, 128),      # Dark Red
-            'line': (128, 128, 0),     # Dark Cyan
-            'unknown': (64, 64, 64)    # Dark Gray
-        }
-
-
-        for element in elements:
-            x, y, w, h = element.bbox
-            color = colors.get(element.type, (64, 64, 64))
-            # Draw filled rectangle for better visibility
-            cv2.rectangle(overlay, (x, y), (x + w, y + h), color, 2)
-            # Draw filled rectangle for the label background
-            cv2.rectangle(overlay, (x, y - 20), (x + len(element.type) * 8, y), color, -1)
-            # White text on color background
-            cv2.putText(overlay, element.type, (x, y - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-
-        # Draw lines for relationships only if checkbox is checked
-        if self.relationship_checkbox.active:
-            for i, j, relationship in relationships:
-                elem1 = elements[i]
-                elem2 = elements[j]
-                x1, y1, w1, h1 = elem1.bbox
-                x2, y2, w2, h2 = elem2.bbox
-                start = (x1 + w1 // 2, y1 + h1 // 2)
-                end = (x2 + w2 // 2, y2 + h2 // 2)
-                cv2.line(overlay, start, end, (128, 0, 128), 1)  # Dark Magenta
-
-        # Blend the overlay with the original image
-        result = cv2.addWeighted(image, 0.7, overlay, 0.3, 0)
-        return result
+            # Keyed by the page the image shows, which trails the controls while a render is pending
+            if self._image_view != self._page_texture_key:
+                self._page_texture = self.create_page_texture(self.current_image)
+                self._page_texture_key = self._image_view
+            self.image_preview.texture = self._page_texture
+        self.overlay.set_layout(self.layout_data)
+
+    def create_page_texture(self, image):
+        # The image is uploaded as is: rows run top to bottom, and the flip
+        # to Kivy's bottom-up convention happens in the texture coordinates
+        texture = Texture.create(size=(image.shape[1], image.shape[0]), colorfmt='rgb')
+        texture.blit_buffer(image.tobytes(), colorfmt='rgb', bufferfmt='ubyte')
+        texture.flip_vertical()
+        return texture
 
     def update_layout_data_display(self):
-        if self.layout_data:
-            elements = self.layout_data['elements']
-            relationships = self.layout_data['relationships']
-            
-            display_text = "Layout Analysis Results:\n\n"
-            display_text += "Elements:\n"
-            for i, elem in enumerate(elements):
-                display_text += f"{i}: {elem.type} at {elem.bbox}\n"
-            
-            if self.relationship_checkbox.active:
-                display_text += "\nRelationships:\n"
-                for i, j, rel in relationships:
-                    display_text += f"Element {i} is {rel} Element {j}\n"
-            else:
-                display_text += "\nRelationships are hidden. Check 'Show Relationships' to view.\n"
-            
-            self.layout_data_display.content.text = display_text
-        else:
-            self.layout_data_display.content.text = "No layout data available"
+        self.layout_data_display.set_layout(self.layout_data, self.relationship_checkbox.active)
+
+    def on_preview_touch(self, instance, touch):
+        # Clicking an element box selects it in the overlay and in the results list
+        if not self.image_preview.collide_point(*touch.pos) or not self.layout_data:
+            return False
+        index = self.overlay.element_at(*touch.pos)
+        if index is None:
+            return False
+        self.overlay.select(index)
+        self.layout_data_display.select(index)
+        return True
 
 
 class PDFAnalyzerApp(App):
     def build(self):
-        return PDFAnalyzerGUI()
+        self.gui = PDFAnalyzerGUI()
+        return self.gui
+
+    def on_stop(self):
+        self.gui.scheduler.shutdown()
+        self.gui.prefetcher.shutdown()
 
 if __name__ == '__main__':
     PDFAnalyzerApp().run()
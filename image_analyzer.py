@@ -1,45 +1,238 @@
 import cv2
 import numpy as np
-from dataclasses import dataclass
-from typing import List, Tuple
-import time
 
-@dataclass
-class LayoutElement:
-    type: str
-    bbox: Tuple[int, int, int, int]  # x, y, width, height
+import instrumentation
+from element_table import ELEMENT_TYPES, RELATIONSHIP_TYPES, ElementTable, LayoutElement, RelationshipTable
+from xy_cut import xy_cut
+
+# Bump whenever a change alters analysis results, so persisted layouts are not reused
+ANALYZER_VERSION = 2
+# Elements whose top (or left) edges are closer than this many pixels are aligned
+ALIGNMENT_TOLERANCE = 10
+# Segmentation backends of analyze_layout: dilation and contour search, or recursive XY cuts
+LAYOUT_METHODS = ('contours', 'xy_cut')
 
 def preprocess_image(image):
     """Convert image to grayscale OpenCV image and apply thresholding."""
-    print("Preprocessing image...")
-    start_time = time.time()
-    if len(image.shape) == 3:
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-    else:
-        gray = image
-    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    print(f"Preprocessing completed in {time.time() - start_time:.2f} seconds")
+    with instrumentation.span('preprocess_image'):
+        if len(image.shape) == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            gray = image
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
     return binary
 
 def detect_layout_elements(binary_image, granularity=50):
     """Detect layout elements using contour detection with adjustable granularity."""
-    print("Detecting layout elements...")
-    start_time = time.time()
-    
-    # Apply morphological operations to merge nearby elements
-    kernel_size = max(1, int(min(binary_image.shape) * granularity / 1000))
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    dilated = cv2.dilate(binary_image, kernel, iterations=1)
-    
-    contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    elements = []
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        element_type = classify_element(binary_image[y:y+h, x:x+w], w, h, granularity)
-        elements.append(LayoutElement(element_type, (x, y, w, h)))
-    print(f"Detected {len(elements)} elements in {time.time() - start_time:.2f} seconds")
+    with instrumentation.span('detect_layout_elements', granularity=granularity):
+        # Apply morphological operations to merge nearby elements
+        kernel_size = granularity_kernel_size(binary_image.shape, granularity)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+        with instrumentation.span('dilate', kernel_size=kernel_size):
+            dilated = cv2.dilate(binary_image, kernel, iterations=1)
+        elements = elements_from_mask(dilated, binary_image, granularity)
     return elements
 
+def detect_layout_elements_xy(binary_image, granularity=50, x_threshold=None, y_threshold=None):
+    """
+    Detect layout elements by recursive XY cuts on whitespace gaps.
+
+    Gaps narrower than the thresholds do not separate elements; both default
+    to the dilation kernel size of the granularity, the gap the contour method
+    bridges. Elements are tight ink boxes listed in reading order.
+
+    :return: (ElementTable, root XYNode of the reading-order tree or None for a blank page)
+    """
+    with instrumentation.span('detect_layout_elements', granularity=granularity, method='xy_cut'):
+        kernel_size = granularity_kernel_size(binary_image.shape, granularity)
+        integral = ink_integral(binary_image)
+        tree = xy_cut(binary_image, x_threshold if x_threshold is not None else kernel_size,
+                      y_threshold if y_threshold is not None else kernel_size, integral)
+        leaves = list(tree.leaves()) if tree is not None else []
+        instrumentation.count('contours', len(leaves))
+        bboxes = np.array([leaf.bbox for leaf in leaves], dtype=np.int64).reshape(-1, 4)
+        with instrumentation.span('classify_elements', count=len(bboxes)):
+            x, y, w, h = bboxes.T
+            ink = integral[y + h, x + w] - integral[y, x + w] - integral[y + h, x] + integral[y, x]
+            pixel_density = ink / (w * h)
+
+            def read_roi(x0, y0, width, height):
+                return binary_image[y0:y0+height, x0:x0+width]
+
+            codes = classify_features(bboxes, pixel_density, granularity, read_roi)
+        count_types(codes)
+    return ElementTable(bboxes, codes, pixel_density), tree
+
+def ink_integral(binary_image):
+    """Integral image counting ink pixels, in int32 while the page is small enough, else int64."""
+    mask = cv2.compare(binary_image, 0, cv2.CMP_GT) // 255
+    if binary_image.size < 2 ** 31:
+        return cv2.integral(mask, sdepth=cv2.CV_32S)
+    return cv2.integral(mask, sdepth=cv2.CV_64F).astype(np.int64)
+
+def granularity_kernel_size(shape, granularity):
+    """Side of the square dilation kernel used for a page of the given shape."""
+    return max(1, int(min(shape[:2]) * granularity / 1000))
+
+def elements_from_mask(mask, binary_image, granularity, integral=None):
+    """Turn the external contours of a dilated mask into an ElementTable of classified elements."""
+    with instrumentation.span('find_contours'):
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    instrumentation.count('contours', len(contours))
+    bboxes = contour_bboxes(contours)
+    with instrumentation.span('classify_elements', count=len(bboxes)):
+        codes, pixel_density = classify_bboxes(binary_image, bboxes, granularity, integral)
+    count_types(codes)
+    return ElementTable(bboxes, codes, pixel_density)
+
+class PageSegmenter:
+    """
+    Segments one binary page at any granularity from work done once per page.
+
+    Dilating with a k x k square marks every pixel whose Chebyshev distance to
+    the nearest ink pixel is at most (k - 1) // 2; for even k OpenCV's anchor
+    makes the kernel one pixel larger towards the top-left, which a fixed 2 x 2
+    dilation restores. The distance map and the integral image used for
+    classification are computed on construction, so segmenting at another
+    granularity costs one threshold plus the contour search.
+    """
+
+    def __init__(self, binary_image):
+        self.binary_image = binary_image
+        with instrumentation.span('segmenter_precompute', shape=list(binary_image.shape)):
+            background = cv2.compare(binary_image, 0, cv2.CMP_EQ)
+            self.distance = cv2.distanceTransform(background, cv2.DIST_C, cv2.DIST_MASK_3)
+            self.integral = cv2.integral(binary_image, sdepth=cv2.CV_64F)
+        self._elements = {}
+
+    def dilated(self, granularity):
+        """Return the mask cv2.dilate would produce for this granularity."""
+        kernel_size = granularity_kernel_size(self.binary_image.shape, granularity)
+        mask = cv2.compare(self.distance, (kernel_size - 1) // 2, cv2.CMP_LE)
+        if kernel_size % 2 == 0:
+            mask = cv2.dilate(mask, np.ones((2, 2), dtype=np.uint8))
+        return mask
+
+    def segment(self, granularity):
+        """Return the layout elements detect_layout_elements finds at this granularity."""
+        elements = self._elements.get(granularity)
+        if elements is None:
+            with instrumentation.span('segment', granularity=granularity):
+                elements = elements_from_mask(self.dilated(granularity), self.binary_image, granularity,
+                                              self.integral)
+            self._elements[granularity] = elements
+        return elements
+
+    def layout(self, granularity):
+        """Return elements and relationships, like analyze_layout, at this granularity."""
+        elements = self.segment(granularity)
+        return {
+            'elements': elements,
+            'relationships': analyze_spatial_relationships(elements)
+        }
+
+    def sweep(self, granularities, relationships=False):
+        """
+        Segment the page at every granularity, for parameter tuning.
+
+        :param granularities: Iterable of granularity values
+        :param relationships: Also analyze spatial relationships for every granularity
+        :return: Dictionary mapping each granularity to its layout
+        """
+        if relationships:
+            return {granularity: self.layout(granularity) for granularity in granularities}
+        return {granularity: {'elements': self.segment(granularity)} for granularity in granularities}
+
+def contour_bboxes(contours):
+    """Return the (x, y, width, height) bboxes of contours as an (n, 4) array."""
+    if not contours:
+        return np.zeros((0, 4), dtype=np.int64)
+    return np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int64)
+
+def classify_elements(binary_image, bboxes, granularity, integral=None):
+    """Classify many elements at once, following the same rules as classify_element."""
+    with instrumentation.span('classify_elements', count=len(bboxes)):
+        codes, _ = classify_bboxes(binary_image, bboxes, granularity, integral)
+    count_types(codes)
+    return [ELEMENT_TYPES[code] for code in codes.tolist()]
+
+def count_types(codes):
+    """Add the number of elements of every type in an array of type codes to the instrumentation counters."""
+    if instrumentation.enabled():
+        for code, total in enumerate(np.bincount(codes, minlength=len(ELEMENT_TYPES)).tolist()):
+            if total:
+                instrumentation.count(f'elements.{ELEMENT_TYPES[code]}', total)
+
+def classify_bboxes(binary_image, bboxes, granularity, integral=None):
+    """
+    Apply the classify_element rules to an (n, 4) array of bboxes with array operations.
+
+    The pixel density of every bbox is read in O(1) from an integral image of
+    the binary image (computed here unless one is passed in). Only elements
+    shaped like lines need their pixels, for the edge density check.
+    Returns (type codes indexing ELEMENT_TYPES, pixel densities).
+    """
+    bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+    if integral is None:
+        integral = cv2.integral(binary_image, sdepth=cv2.CV_64F)
+    x, y, w, h = bboxes.T
+    ink = integral[y + h, x + w] - integral[y, x + w] - integral[y + h, x] + integral[y, x]
+    pixel_density = ink / (w * h * 255)
+
+    def read_roi(x0, y0, width, height):
+        return binary_image[y0:y0+height, x0:x0+width]
+
+    return classify_features(bboxes, pixel_density, granularity, read_roi), pixel_density
+
+def classify_features(bboxes, pixel_density, granularity, read_roi):
+    """
+    Apply the classify_element rules to bboxes whose pixel densities are already known.
+
+    read_roi(x, y, width, height) must return the binary pixels of a bbox; it
+    is only called for elements shaped like lines. Returns type codes.
+    """
+    x, y, w, h = bboxes.T
+    line_candidate = line_candidates(w, h, granularity)
+    is_line = np.zeros(len(bboxes), dtype=bool)
+    for k in np.flatnonzero(line_candidate):
+        x0, y0, width, height = bboxes[k].tolist()
+        edges = cv2.Canny(read_roi(x0, y0, width, height), 50, 150)
+        is_line[k] = np.sum(edges) / (width * height * 255) < 0.2
+    return classify_shapes(w, h, pixel_density, is_line, granularity)
+
+
+def line_candidates(w, h, granularity):
+    """Return a mask of the bboxes shaped like lines, whose edges decide whether they are lines."""
+    aspect_ratio = w / h
+    line_thickness_threshold = classification_thresholds(granularity)[0]
+    return (((aspect_ratio > 10) & (h < line_thickness_threshold)) |
+            ((aspect_ratio < 0.1) & (w < line_thickness_threshold)))
+
+
+def classify_shapes(w, h, pixel_density, is_line, granularity):
+    """Apply the classify_element rules to element sizes and densities, given which elements are lines."""
+    area = w * h
+    _, min_size_threshold, area_threshold, table_size_threshold = classification_thresholds(granularity)
+
+    is_image = (pixel_density > 0.5) & (np.minimum(w, h) > min_size_threshold)
+    is_text = (0.05 < pixel_density) & (pixel_density < 0.5)
+    is_text_block = is_text & ((area > area_threshold) | (w > h * 3))
+    is_table = ((0.01 < pixel_density) & (pixel_density < 0.1) &
+                (w > table_size_threshold) & (h > table_size_threshold))
+
+    # The first matching rule wins, in the same order as classify_element
+    codes = np.select(
+        [is_line, is_image, is_text_block, is_text, is_table],
+        [ELEMENT_TYPES.index(name) for name in ('line', 'image', 'text_block', 'short_text', 'table')],
+        default=ELEMENT_TYPES.index('unknown')
+    ).astype(np.int8)
+    return codes
+
+def classification_thresholds(granularity):
+    """Return the (line thickness, minimum image size, text block area, table size) thresholds of a granularity."""
+    return (max(1, int(20 * granularity / 25)), max(20, int(20 * granularity / 50)),
+            max(1000, int(1000 * granularity / 50)), max(100, int(100 * granularity / 50)))
+
 def classify_element(roi, width, height, granularity):
     """Classify the type of layout element based on its characteristics and granularity."""
     aspect_ratio = width / height
@@ -50,15 +243,12 @@ def classify_element(roi, width, height, granularity):
     line_thickness_threshold = max(1, int(20 * granularity / 25))
     min_size_threshold = max(20, int(20 * granularity / 50))
     area_threshold = max(1000, int(1000 * granularity / 50))
-    
-    print(f"Width: {width}, Height: {height}, Aspect ratio: {aspect_ratio}, Area: {area}, Pixel density: {pixel_density}, Granularity: {granularity}, Line Thickness Threshold: {line_thickness_threshold}")
 
     # Check for potential lines based on aspect ratio and adjusted thickness
     if (aspect_ratio > 10 and height < line_thickness_threshold) or (aspect_ratio < 0.1 and width < line_thickness_threshold):
         edges = cv2.Canny(roi, 50, 150)
         edge_density = np.sum(edges) / (width * height * 255)
-        
-        print(f"edge_density: {edge_density}")
+
         if edge_density < 0.2:
             return "line"
 
@@ -84,26 +274,111 @@ def classify_element(roi, width, height, granularity):
     return "unknown"
 
 def analyze_spatial_relationships(elements):
-    """Analyze spatial relationships between layout elements."""
-    print("Analyzing spatial relationships...")
-    start_time = time.time()
-    relationships = []
-    for i, elem1 in enumerate(elements):
-        for j, elem2 in enumerate(elements[i+1:], start=i+1):
-            relationship = get_relationship(elem1, elem2)
-            if relationship:
-                relationships.append((i, j, relationship))
-    print(f"Analyzed {len(relationships)} relationships in {time.time() - start_time:.2f} seconds")
+    """
+    Analyze spatial relationships between layout elements.
+
+    Takes an ElementTable or a list of LayoutElements and returns a
+    RelationshipTable, which iterates as (i, j, relationship) tuples.
+    """
+    with instrumentation.span('analyze_spatial_relationships', elements=len(elements)):
+        if isinstance(elements, ElementTable):
+            bboxes = elements.bboxes.astype(np.int64)
+        else:
+            bboxes = np.array([element.bbox for element in elements], dtype=np.int64).reshape(-1, 4)
+        first, second, codes = find_relationships(bboxes)
+        relationships = RelationshipTable.from_pairs(first, second, codes, len(bboxes))
+    if instrumentation.enabled():
+        for code, total in enumerate(np.bincount(codes, minlength=len(RELATIONSHIP_TYPES)).tolist()):
+            if total:
+                instrumentation.count(f'relationships.{RELATIONSHIP_TYPES[code]}', total)
     return relationships
 
+def find_relationships(bboxes):
+    """
+    Find the relationship of every related pair of bboxes without testing all pairs.
+
+    Gives exactly what get_relationship() gives for every pair i < j, as
+    (first, second, code) arrays ordered by (first, second), where code indexes
+    RELATIONSHIP_TYPES. Candidate pairs come from sorted coordinates: a window
+    search per element for the alignments and a band search on the less
+    crowded axis for containment, so the cost is O(n log n + candidates).
+    """
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+    n = len(bboxes)
+    x, y, w, h = bboxes.T
+
+    # Pairs with several relationships keep the one get_relationship() tests first
+    horizontal = _pair_keys(*_aligned_pairs(y, ALIGNMENT_TOLERANCE), n)
+    vertical = _pair_keys(*_aligned_pairs(x, ALIGNMENT_TOLERANCE), n)
+    vertical = vertical[~np.isin(vertical, horizontal)]
+    outer, inner = _containment_pairs(x, y, w, h)
+    contains = outer < inner
+    containment = np.where(contains, outer * n + inner, inner * n + outer)
+    keep = ~np.isin(containment, horizontal) & ~np.isin(containment, vertical)
+    containment, contains = containment[keep], contains[keep]
+
+    keys = np.concatenate([horizontal, vertical, containment])
+    codes = np.concatenate([
+        np.full(len(horizontal), 0, dtype=np.int8),
+        np.full(len(vertical), 1, dtype=np.int8),
+        np.where(contains, 2, 3).astype(np.int8)
+    ])
+    order = np.argsort(keys, kind='stable')
+    keys, codes = keys[order], codes[order]
+    return keys // max(n, 1), keys % max(n, 1), codes
+
+def _pair_keys(a, b, n):
+    """Encode unordered index pairs as unique int64 keys with the smaller index first."""
+    return np.minimum(a, b) * n + np.maximum(a, b)
+
+def _expand_ranges(starts, stops):
+    """Return (owner, position) for every position of the ranges [starts[k], stops[k])."""
+    counts = np.maximum(stops - starts, 0)
+    owners = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, starts[owners] + offsets
+
+def _aligned_pairs(coords, tolerance):
+    """Return index pairs whose coordinates differ by less than tolerance."""
+    order = np.argsort(coords, kind='stable')
+    sorted_coords = coords[order]
+    starts = np.arange(1, len(coords) + 1)
+    stops = np.searchsorted(sorted_coords, sorted_coords + tolerance, side='left')
+    owners, positions = _expand_ranges(starts, stops)
+    return order[owners], order[positions]
+
+def _containment_pairs(x, y, w, h):
+    """Return (outer, inner) pairs where the top-left corner of inner lies strictly inside outer."""
+    x_order = np.argsort(x, kind='stable')
+    y_order = np.argsort(y, kind='stable')
+    sorted_x, sorted_y = x[x_order], y[y_order]
+    x_starts = np.searchsorted(sorted_x, x, side='right')
+    x_stops = np.searchsorted(sorted_x, x + w, side='left')
+    y_starts = np.searchsorted(sorted_y, y, side='right')
+    y_stops = np.searchsorted(sorted_y, y + h, side='left')
+
+    # Scan the band of whichever axis holds fewer candidates, then test the other axis
+    use_x = (x_stops - x_starts) <= (y_stops - y_starts)
+    outer_x, positions = _expand_ranges(x_starts[use_x], x_stops[use_x])
+    outer_x = np.flatnonzero(use_x)[outer_x]
+    inner_x = x_order[positions]
+    outer_y, positions = _expand_ranges(y_starts[~use_x], y_stops[~use_x])
+    outer_y = np.flatnonzero(~use_x)[outer_y]
+    inner_y = y_order[positions]
+
+    inside_y = (y[outer_x] < y[inner_x]) & (y[inner_x] < y[outer_x] + h[outer_x])
+    inside_x = (x[outer_y] < x[inner_y]) & (x[inner_y] < x[outer_y] + w[outer_y])
+    return (np.concatenate([outer_x[inside_y], outer_y[inside_x]]),
+            np.concatenate([inner_x[inside_y], inner_y[inside_x]]))
+
 def get_relationship(elem1, elem2):
     """Determine the spatial relationship between two elements."""
     x1, y1, w1, h1 = elem1.bbox
     x2, y2, w2, h2 = elem2.bbox
     
-    if abs(y1 - y2) < 10:
+    if abs(y1 - y2) < ALIGNMENT_TOLERANCE:
         return "horizontally_aligned"
-    elif abs(x1 - x2) < 10:
+    elif abs(x1 - x2) < ALIGNMENT_TOLERANCE:
         return "vertically_aligned"
     elif x1 < x2 < x1 + w1 and y1 < y2 < y1 + h1:
         return "contains"
@@ -112,15 +387,36 @@ def get_relationship(elem1, elem2):
     else:
         return None
 
-def analyze_layout(image, granularity=50):
-    """Analyze the layout of the given image with adjustable granularity."""
-    print("Starting layout analysis...")
-    start_time = time.time()
-    binary_image = preprocess_image(image)
-    elements = detect_layout_elements(binary_image, granularity)
-    relationships = analyze_spatial_relationships(elements)
-    print(f"Layout analysis completed in {time.time() - start_time:.2f} seconds")
-    return {
+def analyze_layout(image, granularity=50, method=None, x_threshold=None, y_threshold=None):
+    """
+    Analyze the layout of the given image with adjustable granularity.
+
+    :param image: Page image (RGB or grayscale numpy array)
+    :param granularity: Layout granularity (1-100)
+    :param method: 'contours' or 'xy_cut'; 'xy_cut' when a threshold is given, 'contours' otherwise
+    :param x_threshold: Minimum blank column gap in pixels between XY-cut columns ('xy_cut' only)
+    :param y_threshold: Minimum blank row gap in pixels between XY-cut rows ('xy_cut' only)
+    :return: Dictionary of elements and relationships, plus the XY-cut reading-order tree for 'xy_cut'
+    """
+    if method is None:
+        method = 'xy_cut' if x_threshold is not None or y_threshold is not None else 'contours'
+    if method not in LAYOUT_METHODS:
+        raise ValueError(f"Invalid method {method!r}. Expected one of {list(LAYOUT_METHODS)}.")
+    if method == 'contours' and (x_threshold is not None or y_threshold is not None):
+        raise ValueError("x_threshold and y_threshold only apply to method 'xy_cut'")
+    tree = None
+    with instrumentation.span('analyze_layout', granularity=granularity, shape=list(image.shape), method=method):
+        binary_image = preprocess_image(image)
+        if method == 'xy_cut':
+            elements, tree = detect_layout_elements_xy(binary_image, granularity, x_threshold, y_threshold)
+        else:
+            elements = detect_layout_elements(binary_image, granularity)
+        relationships = analyze_spatial_relationships(elements)
+    instrumentation.sample_memory('analyze_layout')
+    layout = {
         'elements': elements,
         'relationships': relationships
-    }
\ No newline at end of file
+    }
+    if method == 'xy_cut':
+        layout['reading_order'] = tree
+    return layout
\ No newline at end of file
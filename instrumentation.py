@@ -0,0 +1,198 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class NullSink:
+    """Sink that drops every record. Instrumentation is disabled while it is installed."""
+    enabled = False
+
+    def emit(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySink:
+    """Sink that keeps every record in a list, for tests and interactive profiling."""
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def spans(self, name=None):
+        return [r for r in self.records if r['kind'] == 'span' and (name is None or r['name'] == name)]
+
+    def counters(self):
+        """Return the totals of every counter, keyed by counter name."""
+        totals = {}
+        for record in self.records:
+            if record['kind'] == 'counter':
+                totals[record['name']] = totals.get(record['name'], 0) + record['value']
+        return totals
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink:
+    """
+    Sink that appends one JSON object per record to a file.
+
+    The file is opened in append mode and every record is written with a
+    single write call, so worker processes can share one trace file.
+    """
+    enabled = True
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_sink = NullSink()
+_current_path = contextvars.ContextVar('instrumentation_span_path', default=())
+
+
+def set_sink(sink):
+    """
+    Install the sink that receives all records and return the previous one.
+
+    :param sink: NullSink, MemorySink, JSONLinesSink or any object with emit(record) and an enabled flag
+    :return: The previously installed sink
+    """
+    global _sink
+    previous = _sink
+    _sink = sink if sink is not None else NullSink()
+    return previous
+
+
+def get_sink():
+    return _sink
+
+
+def enabled():
+    """Whether records are currently collected; check it before computing expensive attributes."""
+    return _sink.enabled
+
+
+def peak_memory():
+    """Return the peak resident set size of this process in bytes, or None where unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Span:
+    """Times a block of code and emits it, nested under the enclosing span."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self._token = _current_path.set(_current_path.get() + (self.name,))
+        self._wall_start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        path = _current_path.get()
+        _current_path.reset(self._token)
+        record = {
+            'kind': 'span',
+            'name': self.name,
+            'path': '/'.join(path),
+            'depth': len(path) - 1,
+            'start': self._wall_start,
+            'duration': duration,
+            'pid': os.getpid(),
+            'peak_rss': peak_memory()
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.attributes)
+        _sink.emit(record)
+        return False
+
+    def set(self, **attributes):
+        """Attach attributes that are only known once the span is running."""
+        self.attributes.update(attributes)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attributes):
+    """
+    Context manager timing a stage. Returns a shared no-op span when disabled.
+
+    :param name: Stage name, e.g. 'detect_layout_elements'
+    :param attributes: Extra fields stored with the record (page number, granularity, ...)
+    """
+    if not _sink.enabled:
+        return _NULL_SPAN
+    return Span(name, attributes)
+
+
+def count(name, value=1, **attributes):
+    """
+    Emit a counter increment.
+
+    :param name: Counter name, e.g. 'contours' or 'elements.text_block'
+    :param value: Amount to add
+    """
+    if not _sink.enabled:
+        return
+    record = {'kind': 'counter', 'name': name, 'value': value, 'path': '/'.join(_current_path.get()),
+              'pid': os.getpid()}
+    record.update(attributes)
+    _sink.emit(record)
+
+
+def sample_memory(label, **attributes):
+    """Emit the current peak resident set size of the process."""
+    if not _sink.enabled:
+        return
+    record = {'kind': 'memory', 'name': label, 'peak_rss': peak_memory(), 'path': '/'.join(_current_path.get()),
+              'pid': os.getpid(), 'time': time.time()}
+    record.update(attributes)
+    _sink.emit(record)
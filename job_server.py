@@ -0,0 +1,666 @@
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+import instrumentation
+from pdf_processor import get_total_pages
+from document_analyzer import analyze_pdf_page, layout_to_dict, resolve_pages
+from image_analyzer import LAYOUT_METHODS
+from layout_cache import LayoutCache
+from vector_analyzer import ANALYSIS_MODES
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Jobs waiting for a runner; submissions beyond this are rejected with a retry hint
+DEFAULT_QUEUE_SIZE = 32
+# Finished jobs whose results can still be fetched
+MAX_FINISHED_JOBS = 256
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+# Latency samples kept per stage for the metrics percentiles
+LATENCY_SAMPLES = 1000
+LATENCY_PERCENTILES = (50, 90, 99)
+# Stages reported by /metrics: queue wait and whole job per job, the rest per page
+STAGES = ('queue_wait', 'render', 'analyze', 'page', 'job')
+ANALYSIS_PARAMETERS = {'zoom': float, 'granularity': int, 'mode': str, 'method': str}
+
+# Per-process state of the pool workers
+_worker_cache = None
+
+
+def _init_service_worker(cache_config=None, trace_path=None):
+    """Prepare a pool worker: one OpenCV thread, and the shared layout cache given its directory and size."""
+    global _worker_cache
+    if trace_path:
+        instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path))
+    cv2.setNumThreads(1)
+    _worker_cache = LayoutCache(*cache_config) if cache_config else None
+
+
+def _warm_up():
+    """Run in every worker at startup, so the first job does not pay for process creation."""
+    return os.getpid()
+
+
+def _analyze_job_page(pdf_path, page_number, zoom, granularity, mode, method):
+    """Analyze one page in a pool worker and return it as JSON-serializable types."""
+    return layout_to_dict(analyze_pdf_page(pdf_path, page_number, zoom, granularity, _worker_cache, mode, method))
+
+
+class QueueFull(Exception):
+    """Raised when the job queue is full; retry_after is the suggested wait in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry in {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class Job:
+    """One analysis request: its parameters, its progress and the page results received so far."""
+
+    def __init__(self, job_id, pdf_path, pages, params, upload=False):
+        self.id = job_id
+        self.pdf_path = pdf_path
+        self.pages = pages
+        self.params = params
+        self.upload = upload
+        self.status = 'queued'
+        self.error = None
+        self.results = []
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def summary(self):
+        with self.condition:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'pages': len(self.pages),
+                'pages_done': len(self.results),
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'error': self.error
+            }
+
+    def add_result(self, record):
+        with self.condition:
+            self.results.append(record)
+            self.condition.notify_all()
+
+    def finish(self, status, error=None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            self.finished = time.time()
+            self.condition.notify_all()
+
+    def iter_results(self, timeout=None):
+        """Yield page results as they arrive until the job is finished."""
+        index = 0
+        while True:
+            with self.condition:
+                while index == len(self.results) and not self.done:
+                    if not self.condition.wait(timeout):
+                        return
+                records = self.results[index:]
+                finished = self.done
+            index += len(records)
+            yield from records
+            if finished and index == len(self.results):
+                return
+
+
+class LatencyStats:
+    """Recent latency samples per stage, summarized as percentiles."""
+
+    def __init__(self, stages=STAGES, samples=LATENCY_SAMPLES):
+        self._samples = {stage: deque(maxlen=samples) for stage in stages}
+        self._counts = dict.fromkeys(stages, 0)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples[stage].append(seconds)
+            self._counts[stage] += 1
+
+    def mean(self, stage):
+        with self._lock:
+            samples = self._samples[stage]
+            return sum(samples) / len(samples) if samples else None
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: np.asarray(values, dtype=np.float64) for stage, values in self._samples.items()}
+            counts = dict(self._counts)
+        summary = {}
+        for stage, values in samples.items():
+            stage_summary = {'count': counts[stage], 'mean': float(values.mean()) if len(values) else None}
+            for percentile in LATENCY_PERCENTILES:
+                stage_summary[f'p{percentile}'] = float(np.percentile(values, percentile)) if len(values) else None
+            summary[stage] = stage_summary
+        return summary
+
+
+class JobService:
+    """
+    Queue of analysis jobs run on a pre-warmed process pool.
+
+    Jobs wait in a bounded queue; submit() raises QueueFull with a retry hint
+    once it is full instead of letting the backlog grow. max_jobs runner
+    threads take jobs from the queue and spread each job's pages over the
+    shared process pool, at most `lookahead` pages of a job at a time, so
+    several jobs make progress together. Pool workers keep the documents they
+    have seen open, and publish page results as each page finishes.
+    """
+
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, max_jobs=None, lookahead=None, cache=None,
+                 upload_dir=None, trace_path=None):
+        """
+        :param workers: Number of worker processes, os.cpu_count() if None
+        :param queue_size: Maximum number of queued jobs
+        :param max_jobs: Maximum number of jobs running at once, the number of workers if None
+        :param lookahead: Maximum number of pages of one job in flight, twice the number of workers if None
+        :param cache: Optional LayoutCache shared by all workers
+        :param upload_dir: Directory for uploaded PDFs, a temporary directory if None
+        :param trace_path: Optional JSON-lines file receiving the stage timings of every worker
+        """
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_jobs = max(1, max_jobs or self.workers)
+        self.lookahead = max(1, lookahead or self.workers * 2)
+        self.queue_size = queue_size
+        self.latency = LatencyStats()
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        # Unbounded so that shutdown never blocks on it; submit() enforces queue_size under the lock
+        self._queue = queue.Queue()
+        self._closing = False
+        self._jobs = OrderedDict()
+        self._running = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._temp_dir = None
+        if upload_dir is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix='pdf_jobs_')
+            upload_dir = self._temp_dir.name
+        self.upload_dir = upload_dir
+        os.makedirs(upload_dir, exist_ok=True)
+        cache_config = (cache.directory, cache.max_bytes) if cache is not None else None
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_service_worker,
+                                             initargs=(cache_config, trace_path))
+        # Start every worker process now, with fitz and cv2 already imported
+        for future in [self._executor.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+        self._runners = [threading.Thread(target=self._run, daemon=True) for _ in range(self.max_jobs)]
+        for runner in self._runners:
+            runner.start()
+
+    def submit(self, pdf_path=None, data=None, pages=None, zoom=1, granularity=50, mode='raster', method='contours'):
+        """
+        Queue a job for a PDF file on this machine or for uploaded PDF bytes.
+
+        :param pdf_path: Path to the PDF file; ignored when data is given
+        :param data: Bytes of an uploaded PDF, stored in upload_dir until the job is dropped
+        :param pages: Iterable of page numbers to analyze (0-indexed), all pages if None
+        :param zoom: number by which to multiply the matrix
+        :param granularity: Granularity passed to analyze_layout
+        :param mode: 'raster', 'vector' or 'auto'
+        :param method: 'contours' or 'xy_cut'
+        :return: The queued Job
+        """
+        if mode not in ANALYSIS_MODES:
+            raise ValueError(f"Invalid mode {mode!r}. Expected one of {list(ANALYSIS_MODES)}.")
+        if method not in LAYOUT_METHODS:
+            raise ValueError(f"Invalid method {method!r}. Expected one of {list(LAYOUT_METHODS)}.")
+        if mode == 'vector' and method != 'contours':
+            raise ValueError(f"Method {method!r} segments rendered pages and cannot be combined with mode 'vector'")
+        job_id = f'{next(self._ids):06d}'
+        if data is not None:
+            pdf_path = os.path.join(self.upload_dir, f'{job_id}.pdf')
+            with open(pdf_path, 'wb') as f:
+                f.write(data)
+        elif pdf_path is None or not os.path.isfile(pdf_path):
+            raise ValueError(f"PDF file not found: {pdf_path}")
+        try:
+            pages = resolve_pages(pages, get_total_pages(pdf_path))
+            job = Job(job_id, os.path.abspath(pdf_path), pages,
+                      {'zoom': zoom, 'granularity': granularity, 'mode': mode, 'method': method},
+                      upload=data is not None)
+            with self._lock:
+                if self._closing:
+                    raise RuntimeError("The job service is shutting down")
+                if self._queue.qsize() >= self.queue_size:
+                    raise queue.Full
+                self._queue.put_nowait(job)
+                self._jobs[job_id] = job
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            instrumentation.count('job_server.rejected')
+            self._discard_upload(pdf_path, data is not None)
+            raise QueueFull(self.retry_after())
+        except Exception:
+            self._discard_upload(pdf_path, data is not None)
+            raise
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Stop a job: queued jobs never start, running ones stop submitting pages."""
+        job = self.get(job_id)
+        if job is not None:
+            job.cancelled = True
+        return job
+
+    def retry_after(self):
+        """Seconds after which a rejected client should try again: the time to drain the queue once."""
+        mean_job = self.latency.mean('job') or 1.0
+        return max(1, math.ceil(mean_job * self._queue.qsize() / self.max_jobs))
+
+    def metrics(self):
+        with self._lock:
+            in_flight = [job.id for job in self._running]
+            finished = sum(1 for job in self._jobs.values() if job.done)
+            metrics = {
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self.queue_size,
+                'in_flight_jobs': len(in_flight),
+                'running': in_flight,
+                'max_jobs': self.max_jobs,
+                'workers': self.workers,
+                'completed_jobs': self.completed,
+                'failed_jobs': self.failed,
+                'cancelled_jobs': self.cancelled,
+                'rejected_jobs': self.rejected,
+                'retained_jobs': finished
+            }
+        metrics['retry_after'] = self.retry_after()
+        metrics['latency'] = self.latency.summary()
+        return metrics
+
+    def shutdown(self):
+        """Cancel the queued jobs, stop the runners once the running jobs have finished, then the worker processes."""
+        with self._lock:
+            self._closing = True
+            queued = []
+            while True:
+                try:
+                    queued.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+        for job in queued:
+            if job is not None:
+                self._cancel_queued(job)
+        for _ in self._runners:
+            self._queue.put_nowait(None)
+        for runner in self._runners:
+            runner.join()
+        self._executor.shutdown()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._running.add(job)
+            try:
+                self._run_job(job)
+            finally:
+                self._discard_upload(job.pdf_path, job.upload)
+                with self._lock:
+                    self._running.discard(job)
+                    self._forget_finished()
+
+    def _cancel_queued(self, job):
+        """Finish a job that never started as cancelled."""
+        job.cancelled = True
+        with self._lock:
+            self.cancelled += 1
+        job.finish('cancelled')
+        self._discard_upload(job.pdf_path, job.upload)
+
+    def _run_job(self, job):
+        if job.cancelled:
+            with self._lock:
+                self.cancelled += 1
+            job.finish('cancelled')
+            return
+        with job.condition:
+            job.started = time.time()
+            job.status = 'running'
+        self.latency.add('queue_wait', job.started - job.submitted)
+        remaining = iter(job.pages)
+        in_flight = set()
+        params = job.params
+        try:
+            with instrumentation.span('job', job_id=job.id, pages=len(job.pages)):
+                while True:
+                    while not job.cancelled and len(in_flight) < self.lookahead:
+                        page_number = next(remaining, None)
+                        if page_number is None:
+                            break
+                        in_flight.add(self._executor.submit(_analyze_job_page, job.pdf_path, page_number,
+                                                            params['zoom'], params['granularity'], params['mode'],
+                                                            params['method']))
+                    if not in_flight:
+                        break
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record = future.result()
+                        for stage in ('render', 'analyze'):
+                            self.latency.add(stage, record['timings'][stage])
+                        self.latency.add('page', record['timings']['total'])
+                        job.add_result(record)
+        except Exception as e:
+            for future in in_flight:
+                future.cancel()
+            with self._lock:
+                self.failed += 1
+            job.finish('failed', f'{type(e).__name__}: {e}')
+        else:
+            if job.cancelled:
+                with self._lock:
+                    self.cancelled += 1
+                job.finish('cancelled')
+            else:
+                # Only complete jobs count towards the job latency, which sets retry_after
+                self.latency.add('job', time.time() - job.started)
+                with self._lock:
+                    self.completed += 1
+                job.finish('done')
+
+    def _forget_finished(self):
+        """Drop the oldest finished jobs beyond MAX_FINISHED_JOBS; the caller holds the lock."""
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _discard_upload(pdf_path, upload):
+        if upload:
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a JobService.
+
+    POST /jobs                 queue a job: a JSON body with pdf_path, or a PDF body
+                               (Content-Type: application/pdf); parameters as JSON
+                               fields or query parameters (pages, zoom, granularity, mode, method)
+    GET /jobs/<id>             job status
+    GET /jobs/<id>/results     page results as JSON lines, streamed as pages finish
+    DELETE /jobs/<id>          cancel a job
+    GET /metrics               queue depth, in-flight jobs and per-stage latency
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'PDFLayoutJobs/1.0'
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/jobs':
+            return self._send_json(404, {'error': 'Not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPLOAD_BYTES:
+            return self._send_json(413, {'error': f'Uploads are limited to {MAX_UPLOAD_BYTES} bytes'})
+        body = self.rfile.read(length)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        data = None
+        try:
+            if self.headers.get_content_type() == 'application/pdf':
+                data = body
+            else:
+                params.update(json.loads(body or b'{}'))
+            job = self.service.submit(params.get('pdf_path'), data, _parse_pages(params.get('pages')),
+                                      **{name: convert(params[name]) for name, convert in ANALYSIS_PARAMETERS.items()
+                                         if name in params})
+        except QueueFull as e:
+            return self._send_json(503, {'error': str(e), 'retry_after': e.retry_after},
+                                   {'Retry-After': str(e.retry_after)})
+        except (ValueError, TypeError, RuntimeError) as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send_json(202, job.summary(), {'Location': f'/jobs/{job.id}'})
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts == ['metrics']:
+            return self._send_json(200, self.service.metrics())
+        if parts == ['health']:
+            return self._send_json(200, {'status': 'ok'})
+        job = self._job(parts)
+        if job is None:
+            return self._send_json(404, {'error': 'Not found'})
+        if len(parts) == 2:
+            return self._send_json(200, job.summary())
+        self._stream_results(job)
+
+    def do_DELETE(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        job = self._job(parts) if len(parts) == 2 else None
+        if job is None:
+            return self._send_json(404, {'error': 'Not found'})
+        self.service.cancel(job.id)
+        self._send_json(202, job.summary())
+
+    def _job(self, parts):
+        if parts[0] != 'jobs' or len(parts) not in (2, 3) or (len(parts) == 3 and parts[2] != 'results'):
+            return None
+        return self.service.get(parts[1])
+
+    def _stream_results(self, job):
+        """Send every page result as one JSON line, then the final job status, with chunked encoding."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for record in job.iter_results():
+                self._write_chunk(json.dumps(record).encode() + b'\n')
+            self._write_chunk(json.dumps(job.summary()).encode() + b'\n')
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _parse_pages(pages):
+    """Accept a list of 0-indexed page numbers or a comma-separated string of them."""
+    if pages is None or isinstance(pages, list):
+        return pages
+    return [int(page) for page in str(pages).split(',') if page.strip()]
+
+
+class JobHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, quiet=False):
+        self.service = service
+        self.quiet = quiet
+        super().__init__(address, JobRequestHandler)
+
+
+class UnixJobHTTPServer(JobHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, quiet=False):
+    """
+    Create the HTTP server of a JobService on a local port or a Unix socket.
+
+    Call serve_forever() on the result (in a thread for tests) and shutdown() to stop it.
+    """
+    if socket_path:
+        return UnixJobHTTPServer(socket_path, service, quiet)
+    return JobHTTPServer((host, port), service, quiet)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class JobClient:
+    """Client of a job server on this machine, over TCP or a Unix socket."""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def submit(self, pdf_path=None, data=None, pages=None, **params):
+        """
+        Queue a job for a PDF path the server can read, or upload PDF bytes.
+
+        :param params: zoom, granularity, mode, method
+        :return: Job status dictionary with its job_id
+        :raises QueueFull: when the server queue is full
+        """
+        if pages is not None:
+            params['pages'] = list(pages)
+        if data is not None:
+            query = '&'.join(f'{key}={",".join(map(str, value)) if key == "pages" else value}'
+                             for key, value in params.items())
+            return self._request('POST', '/jobs' + (f'?{query}' if query else ''), data,
+                                 {'Content-Type': 'application/pdf'})
+        params['pdf_path'] = os.path.abspath(pdf_path)
+        return self._request('POST', '/jobs', json.dumps(params).encode(), {'Content-Type': 'application/json'})
+
+    def status(self, job_id):
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id):
+        return self._request('DELETE', f'/jobs/{job_id}')
+
+    def metrics(self):
+        return self._request('GET', '/metrics')
+
+    def results(self, job_id):
+        """Yield page results as the server finishes them; the last item is the final job status."""
+        connection = self._connection()
+        try:
+            connection.request('GET', f'/jobs/{job_id}/results')
+            response = connection.getresponse()
+            if response.status != 200:
+                raise ValueError(json.loads(response.read()).get('error'))
+            for line in response:
+                yield json.loads(line)
+        finally:
+            connection.close()
+
+    def _connection(self):
+        if self.socket_path:
+            return _UnixHTTPConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method, path, body=None, headers=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            payload = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status == 503:
+            raise QueueFull(payload['retry_after'])
+        if response.status >= 400:
+            raise ValueError(payload.get('error'))
+        return payload
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve layout analysis jobs over HTTP on this machine.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument('--socket', help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes. Default: one per core")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="Queued jobs accepted before submissions are rejected")
+    parser.add_argument('--max-jobs', type=int, default=None,
+                        help="Jobs running at once. Default: the number of workers")
+    parser.add_argument('--trace', help="Append per-stage timings of every worker to this JSON-lines file")
+    parser.add_argument('--cache', metavar='DIR', help="Share a layout cache in this directory between workers")
+    parser.add_argument('--quiet', action='store_true', help="Do not log requests")
+    args = parser.parse_args()
+    job_service = JobService(args.workers, args.queue_size, args.max_jobs,
+                             cache=LayoutCache(args.cache) if args.cache else None, trace_path=args.trace)
+    server = serve(job_service, args.host, args.port, args.socket, args.quiet)
+    print(f"Serving {job_service.workers} worker(s) on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        job_service.shutdown()
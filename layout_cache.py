@@ -0,0 +1,268 @@
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+from pdf_processor import document_lock, open_document
+from image_analyzer import ANALYZER_VERSION, ElementTable, RelationshipTable
+from xy_cut import HORIZONTAL, VERTICAL, XYNode
+
+# Default location and size of the layout cache shared by the GUI and the CLI
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pdf_layout_analyzer')
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+# Eviction trims the cache to this fraction of its budget, so it does not run on every write
+EVICTION_TARGET = 0.9
+
+# Header of a cache entry: magic, format version, element count, relationship count, reading-order node count
+_HEADER = struct.Struct('<4sBIII')
+_MAGIC = b'PLAC'
+_FORMAT_VERSION = 3
+# Codes of the XY-cut node directions in cache entries; 0 is a leaf
+_DIRECTIONS = (None, HORIZONTAL, VERTICAL)
+# Bytes per element (type, density, bbox), relationship (pair, kind) and node (bbox, direction, children, element)
+_ELEMENT_BYTES = 1 + 4 + 16
+_RELATIONSHIP_BYTES = 8 + 1
+_NODE_BYTES = 16 + 1 + 4 + 4
+_SUFFIX = '.layout'
+
+
+def page_key(doc, page_number, **params):
+    """
+    Return the cache key of a page analyzed with the given parameters.
+
+    The key hashes what determines the rendered page: its size and rotation,
+    its content streams, and the streams of the images and form XObjects it
+    uses, together with the fonts it references. It does not depend on the
+    file name or on where the page sits in the file, so an unchanged page
+    keeps its key when the document is edited elsewhere or saved again.
+    Callers holding a shared document must hold pdf_processor.document_lock().
+
+    :param doc: Open fitz.Document
+    :param page_number: Page number (0-indexed)
+    :param params: Analysis parameters (zoom, granularity, ...); every value changes the key
+    :return: Hex digest
+    """
+    page = doc.load_page(page_number)
+    digest = hashlib.sha256()
+    digest.update(f'{ANALYZER_VERSION}|{tuple(page.rect)}|{page.rotation}'.encode())
+    digest.update(repr(sorted(params.items())).encode())
+    digest.update(page.read_contents())
+    for xref, *_ in page.get_images(full=True):
+        digest.update(doc.xref_object(xref, compressed=True).encode())
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    for xref, *_ in page.get_xobjects():
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    for _, extension, font_type, base_font, name, encoding, *_ in page.get_fonts(full=True):
+        digest.update(f'{extension}|{font_type}|{base_font}|{name}|{encoding}'.encode())
+    return digest.hexdigest()
+
+
+def pdf_page_key(pdf_path, page_number, **params):
+    """Return page_key() for a page of a PDF file, using the shared open document."""
+    with document_lock():
+        # Opened under the lock, so another thread cannot evict and close it before it is used
+        doc, _ = open_document(pdf_path)
+        return page_key(doc, page_number, **params)
+
+
+def encode_layout(layout):
+    """Serialize the elements (with their densities), relationships and XY-cut reading order of a layout."""
+    elements = ElementTable.from_elements(layout['elements'])
+    relationships = RelationshipTable.from_tuples(layout['relationships'], len(elements))
+    pairs = np.stack([relationships.sources(), relationships.indices], axis=1).astype(np.int32)
+    nodes = _encode_tree(layout.get('reading_order'))
+    body = b''.join(array.tobytes() for array in (elements.types, elements.density, elements.bboxes, pairs,
+                                                  relationships.kinds) + nodes)
+    header = _HEADER.pack(_MAGIC, _FORMAT_VERSION, len(elements), len(relationships), len(nodes[0]))
+    return header + zlib.compress(body, 1)
+
+
+def decode_layout(data):
+    """Rebuild a layout from encode_layout() bytes. Raises ValueError on a damaged entry."""
+    magic, version, element_count, relationship_count, node_count = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _FORMAT_VERSION:
+        raise ValueError("Not a layout cache entry")
+    try:
+        body = zlib.decompress(data[_HEADER.size:])
+    except zlib.error as e:
+        raise ValueError(f"Damaged layout cache entry: {e}")
+    if len(body) != element_count * _ELEMENT_BYTES + relationship_count * _RELATIONSHIP_BYTES + \
+            node_count * _NODE_BYTES:
+        raise ValueError("Truncated layout cache entry")
+    offset = 0
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array
+
+    types = take(np.int8, element_count)
+    density = take(np.float32, element_count)
+    bboxes = take(np.int32, element_count * 4).reshape(-1, 4)
+    pairs = take(np.int32, relationship_count * 2).reshape(-1, 2)
+    kinds = take(np.int8, relationship_count)
+    layout = {
+        'elements': ElementTable(bboxes, types, density),
+        'relationships': RelationshipTable.from_pairs(pairs[:, 0], pairs[:, 1], kinds, element_count)
+    }
+    if node_count:
+        layout['reading_order'] = _decode_tree(take(np.int32, node_count * 4).reshape(-1, 4),
+                                               take(np.int8, node_count), take(np.int32, node_count),
+                                               take(np.int32, node_count))
+    return layout
+
+
+def _encode_tree(root):
+    """Flatten an XY-cut tree in preorder into bbox, direction code, child count and element arrays."""
+    bboxes, directions, children, elements = [], [], [], []
+    stack = [root] if root is not None else []
+    while stack:
+        node = stack.pop()
+        bboxes.append(node.bbox)
+        directions.append(_DIRECTIONS.index(node.direction) if node.children else 0)
+        children.append(len(node.children))
+        elements.append(-1 if node.element is None else node.element)
+        stack.extend(reversed(node.children))
+    return (np.array(bboxes, dtype=np.int32).reshape(-1, 4), np.array(directions, dtype=np.int8),
+            np.array(children, dtype=np.int32), np.array(elements, dtype=np.int32))
+
+
+def _decode_tree(bboxes, directions, children, elements):
+    """Rebuild the XY-cut tree _encode_tree() flattened."""
+    root = None
+    parents = []  # [node, children still to attach]
+    for bbox, direction, child_count, element in zip(bboxes.tolist(), directions.tolist(), children.tolist(),
+                                                     elements.tolist()):
+        node = XYNode(tuple(bbox), _DIRECTIONS[direction], [], None if element < 0 else element)
+        if parents:
+            parents[-1][0].children.append(node)
+            parents[-1][1] -= 1
+            if not parents[-1][1]:
+                parents.pop()
+        else:
+            root = node
+        if child_count:
+            parents.append([node, child_count])
+    if parents:
+        raise ValueError("Truncated reading order in layout cache entry")
+    return root
+
+
+class LayoutCache:
+    """
+    Persistent cache of page layouts, one file per key, bounded by total size.
+
+    Entries are written to a temporary file in the cache directory and moved
+    into place with os.replace, so readers never see a partial entry and any
+    number of processes can share the directory. Reading an entry refreshes
+    its modification time, and eviction removes the least recently used files
+    once the directory outgrows max_bytes.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        :param directory: Cache directory, created if missing
+        :param max_bytes: Maximum total size of the cache files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + _SUFFIX)
+
+    def get(self, key):
+        """Return the cached layout for a key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                layout = decode_layout(f.read())
+            os.utime(path)
+        except FileNotFoundError:
+            layout = None
+        except (OSError, ValueError, struct.error):
+            layout = None
+            self._remove(path)
+        with self._lock:
+            if layout is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return layout
+
+    def put(self, key, layout):
+        """Store a layout under a key, replacing any previous entry atomically."""
+        data = encode_layout(layout)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            self._remove(temp_path)
+            raise
+        with self._lock:
+            self._size += len(data)
+            evict = self._size > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below its budget."""
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        target = self.max_bytes * EVICTION_TARGET
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            if self._remove(path):
+                size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def clear(self):
+        for _, path, _ in self._entries():
+            self._remove(path)
+        with self._lock:
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _entries(self):
+        """Yield (mtime, path, size) of every entry; files removed meanwhile by other processes are skipped."""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(_SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, path, stat.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
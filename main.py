@@ -1,23 +1,255 @@
-from pdf_processor import load_pdf, get_pdf_info
-from image_analyzer import preprocess_image, analyze_layout
+import argparse
+import sys
+import time
 
-def main(pdf_path):
+from pdf_processor import get_pdf_info, get_total_pages, load_pdf
+from document_analyzer import analyze_document, iter_page_layouts, write_layouts_jsonl
+from image_analyzer import ELEMENT_TYPES, LAYOUT_METHODS, PageSegmenter, preprocess_image
+from tiled_analyzer import analyze_page_tiled
+from pyramid_analyzer import compare_with_full
+from render_pipeline import analyze_document_pipelined, iter_pipelined_layouts
+from template_analyzer import analyze_document_templated, iter_templated_layouts
+from vector_analyzer import ANALYSIS_MODES
+from layout_cache import DEFAULT_CACHE_BYTES, DEFAULT_CACHE_DIR, LayoutCache
+
+
+def parse_pages(spec):
+    """Parse a 1-indexed page spec such as "1-10,15" into 0-indexed page numbers."""
+    if not spec:
+        return None
+    pages = []
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-', 1)
+            pages.extend(range(int(start) - 1, int(end)))
+        elif part:
+            pages.append(int(part) - 1)
+    return pages
+
+
+def main(pdf_path, pages=None, zoom=1, granularity=50, workers=None, trace_path=None, cache=None, mode='raster',
+         method='contours', coarse_scale=None):
     # Load PDF
     pdf_info = get_pdf_info(pdf_path)
     print(f"PDF Info: {pdf_info}")
 
-    # Convert first page to image
-    image = load_pdf(pdf_path)
+    # Analyze every requested page
+    result = analyze_document(pdf_path, pages=pages, zoom=zoom, granularity=granularity, workers=workers,
+                              trace_path=trace_path, cache=cache, mode=mode, method=method, coarse_scale=coarse_scale)
+    for layout in result['pages']:
+        print(f"Page {layout['page_number'] + 1}: {len(layout['elements'])} elements, "
+              f"{len(layout['relationships'])} relationships ({layout['elapsed']:.2f} seconds"
+              f"{', cached' if layout['cached'] else ', ' + layout['source']})")
+    print(f"Throughput: {result['pages_per_second']:.2f} pages/second with {result['workers']} worker(s)")
+    return result
+
+
+def stream(pdf_path, output, pages=None, zoom=1, granularity=50, workers=None, trace_path=None, cache=None,
+           mode='raster', method='contours', coarse_scale=None):
+    """Write one JSON line per page to output as pages finish, without keeping results in memory."""
+    start_time = time.time()
+    layouts = iter_page_layouts(pdf_path, pages=pages, zoom=zoom, granularity=granularity, workers=workers,
+                                trace_path=trace_path, cache=cache, mode=mode, method=method,
+                                coarse_scale=coarse_scale)
+    _report_written(write_layouts_jsonl(layouts, output), time.time() - start_time, output)
+
+
+def _report_written(written, elapsed, output):
+    # With output on stdout the summary would end up in the JSON-lines stream
+    print(f"Wrote {written} pages in {elapsed:.2f} seconds ({written / max(elapsed, 1e-9):.2f} pages/second)",
+          file=sys.stderr if output == '-' else sys.stdout)
+
+
+def pipelined(pdf_path, pages=None, zoom=1, granularity=50, render_workers=None, analyze_workers=None,
+              trace_path=None, method='contours', output=None):
+    """
+    Analyze pages with separate render and analysis pools and report how busy each stage was.
+
+    With an output, one JSON line per page is written to it instead of the per-page summary.
+    """
+    if output:
+        start_time = time.time()
+        stages = {}
+        layouts = iter_pipelined_layouts(pdf_path, pages, zoom, granularity, render_workers, analyze_workers,
+                                         method=method, trace_path=trace_path, stats=stages)
+        _report_written(write_layouts_jsonl(layouts, output), time.time() - start_time, output)
+        _report_stages(stages, sys.stderr if output == '-' else sys.stdout)
+        return None
+    result = analyze_document_pipelined(pdf_path, pages, zoom, granularity, render_workers, analyze_workers,
+                                        method=method, trace_path=trace_path)
+    for layout in result['pages']:
+        print(f"Page {layout['page_number'] + 1}: {len(layout['elements'])} elements, "
+              f"{len(layout['relationships'])} relationships ({layout['timings']['render']:.2f} s render, "
+              f"{layout['timings']['analyze']:.2f} s analyze)")
+    print(f"Throughput: {result['pages_per_second']:.2f} pages/second")
+    _report_stages(result['stages'], sys.stdout)
+    return result
+
+
+def _report_stages(stages, file):
+    for name in ('render', 'analyze'):
+        stage = stages[name]
+        print(f"  {name:<8} {stage['workers']} worker(s), {stage['busy']:.2f} s busy, {stage['idle']:.2f} s idle "
+              f"({stage['utilization']:.0%} utilization)", file=file)
+    print(f"  {stages['slots']} slots of {stages['slot_bytes'] / (1024 * 1024):.1f} MB, "
+          f"rendering held back for {stages['slot_wait']:.2f} s", file=file)
+
+
+def templated(pdf_path, pages=None, zoom=1, granularity=50, workers=None, sample_pages=4, trace_path=None,
+              output=None):
+    """
+    Find the template repeated on the first pages and segment only what later pages add to it.
+
+    With an output, one JSON line per page is written to it instead, with every element marked as
+    template or not.
+    """
+    if output:
+        start_time = time.time()
+        layouts = iter_templated_layouts(pdf_path, pages, zoom, granularity, workers, sample_pages,
+                                         trace_path=trace_path)
+        _report_written(write_layouts_jsonl(layouts, output), time.time() - start_time, output)
+        return None
+    result = analyze_document_templated(pdf_path, pages, zoom, granularity, workers, sample_pages,
+                                        trace_path=trace_path)
+    template = result['template']
+    print(f"Template: {template['elements']} elements found on the first {template['sampled_pages']} pages, "
+          f"reused {template['reused_elements']} times on {template['pages_reusing']} later pages")
+    for layout in result['pages']:
+        print(f"Page {layout['page_number'] + 1}: {len(layout['elements'])} elements "
+              f"({int(layout['template'].sum())} from the template), {len(layout['relationships'])} relationships "
+              f"({layout['timings']['analyze'] * 1000:.1f} ms analysis)")
+    print(f"Throughput: {result['pages_per_second']:.2f} pages/second")
+    return result
+
+
+def sweep(pdf_path, pages=None, zoom=1, granularities=range(5, 101, 5)):
+    """Print element counts per type at every granularity, segmenting each page once."""
+    pages = pages if pages is not None else range(get_total_pages(pdf_path))
+    for page_number in pages:
+        image, _ = load_pdf(pdf_path, page_number, zoom, 'gray')
+        layouts = PageSegmenter(preprocess_image(image)).sweep(granularities)
+        print(f"Page {page_number + 1}:")
+        print("  granularity  elements  " + "  ".join(ELEMENT_TYPES))
+        for granularity, layout in layouts.items():
+            type_counts = layout['elements'].type_counts()
+            counts = "  ".join(f"{type_counts[name]:>{len(name)}}" for name in ELEMENT_TYPES)
+            print(f"  {granularity:>11}  {len(layout['elements']):>8}  {counts}")
+
+
+def tiled(pdf_path, pages=None, zoom=1, granularity=50, workers=None, max_memory_mb=512, output=None):
+    """
+    Analyze pages one at a time in tiles, for pages too large to render whole.
+
+    With an output, one JSON line per page is written to it instead of the per-page summary.
+    """
+    start_time = time.time()
+    layouts = _iter_tiled_layouts(pdf_path, pages, zoom, granularity, workers, max_memory_mb)
+    if output:
+        _report_written(write_layouts_jsonl(layouts, output), time.time() - start_time, output)
+        return
+    for layout in layouts:
+        print(f"Page {layout['page_number'] + 1}: {len(layout['elements'])} elements, "
+              f"{len(layout['relationships'])} relationships ({layout['elapsed']:.2f} seconds)")
+
+
+def _iter_tiled_layouts(pdf_path, pages, zoom, granularity, workers, max_memory_mb):
+    pages = pages if pages is not None else range(get_total_pages(pdf_path))
+    for page_number in pages:
+        start_time = time.perf_counter()
+        layout = analyze_page_tiled(pdf_path, page_number, zoom, granularity, workers=workers,
+                                    max_memory=max_memory_mb * 1024 * 1024)
+        elapsed = time.perf_counter() - start_time
+        layout.update(page_number=page_number, elapsed=elapsed, timings={'total': elapsed})
+        yield layout
 
-    # Preprocess image
-    cv_image = preprocess_image(image)
 
-    # Analyze layout
-    layout = analyze_layout(cv_image, x_threshold=200, y_threshold=200)
-    print(f"Layout analysis: {layout}")
+def compare_pyramid(pdf_path, pages=None, zoom=1, granularity=50, coarse_scale=0.25):
+    """Compare coarse-to-fine analysis with full-resolution analysis page by page."""
+    pages = pages if pages is not None else range(get_total_pages(pdf_path))
+    print("  page  full ms  pyramid ms  speedup  recall  precision  refined")
+    for page_number in pages:
+        report = compare_with_full(pdf_path, page_number, zoom, granularity, coarse_scale)
+        print(f"  {page_number + 1:>4}  {report['full_time'] * 1000:>7.1f}  {report['pyramid_time'] * 1000:>10.1f}"
+              f"  {report['speedup']:>6.2f}x  {report['recall']:>6.2f}  {report['precision']:>9.2f}"
+              f"  {report['refined_fraction']:>6.0%}")
 
-    # Here you would add more processing steps as needed
 
 if __name__ == "__main__":
-    pdf_path = "test_pdfs/sample.pdf"  # Replace with your test PDF
-    main(pdf_path)
+    parser = argparse.ArgumentParser(description="Analyze the layout of a PDF without the GUI.")
+    parser.add_argument('pdf_path', nargs='?', default="test_pdfs/sample.pdf", help="PDF file to analyze")
+    parser.add_argument('--pages', help="Pages to analyze (1-indexed), e.g. '1-10,15'. Default: all pages")
+    parser.add_argument('--zoom', type=float, default=1, help="Render zoom factor")
+    parser.add_argument('--granularity', type=int, default=50, help="Layout granularity (1-100)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes. Default: one per core")
+    parser.add_argument('--mode', choices=ANALYSIS_MODES, default='raster',
+                        help="Render every page, build layouts from the PDF objects, or decide per page (digital pages "
+                             "from the objects, scanned ones rendered)")
+    parser.add_argument('--method', choices=LAYOUT_METHODS, default='contours',
+                        help="Segment rendered pages by dilation and contours, or by recursive XY cuts on whitespace "
+                             "gaps (faster on text-heavy pages, elements in reading order)")
+    parser.add_argument('--render-workers', type=int, metavar='N',
+                        help="Render in N processes and analyze in --workers others, passing pages through shared "
+                             "memory, and report the busy and idle time of both stages")
+    parser.add_argument('--templates', type=int, nargs='?', const=4, metavar='SAMPLE_PAGES',
+                        help="Find the elements repeated on the first SAMPLE_PAGES pages (letterheads, footers, form "
+                             "skeletons) and segment only the rest of later pages. Default: 4")
+    parser.add_argument('--trace', help="Append per-stage timings, counters and memory samples to this JSON-lines file")
+    parser.add_argument('--output', help="Stream one JSON line per page to this file ('-' for stdout)")
+    parser.add_argument('--tiled', type=int, metavar='MAX_MB',
+                        help="Analyze each page in tiles within this memory ceiling (for huge pages or high zoom)")
+    parser.add_argument('--pyramid', type=float, metavar='SCALE',
+                        help="Analyze coarse-to-fine: segment a render at this fraction of the zoom and refine only "
+                             "the ambiguous regions at full resolution")
+    parser.add_argument('--compare', action='store_true',
+                        help="Instead of analyzing, report the speed and accuracy of --pyramid against "
+                             "full-resolution analysis page by page")
+    parser.add_argument('--sweep', metavar='START:STOP:STEP',
+                        help="Instead of analyzing, report element counts over a range of granularities, e.g. 5:100:5")
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_DIR, metavar='DIR',
+                        help=f"Reuse layouts from earlier runs stored in this directory. Default: {DEFAULT_CACHE_DIR}")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024), metavar='MB',
+                        help="Maximum size of the layout cache")
+    args = parser.parse_args()
+    if args.mode == 'vector' and args.method != 'contours':
+        parser.error("--method xy_cut segments rendered pages and cannot be combined with --mode vector")
+    # Each of these runs its own kind of analysis, so only one of them can be given
+    exclusive = [flag for flag, value in (('--sweep', args.sweep), ('--pyramid', args.pyramid),
+                                          ('--render-workers', args.render_workers), ('--templates', args.templates),
+                                          ('--tiled', args.tiled)) if value]
+    if len(exclusive) > 1:
+        parser.error(f"{' and '.join(exclusive)} cannot be combined")
+    if args.pyramid and (args.mode != 'raster' or args.method != 'contours'):
+        parser.error("--pyramid segments rendered pages with contours and cannot be combined with --mode or --method")
+    if args.compare and not args.pyramid:
+        parser.error("--compare reports on --pyramid analysis and requires it")
+    if args.compare and (args.cache or args.output):
+        parser.error("--compare reports instead of analyzing and cannot be combined with --cache or --output")
+    if args.tiled and (args.cache or args.trace or args.mode != 'raster' or args.method != 'contours'):
+        parser.error("--tiled segments rendered tiles with contours and cannot be combined with --cache, --trace, "
+                     "--mode or --method")
+    if args.render_workers and (args.cache or args.mode != 'raster'):
+        parser.error("--render-workers renders every page and cannot be combined with --cache or --mode")
+    if args.templates and (args.cache or args.mode != 'raster' or args.method != 'contours'):
+        parser.error("--templates segments with contours only and cannot be combined with --cache, --mode or --method")
+    cache = LayoutCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None
+    if args.sweep:
+        start, stop, step = (int(value) for value in args.sweep.split(':'))
+        sweep(args.pdf_path, parse_pages(args.pages), args.zoom, range(start, stop + 1, step))
+    elif args.compare:
+        compare_pyramid(args.pdf_path, parse_pages(args.pages), args.zoom, args.granularity, args.pyramid)
+    elif args.render_workers:
+        pipelined(args.pdf_path, parse_pages(args.pages), args.zoom, args.granularity, args.render_workers,
+                  args.workers, args.trace, args.method, args.output)
+    elif args.templates:
+        templated(args.pdf_path, parse_pages(args.pages), args.zoom, args.granularity, args.workers, args.templates,
+                  args.trace, args.output)
+    elif args.tiled:
+        tiled(args.pdf_path, parse_pages(args.pages), args.zoom, args.granularity, args.workers, args.tiled,
+              args.output)
+    elif args.output:
+        stream(args.pdf_path, args.output, parse_pages(args.pages), args.zoom, args.granularity, args.workers,
+               args.trace, cache, args.mode, args.method, args.pyramid)
+    else:
+        main(args.pdf_path, parse_pages(args.pages), args.zoom, args.granularity, args.workers, args.trace, cache,
+             args.mode, args.method, args.pyramid)
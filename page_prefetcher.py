@@ -0,0 +1,139 @@
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import instrumentation
+from pdf_processor import configure_page_cache
+from layout_cache import pdf_page_key
+from stage_graph import StageGraph
+
+class PagePrefetcher:
+    """
+    Renders, and optionally analyzes, the pages around the current one in the background.
+
+    Rendered pages land in pdf_processor.page_cache, whose byte budget bounds
+    their memory; layouts are kept in a small LRU of their own. Work runs on a
+    few daemon threads fed from a priority queue, nearest pages first, and work
+    queued for a page the user has already left is dropped. The current page
+    itself is rendered and analyzed by the GUI's scheduler.
+    """
+
+    def __init__(self, depth=2, max_layouts=32, workers=2, cache_bytes=None, layout_cache=None, stages=None):
+        """
+        :param depth: Number of pages to prefetch on each side of the current page
+        :param max_layouts: Maximum number of analyzed layouts to keep
+        :param workers: Number of background threads
+        :param cache_bytes: Memory budget of the rendered page cache, unchanged if None
+        :param layout_cache: Optional LayoutCache consulted before analyzing a page and filled afterwards
+        :param stages: StageGraph holding the intermediate images of the pages, a private one if None
+        """
+        self.depth = depth
+        self.max_layouts = max_layouts
+        self.layout_cache = layout_cache
+        self.stages = stages if stages is not None else StageGraph()
+        if cache_bytes is not None:
+            configure_page_cache(cache_bytes)
+        self._layouts = OrderedDict()
+        self._pending = {}  # key -> Future of queued or running work
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._generation = 0
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def get_layout(self, pdf_path, page_number, zoom, granularity):
+        """Return the finished layout of a page, or None if it has not been analyzed."""
+        key = (pdf_path, page_number, zoom, granularity)
+        with self._lock:
+            layout = self._layouts.get(key)
+            if layout is not None:
+                self._layouts.move_to_end(key)
+            return layout
+
+    def prefetch_around(self, pdf_path, page_number, total_pages, zoom, granularity=None):
+        """
+        Queue the neighbouring pages of the current page, nearest first.
+
+        Speculative work still queued for an earlier current page is dropped.
+
+        :param page_number: Current page (0-indexed)
+        :param total_pages: Number of pages in the document
+        :param granularity: Also analyze the neighbours at this granularity if not None
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        for distance in range(1, self.depth + 1):
+            for neighbour in (page_number + distance, page_number - distance):
+                if 0 <= neighbour < total_pages:
+                    self._submit(distance, (pdf_path, neighbour, zoom, granularity), generation)
+
+    def shutdown(self):
+        """Stop the background threads once the work already started has finished."""
+        for _ in self._threads:
+            self._queue.put((float('inf'), next(self._sequence), None, None, None))
+
+    def _submit(self, priority, key, generation):
+        with self._lock:
+            if key[3] is not None and key in self._layouts:
+                return
+            if key in self._pending:
+                return  # Already queued, possibly with a higher priority
+            future = self._pending[key] = Future()
+        self._queue.put((priority, next(self._sequence), generation, key, future))
+
+    def _run(self):
+        while True:
+            priority, _, generation, key, future = self._queue.get()
+            if future is None:
+                return
+            if future.done():
+                continue
+            with self._lock:
+                if generation < self._generation:
+                    # Speculative work for a page the user has moved away from
+                    self._finish(key, future)
+                    future.cancel()
+                    continue
+                if not future.set_running_or_notify_cancel():
+                    self._finish(key, future)
+                    continue
+            try:
+                result = self._process(key)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._lock:
+                    self._finish(key, future)
+
+    def _finish(self, key, future):
+        """Forget finished work; the caller holds the lock."""
+        if self._pending.get(key) is future:
+            del self._pending[key]
+
+    def _process(self, key):
+        pdf_path, page_number, zoom, granularity = key
+        with instrumentation.span('prefetch', page_number=page_number):
+            stages = self.stages.page(pdf_path, page_number)
+            stages.get('render', zoom)  # The display render, kept in the page cache
+            if granularity is None:
+                return None
+            layout = cache_key = None
+            if self.layout_cache is not None:
+                cache_key = pdf_page_key(pdf_path, page_number, zoom=zoom, granularity=granularity)
+                layout = self.layout_cache.get(cache_key)
+            if layout is None:
+                layout = stages.layout(zoom, granularity)
+                if self.layout_cache is not None:
+                    self.layout_cache.put(cache_key, layout)
+        with self._lock:
+            self._layouts[key] = layout
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+        return layout
@@ -1,34 +1,191 @@
+import os
+import threading
+from collections import OrderedDict
+
 import fitz  # PyMuPDF
 import numpy as np
 
-def load_pdf(pdf_path, page_number=0, zoom=1):
+# Maximum number of documents kept open by open_document()
+MAX_OPEN_DOCUMENTS = 8
+# Default memory budget of the rendered page cache
+DEFAULT_PAGE_CACHE_BYTES = 256 * 1024 * 1024
+# Colorspaces render_page() can produce
+RENDER_COLORSPACES = {'rgb': fitz.csRGB, 'gray': fitz.csGRAY}
+
+# PyMuPDF documents must not be used from several threads at once, so every
+# access to a cached document goes through this lock.
+_document_lock = threading.RLock()
+_open_documents = OrderedDict()  # path -> (mtime, fitz.Document)
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages bounded by the number of bytes it holds.
+
+    Keys are (path, mtime, page_number, zoom, colorspace) tuples. Cached arrays
+    are read-only because they are shared between all callers.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_PAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            array = self._entries.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return array
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return  # Would evict everything else and still not fit
+        array.flags.writeable = False
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[key] = array
+            self.current_bytes += array.nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, array = self._entries.popitem(last=False)
+            self.current_bytes -= array.nbytes
+
+
+page_cache = PageCache()
+
+
+def configure_page_cache(max_bytes):
+    """
+    Set the memory budget of the rendered page cache.
+    
+    :param max_bytes: Maximum number of bytes of rendered pages to keep (0 disables caching)
+    """
+    page_cache.resize(max_bytes)
+
+
+def open_document(pdf_path):
+    """
+    Return a cached open document for a PDF file.
+    
+    Documents are keyed by absolute path and modification time, so a file
+    that changed on disk is opened again. Callers must hold document_lock()
+    while they use the returned document.
+    
+    :param pdf_path: Path to the PDF file
+    :return: Tuple of (fitz.Document, modification time)
+    """
+    path = os.path.abspath(pdf_path)
+    mtime = os.path.getmtime(path)
+    with _document_lock:
+        cached = _open_documents.pop(path, None)
+        if cached is not None and cached[0] != mtime:
+            cached[1].close()
+            cached = None
+        if cached is None:
+            cached = (mtime, fitz.open(path))
+        _open_documents[path] = cached
+        while len(_open_documents) > MAX_OPEN_DOCUMENTS:
+            _, (_, stale_doc) = _open_documents.popitem(last=False)
+            stale_doc.close()
+        return cached[1], mtime
+
+
+def document_lock():
+    """Lock that serializes access to the documents returned by open_document()."""
+    return _document_lock
+
+
+def close_documents():
+    """Close every cached document and drop all cached pages."""
+    with _document_lock:
+        while _open_documents:
+            _, (_, doc) = _open_documents.popitem()
+            doc.close()
+    page_cache.clear()
+
+
+def load_pdf(pdf_path, page_number=0, zoom=1, colorspace='rgb'):
     """
     Load a specific page from a PDF file and return it as a numpy array.
     
+    The document is kept open between calls and rendered pages are served
+    from page_cache when possible. The returned array is read-only.
+    
     :param pdf_path: Path to the PDF file
     :param page_number: Page number to load (0-indexed)
     :param zoom: number by which to multiply the matrix
+    :param colorspace: 'rgb' for display or 'gray' for analysis
     :return: Tuple of (image as numpy array, total number of pages)
     """
-    doc = fitz.open(pdf_path)
-    total_pages = len(doc)
+    with _document_lock:
+        doc, mtime = open_document(pdf_path)
+        total_pages = len(doc)
+        
+        if page_number < 0 or page_number >= total_pages:
+            raise ValueError(f"Invalid page number. The document has {total_pages} pages.")
+        
+        key = (os.path.abspath(pdf_path), mtime, page_number, zoom, colorspace)
+        img_array = page_cache.get(key)
+        if img_array is None:
+            img_array = render_page(doc.load_page(page_number), zoom, colorspace)
+            page_cache.put(key, img_array)
+    
+    return img_array, total_pages
+
+def render_page(page, zoom=1, colorspace='rgb'):
+    """
+    Render an already loaded PyMuPDF page to a numpy array.
     
-    if page_number < 0 or page_number >= total_pages:
-        raise ValueError(f"Invalid page number. The document has {total_pages} pages.")
+    The pixmap is rendered without alpha directly in the requested colorspace,
+    so the array wraps the pixmap samples as they are: contiguous and without
+    any further conversion copy. Use 'gray' for analysis and 'rgb' for display.
     
-    page = doc.load_page(page_number)
+    :param page: fitz.Page to render
+    :param zoom: number by which to multiply the matrix
+    :param colorspace: 'rgb' for an (h, w, 3) array or 'gray' for an (h, w) array
+    :return: Image as numpy array
+    """
+    if colorspace not in RENDER_COLORSPACES:
+        raise ValueError(f"Invalid colorspace {colorspace!r}. Expected one of {sorted(RENDER_COLORSPACES)}.")
     mat = fitz.Matrix(zoom, zoom)  # use zoom value 
-    pix = page.get_pixmap(matrix=mat)
+    pix = page.get_pixmap(matrix=mat, colorspace=RENDER_COLORSPACES[colorspace], alpha=False)
     
     # Convert pixmap to numpy array
-    img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
-    
-    # If the image is RGBA, convert it to RGB
-    if img_array.shape[2] == 4:
-        img_array = img_array[:, :, :3]
-    
-    doc.close()
-    return img_array, total_pages
+    img_array = np.frombuffer(pix.samples, dtype=np.uint8)
+    if pix.n == 1:
+        return img_array.reshape(pix.h, pix.w)
+    return img_array.reshape(pix.h, pix.w, pix.n)
 
 def get_total_pages(pdf_path):
     """
@@ -37,7 +194,19 @@ def get_total_pages(pdf_path):
     :param pdf_path: Path to the PDF file
     :return: Total number of pages
     """
-    doc = fitz.open(pdf_path)
-    total_pages = len(doc)
-    doc.close()
-    return total_pages
\ No newline at end of file
+    with _document_lock:
+        doc, _ = open_document(pdf_path)
+        return len(doc)
+
+def get_pdf_info(pdf_path):
+    """
+    Get basic information about a PDF file.
+    
+    :param pdf_path: Path to the PDF file
+    :return: Dictionary with the page count and the document metadata
+    """
+    with _document_lock:
+        doc, _ = open_document(pdf_path)
+        info = {'total_pages': len(doc)}
+        info.update(doc.metadata or {})
+    return info
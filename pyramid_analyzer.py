@@ -0,0 +1,380 @@
+import itertools
+import time
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import instrumentation
+from pdf_processor import document_lock, open_document, render_page
+from image_analyzer import (ElementTable, PageSegmenter, analyze_layout, analyze_spatial_relationships,
+                            classify_bboxes, classify_features, classify_shapes, contour_bboxes,
+                            granularity_kernel_size, line_candidates)
+from tiled_analyzer import otsu_threshold
+
+# Default zoom of the coarse pass relative to the requested zoom
+DEFAULT_COARSE_SCALE = 0.25
+# Elements thinner than this many coarse pixels are refined
+SMALL_ELEMENT_PIXELS = 6
+# The full-resolution ink density of an element lies within these factors of the ink coverage of its coarse
+# box, which slightly understates it because Otsu thresholding counts partly covered edge pixels as ink
+DENSITY_FACTORS = (0.85, 1.35)
+# Element edges found on the coarse render are known to within this many coarse pixels
+EDGE_PIXELS = 2
+# Side of the coarse grid cells used to find densely packed areas, and the element count that makes a cell dense
+DENSE_CELL_PIXELS = 32
+DENSE_CELL_ELEMENTS = 6
+# Above this fraction of the page in refined regions, analyzing the whole page at full resolution is cheaper
+MAX_REFINED_FRACTION = 0.6
+# Gray level below which a coarse pixel takes part in segmentation
+FAINT_INK_LEVEL = 250
+
+
+def analyze_page_pyramid(pdf_path, page_number=0, zoom=1, granularity=50, coarse_scale=DEFAULT_COARSE_SCALE):
+    """
+    Analyze a page of a PDF file with pyramid_layout.
+
+    :param pdf_path: Path to the PDF file
+    :param page_number: Page number to analyze (0-indexed)
+    :return: Layout dictionary with elements, relationships and a 'pyramid' summary of the refinement
+    """
+    with document_lock():
+        doc, _ = open_document(pdf_path)
+        if page_number < 0 or page_number >= len(doc):
+            raise ValueError(f"Invalid page number. The document has {len(doc)} pages.")
+        page = doc.load_page(page_number)
+    return pyramid_layout(page, zoom, granularity, coarse_scale)
+
+
+def pyramid_layout(page, zoom=1, granularity=50, coarse_scale=DEFAULT_COARSE_SCALE):
+    """
+    Analyze a PDF page on a downscaled render and refine only the ambiguous regions at full resolution.
+
+    The page is rendered at zoom * coarse_scale, segmented and classified
+    there, and every element is mapped to page pixels at `zoom`. Elements that
+    are small, close to a classification threshold or in a densely packed area
+    are grouped into regions that are rendered again at full zoom through clip
+    rectangles and segmented with the full-resolution kernel and the page's
+    Otsu threshold. Their elements replace the coarse ones.
+
+    :param page: fitz.Page to analyze
+    :param zoom: number by which to multiply the matrix; all coordinates are pixels at this zoom
+    :param granularity: Granularity, as for analyze_layout
+    :param coarse_scale: Zoom of the coarse pass relative to zoom, in (0, 1]
+    :return: Layout dictionary with elements, relationships and a 'pyramid' summary of the refinement
+    """
+    if not 0 < coarse_scale <= 1:
+        raise ValueError(f"coarse_scale must be in (0, 1], got {coarse_scale}")
+    start_time = time.perf_counter()
+    matrix = fitz.Matrix(zoom, zoom)
+    with document_lock():
+        display_list = page.get_displaylist()
+        page_pixels = (page.rect * matrix).round()
+        width, height = page_pixels.width, page_pixels.height
+
+    with instrumentation.span('analyze_page_pyramid', granularity=granularity, zoom=zoom, coarse_scale=coarse_scale):
+        with instrumentation.span('coarse'):
+            with document_lock():
+                gray = render_page(display_list, zoom * coarse_scale, 'gray')
+            threshold, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+            # Downscaling turns thin strokes light gray, so segment on every pixel darker than paper
+            _, faint = cv2.threshold(gray, FAINT_INK_LEVEL, 255, cv2.THRESH_BINARY_INV)
+            segmenter = PageSegmenter(cv2.max(binary, faint))
+            mask = segmenter.dilated(granularity)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            coarse_bboxes = contour_bboxes(contours)
+            # Anti-aliasing keeps the ink of every stroke as the darkness of the pixels it covers, so the
+            # mean darkness of a box estimates the full-resolution ink density far better than the
+            # coarse Otsu binary, which widens or drops thin strokes
+            _, density = classify_bboxes(255 - gray, coarse_bboxes, granularity)
+            coarse = ElementTable(coarse_bboxes, np.zeros(len(coarse_bboxes), dtype=np.int8), density)
+        scale_x, scale_y = width / gray.shape[1], height / gray.shape[0]
+        bboxes = _to_page_pixels(coarse.bboxes, scale_x, scale_y, width, height)
+
+        def read_coarse_roi(x0, y0, roi_width, roi_height):
+            cx0, cy0 = int(x0 / scale_x), int(y0 / scale_y)
+            cx1 = max(cx0 + 1, int(np.ceil((x0 + roi_width) / scale_x)))
+            cy1 = max(cy0 + 1, int(np.ceil((y0 + roi_height) / scale_y)))
+            return cv2.resize(binary[cy0:cy1, cx0:cx1], (roi_width, roi_height), interpolation=cv2.INTER_NEAREST)
+
+        # Classify with page-pixel sizes so the thresholds mean the same as at full resolution
+        codes = classify_features(bboxes.astype(np.int64), coarse.density.astype(np.float64), granularity,
+                                  read_coarse_roi)
+        ambiguous = ambiguous_elements(coarse, bboxes, coarse.density, granularity) | \
+            unstable_elements(segmenter, coarse, granularity, PageSegmenter(binary))
+        kernel_size = granularity_kernel_size((height, width), granularity)
+        regions = refinement_regions(bboxes, ambiguous, kernel_size, width, height)
+        refined_area = int(sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions))
+        refined_fraction = refined_area / max(width * height, 1)
+
+        if refined_fraction > MAX_REFINED_FRACTION:
+            # Refining most of the page costs more than analyzing it once at full resolution
+            with document_lock():
+                full = render_page(display_list, zoom, 'gray')
+            layout = analyze_layout(full, granularity)
+            elements, regions = layout['elements'], [(0, 0, width, height)]
+        else:
+            keep = np.ones(len(bboxes), dtype=bool)
+            with instrumentation.span('refine', regions=len(regions), fraction=refined_fraction):
+                clips = [_render_region(display_list, matrix, zoom, region) for region in regions]
+                # Otsu over the full-resolution clips and the coarse pixels outside them, each
+                # coarse pixel standing for the page pixels it covers: the threshold of a
+                # render at full zoom shifts away from the coarse one as anti-aliasing narrows
+                outside = np.full(gray.shape, 255, dtype=np.uint8)
+                for x0, y0, x1, y1 in regions:
+                    outside[int(y0 / scale_y):int(np.ceil(y1 / scale_y)),
+                            int(x0 / scale_x):int(np.ceil(x1 / scale_x))] = 0
+                histogram = cv2.calcHist([gray], [0], outside, [256], [0, 256]).ravel() * (scale_x * scale_y)
+                for clip in clips:
+                    histogram += np.bincount(clip.ravel(), minlength=256)
+                threshold = otsu_threshold(histogram)
+                tables = []
+                for region, clip in zip(regions, clips):
+                    keep &= ~_inside(bboxes, region)
+                    tables.append(_segment_region(clip, region, threshold, kernel_size, granularity))
+            elements = ElementTable(
+                np.concatenate([bboxes[keep]] + [table.bboxes for table in tables]),
+                np.concatenate([codes[keep]] + [table.types for table in tables]),
+                np.concatenate([coarse.density[keep]] + [table.density for table in tables])
+            )
+        relationships = analyze_spatial_relationships(elements)
+
+    return {
+        'elements': elements,
+        'relationships': relationships,
+        'pyramid': {
+            'coarse_zoom': zoom * coarse_scale,
+            'coarse_elements': len(coarse),
+            'ambiguous_elements': int(ambiguous.sum()),
+            'regions': [list(map(int, region)) for region in regions],
+            'refined_fraction': refined_fraction,
+            'full_page': refined_fraction > MAX_REFINED_FRACTION,
+            'elapsed': time.perf_counter() - start_time
+        }
+    }
+
+
+def ambiguous_elements(coarse, bboxes, density, granularity):
+    """
+    Return a mask of the coarse elements whose result could change at full resolution.
+
+    These are elements thinner than SMALL_ELEMENT_PIXELS coarse pixels,
+    elements whose type changes when their edges move by EDGE_PIXELS or their
+    density by DENSITY_FACTORS, and elements in grid cells holding at least
+    DENSE_CELL_ELEMENTS element centers. A threshold an element is near only
+    counts when it decides the element's type, so the density of a text block
+    near the table threshold does not make it ambiguous.
+
+    :param coarse: ElementTable of the coarse pass, in coarse pixels
+    :param bboxes: The same bboxes in page pixels
+    :param density: Pixel density (ink coverage) of every element
+    :param granularity: Layout granularity
+    """
+    count = len(coarse)
+    if not count:
+        return np.zeros(0, dtype=bool)
+    small = np.minimum(coarse.w, coarse.h) < SMALL_ELEMENT_PIXELS
+
+    w, h = bboxes[:, 2].astype(np.float64), bboxes[:, 3].astype(np.float64)
+    density = np.asarray(density, dtype=np.float64)
+    candidates = line_candidates(w, h, granularity)
+    # Whether a line candidate is a line depends on its edges, which the coarse pass cannot tell,
+    # so the types are compared both ways
+    line_states = (candidates, np.zeros(count, dtype=bool))
+    nominal = [classify_shapes(w, h, density, is_line, granularity) for is_line in line_states]
+    borderline = np.zeros(count, dtype=bool)
+    # Both edges of a side may move, by EDGE_PIXELS coarse pixels each
+    edge_w = 2 * EDGE_PIXELS * w / np.maximum(coarse.w, 1)
+    edge_h = 2 * EDGE_PIXELS * h / np.maximum(coarse.h, 1)
+    low, high = DENSITY_FACTORS
+    for dw, dh, fd in itertools.product((-1, 0, 1), (-1, 0, 1), (low, 1, high)):
+        pw, ph, pd = np.maximum(w + dw * edge_w, 1), np.maximum(h + dh * edge_h, 1), density * fd
+        borderline |= line_candidates(pw, ph, granularity) != candidates
+        for is_line, codes in zip(line_states, nominal):
+            borderline |= classify_shapes(pw, ph, pd, is_line, granularity) != codes
+
+    cell_x = (coarse.x + coarse.w // 2) // DENSE_CELL_PIXELS
+    cell_y = (coarse.y + coarse.h // 2) // DENSE_CELL_PIXELS
+    cells = cell_y.astype(np.int64) * (int(cell_x.max()) + 1) + cell_x
+    _, index, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    dense = counts[index] >= DENSE_CELL_ELEMENTS
+    return small | borderline | dense
+
+
+def unstable_elements(segmenter, coarse, granularity, strong=None):
+    """
+    Return a mask of the coarse elements whose segmentation depends on a single coarse pixel.
+
+    A coarse pixel covers several page pixels, so gaps between ink are only
+    known to within one coarse pixel. An element is unstable when dilating one
+    pixel less splits it, or one pixel more merges it with another element.
+    Faint anti-aliased pixels also narrow the gaps, so an element the strong
+    ink alone splits is unstable as well.
+
+    :param segmenter: PageSegmenter of the coarse binary image
+    :param coarse: Its elements at this granularity
+    :param strong: Optional PageSegmenter of the strong ink alone, a subset of the binary image
+    """
+    if not len(coarse):
+        return np.zeros(0, dtype=bool)
+    radius = (granularity_kernel_size(segmenter.binary_image.shape, granularity) - 1) // 2
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(segmenter.dilated(granularity), connectivity=8)
+    tight_count, tight = cv2.connectedComponents(cv2.compare(segmenter.distance, radius - 1, cv2.CMP_LE),
+                                                 connectivity=8)
+    loose_count, loose = cv2.connectedComponents(cv2.compare(segmenter.distance, radius + 1, cv2.CMP_LE),
+                                                 connectivity=8)
+
+    def containing(inner, inner_count, outer):
+        """Outer label of every inner component; the inner mask lies within the outer one."""
+        flat = inner.ravel()
+        first = np.zeros(inner_count, dtype=np.int64)
+        # Reversed assignment keeps the first pixel of every label
+        first[flat[::-1]] = np.arange(len(flat) - 1, -1, -1)
+        return outer.ravel()[first[1:]]
+
+    unstable = np.bincount(containing(tight, tight_count, labels), minlength=count) > 1
+    if strong is not None:
+        strong_count, strong_labels = cv2.connectedComponents(strong.dilated(granularity), connectivity=8)
+        unstable |= np.bincount(containing(strong_labels, strong_count, labels), minlength=count) > 1
+    outer = containing(labels, count, loose)
+    unstable[1:] |= np.bincount(outer, minlength=loose_count)[outer] > 1
+    # External contours and 8-connected components have the same bounding boxes
+    by_bbox = {tuple(stat[:4]): unstable[label] for label, stat in enumerate(stats.tolist()) if label}
+    return np.array([by_bbox.get(tuple(bbox), True) for bbox in coarse.bboxes.tolist()], dtype=bool)
+
+
+def refinement_regions(bboxes, ambiguous, margin, width, height):
+    """
+    Group the ambiguous elements into disjoint (x0, y0, x1, y1) regions to analyze at full resolution.
+
+    Every ambiguous bbox is grown by margin pixels, overlapping boxes are
+    merged, and each region is grown to cover the coarse elements it touches,
+    so no element is cut by a region border.
+    """
+    boxes = [(max(0, x - margin), max(0, y - margin), min(width, x + w + margin), min(height, y + h + margin))
+             for x, y, w, h in bboxes[ambiguous].tolist()]
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+    while True:
+        merged = _merge_boxes(boxes)
+        grown = []
+        for rx0, ry0, rx1, ry1 in merged:
+            touching = (x0 < rx1) & (y0 < ry1) & (x1 > rx0) & (y1 > ry0)
+            grown.append((min(rx0, int(x0[touching].min(initial=rx0))), min(ry0, int(y0[touching].min(initial=ry0))),
+                          max(rx1, int(x1[touching].max(initial=rx1))), max(ry1, int(y1[touching].max(initial=ry1)))))
+        if grown == merged:
+            return merged
+        boxes = grown
+
+
+def _merge_boxes(boxes):
+    """Merge overlapping (x0, y0, x1, y1) boxes until none overlap."""
+    boxes = sorted(boxes)
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for k, other in enumerate(result):
+                if box[0] < other[2] and box[1] < other[3] and box[2] > other[0] and box[3] > other[1]:
+                    result[k] = (min(box[0], other[0]), min(box[1], other[1]),
+                                 max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return boxes
+
+
+def _to_page_pixels(bboxes, scale_x, scale_y, width, height):
+    """Map coarse (x, y, w, h) bboxes to page pixels, rounding outwards."""
+    x0 = np.floor(bboxes[:, 0] * scale_x)
+    y0 = np.floor(bboxes[:, 1] * scale_y)
+    x1 = np.minimum(np.ceil((bboxes[:, 0] + bboxes[:, 2]) * scale_x), width)
+    y1 = np.minimum(np.ceil((bboxes[:, 1] + bboxes[:, 3]) * scale_y), height)
+    return np.stack([x0, y0, x1 - x0, y1 - y0], axis=1).astype(np.int32).reshape(-1, 4)
+
+
+def _inside(bboxes, region):
+    x0, y0, x1, y1 = region
+    return ((bboxes[:, 0] >= x0) & (bboxes[:, 1] >= y0) &
+            (bboxes[:, 0] + bboxes[:, 2] <= x1) & (bboxes[:, 1] + bboxes[:, 3] <= y1))
+
+
+def _render_region(display_list, matrix, zoom, region):
+    """Render a region of the page at full zoom as a grayscale array."""
+    x0, y0, x1, y1 = region
+    # As in tiled_analyzer: render one pixel more on every side and cut the exact rectangle out
+    clip = fitz.Rect(x0 - 1, y0 - 1, x1 + 1, y1 + 1) / zoom
+    with document_lock():
+        pix = display_list.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False, clip=clip)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w)
+    return np.ascontiguousarray(gray[y0 - pix.y:y1 - pix.y, x0 - pix.x:x1 - pix.x])
+
+
+def _segment_region(gray, region, threshold, kernel_size, granularity):
+    """Segment a full-resolution region with the page threshold and kernel; bboxes are in page pixels."""
+    x0, y0 = region[:2]
+    _, binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY_INV)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    dilated = cv2.dilate(binary, kernel, iterations=1)
+    contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    instrumentation.count('contours', len(contours))
+    bboxes = contour_bboxes(contours)
+    codes, density = classify_bboxes(binary, bboxes, granularity)
+    bboxes[:, 0] += x0
+    bboxes[:, 1] += y0
+    return ElementTable(bboxes, codes, density)
+
+
+def compare_with_full(pdf_path, page_number=0, zoom=1, granularity=50, coarse_scale=DEFAULT_COARSE_SCALE,
+                      iou_threshold=0.5):
+    """
+    Report the speed and accuracy of pyramid analysis against full-resolution analysis of a page.
+
+    An element counts as found when a pyramid element of the same type
+    overlaps it with an intersection over union of at least iou_threshold.
+
+    :return: Dictionary with both timings, the speedup, recall, precision and the refined fraction
+    """
+    start_time = time.perf_counter()
+    pyramid = analyze_page_pyramid(pdf_path, page_number, zoom, granularity, coarse_scale)
+    pyramid_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with document_lock():
+        doc, _ = open_document(pdf_path)
+        full_image = render_page(doc.load_page(page_number), zoom, 'gray')
+    full = analyze_layout(full_image, granularity)
+    full_time = time.perf_counter() - start_time
+
+    expected, found = full['elements'], pyramid['elements']
+    matches = _match_elements(expected, found, iou_threshold)
+    return {
+        'page_number': page_number,
+        'full_time': full_time,
+        'pyramid_time': pyramid_time,
+        'speedup': full_time / max(pyramid_time, 1e-9),
+        'full_elements': len(expected),
+        'pyramid_elements': len(found),
+        'recall': matches / len(expected) if len(expected) else 1.0,
+        'precision': matches / len(found) if len(found) else 1.0,
+        'refined_fraction': pyramid['pyramid']['refined_fraction']
+    }
+
+
+def _match_elements(expected, found, iou_threshold):
+    """Count the expected elements matched by a found element of the same type."""
+    if not len(expected) or not len(found):
+        return 0
+    a, b = expected.bboxes.astype(np.int64), found.bboxes.astype(np.int64)
+    ix = np.maximum(0, np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2]) -
+                    np.maximum(a[:, None, 0], b[None, :, 0]))
+    iy = np.maximum(0, np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3]) -
+                    np.maximum(a[:, None, 1], b[None, :, 1]))
+    intersection = ix * iy
+    union = (a[:, None, 2] * a[:, None, 3]) + (b[None, :, 2] * b[None, :, 3]) - intersection
+    iou = intersection / np.maximum(union, 1)
+    same_type = expected.types[:, None] == found.types[None, :]
+    return int(((iou >= iou_threshold) & same_type).any(axis=1).sum())
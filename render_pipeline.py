@@ -0,0 +1,350 @@
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import instrumentation
+from document_analyzer import resolve_pages
+from stage_graph import PageStages
+
+# Page buffers in the ring for every analysis worker, on top of one per render
+# worker: one page being analyzed and one waiting, so analysis never starves
+# while a render is in progress
+SLOTS_PER_ANALYZE_WORKER = 2
+# Pages that may finish ahead of the next page to yield, per ring slot
+LOOKAHEAD_PER_SLOT = 2
+
+# Per-process state of the stage workers. Render workers open the document
+# once; both kinds attach to every ring slot once and keep it mapped.
+_worker_doc = None
+_worker_slots = {}  # name -> SharedMemory
+
+
+class SlotRing:
+    """
+    Fixed set of shared-memory page buffers owned by the parent process.
+
+    A slot is acquired before a rendered page is copied into it and released
+    once the page has been analyzed, so the number of slots bounds the pages
+    between the two stages: when analysis falls behind, no slot is free and
+    rendering waits. Workers only attach to the slots; the parent unlinks them all on
+    close(), whatever state the workers are in.
+    """
+
+    def __init__(self, count, slot_bytes):
+        if count < 1:
+            raise ValueError("A slot ring needs at least one slot")
+        self.slot_bytes = max(1, int(slot_bytes))
+        self._slots = []
+        try:
+            for _ in range(count):
+                self._slots.append(shared_memory.SharedMemory(create=True, size=self.slot_bytes))
+        except BaseException:
+            self.close()
+            raise
+        self._free = deque(range(count))
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def free(self):
+        return len(self._free)
+
+    def name(self, slot):
+        return self._slots[slot].name
+
+    def acquire(self):
+        """Return the index of a free slot, or None if every slot is in use."""
+        return self._free.popleft() if self._free else None
+
+    def release(self, slot):
+        self._free.append(slot)
+
+    def close(self):
+        """Unmap and remove every slot."""
+        while self._slots:
+            slot = self._slots.pop()
+            slot.close()
+            try:
+                slot.unlink()
+            except FileNotFoundError:
+                pass
+        self._free = deque()
+
+
+class StageStats:
+    """Busy time and task count of one pipeline stage, summed over its workers."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.tasks = 0
+        self.busy = 0.0
+
+    def add(self, busy):
+        self.tasks += 1
+        self.busy += busy
+
+    def to_dict(self, elapsed):
+        capacity = self.workers * elapsed
+        return {
+            'workers': self.workers,
+            'tasks': self.tasks,
+            'busy': self.busy,
+            'idle': max(0.0, capacity - self.busy),
+            'utilization': self.busy / capacity if capacity > 0 else 0.0
+        }
+
+
+class PipelineStats:
+    """
+    Busy and idle time of the render and analysis stages.
+
+    Busy time is measured inside the workers, so idle time (worker count times
+    wall time, less busy time) includes process start-up and the time workers
+    wait for work. slot_wait is the wall time during which pages were left to
+    render but every slot was taken, i.e. how long analysis held back rendering.
+    """
+
+    def __init__(self, render_workers, analyze_workers, slots, slot_bytes):
+        self.render = StageStats(render_workers)
+        self.analyze = StageStats(analyze_workers)
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.slot_wait = 0.0
+        self.oversize = 0
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        return {
+            'render': self.render.to_dict(self.elapsed),
+            'analyze': self.analyze.to_dict(self.elapsed),
+            'slots': self.slots,
+            'slot_bytes': self.slot_bytes,
+            'slot_wait': self.slot_wait,
+            'oversize': self.oversize,
+            'elapsed': self.elapsed
+        }
+
+
+def _init_render_worker(pdf_path, trace_path=None):
+    global _worker_doc
+    if trace_path:
+        instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path))
+    _worker_doc = fitz.open(pdf_path)
+
+
+def _init_analyze_worker(trace_path=None):
+    if trace_path:
+        instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path))
+    # Both pools together already use every core, see _init_worker in document_analyzer
+    cv2.setNumThreads(1)
+
+
+def _attach(name):
+    """Map a ring slot into this worker, once per worker."""
+    slot = _worker_slots.get(name)
+    if slot is None:
+        try:
+            slot = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # Python < 3.13 has no track argument; the parent's resource tracker owns the slot
+            slot = shared_memory.SharedMemory(name=name)
+        _worker_slots[name] = slot
+    return slot
+
+
+def _render_to_slot(page_number, zoom, slot_name):
+    """
+    Render a page in grayscale and copy it into a ring slot.
+
+    The page is rendered into a fitz Pixmap and copied once into the slot.
+
+    :return: Tuple of (shape, busy seconds, None), or (shape, busy seconds, image)
+             for a page larger than the slot, which is then sent back by value
+    """
+    start_time = time.perf_counter()
+    with instrumentation.span('render', page_number=page_number, zoom=zoom):
+        pix = _worker_doc.load_page(page_number).get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY,
+                                                            alpha=False)
+        samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.h, pix.stride)[:, :pix.w]
+        shape = samples.shape
+        slot = _attach(slot_name)
+        if samples.size > slot.size:
+            return shape, time.perf_counter() - start_time, np.ascontiguousarray(samples)
+        np.copyto(np.ndarray(shape, dtype=np.uint8, buffer=slot.buf), samples)
+    return shape, time.perf_counter() - start_time, None
+
+
+def _analyze_slot(slot_name, shape, granularity, method):
+    """Analyze the page held by a ring slot; returns (layout, busy seconds)."""
+    start_time = time.perf_counter()
+    image = np.ndarray(shape, dtype=np.uint8, buffer=_attach(slot_name).buf)
+    layout = PageStages.from_image(image).layout(granularity=granularity, method=method)
+    del image  # The slot is reused as soon as the parent sees the result
+    return layout, time.perf_counter() - start_time
+
+
+def _analyze_image(image, granularity, method):
+    """Analyze a page that did not fit in a slot."""
+    start_time = time.perf_counter()
+    layout = PageStages.from_image(image).layout(granularity=granularity, method=method)
+    return layout, time.perf_counter() - start_time
+
+
+def _resolve_stage_workers(render_workers, analyze_workers, page_count):
+    """Split the cores between the stages: a quarter render and the rest analyze, by default."""
+    cores = os.cpu_count() or 1
+    if render_workers is None:
+        render_workers = max(1, cores // 4)
+    if analyze_workers is None:
+        analyze_workers = max(1, cores - render_workers)
+    if render_workers < 1 or analyze_workers < 1:
+        raise ValueError("Each stage needs at least one worker")
+    page_count = max(1, page_count)
+    return min(render_workers, page_count), min(analyze_workers, page_count)
+
+
+def page_buffer_bytes(doc, pages, zoom):
+    """Return the size of the largest grayscale render among the given pages."""
+    matrix = fitz.Matrix(zoom, zoom)
+    largest = 0
+    for page_number in pages:
+        rect = doc.load_page(page_number).rect * matrix
+        largest = max(largest, math.ceil(rect.width) * math.ceil(rect.height))
+    return largest
+
+
+def iter_pipelined_layouts(pdf_path, pages=None, zoom=1, granularity=50, render_workers=None, analyze_workers=None,
+                           slots=None, method='contours', trace_path=None, stats=None):
+    """
+    Render and analyze pages in two process pools connected by shared memory.
+
+    Render workers copy each rendered page once into a free slot of a SlotRing
+    and only the slot name and page shape reach the analysis workers, so the
+    page buffers are never pickled. The two pools are sized independently; when
+    every slot is in use, no further page is rendered until analysis releases
+    one. Layouts are yielded in page order. Slots are removed when the
+    generator finishes, fails (including a crashed worker) or is closed.
+
+    :param pdf_path: Path to the PDF file
+    :param pages: Iterable of page numbers to analyze (0-indexed), all pages if None
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity passed to analyze_layout
+    :param render_workers: Render processes, a quarter of the cores if None
+    :param analyze_workers: Analysis processes, the remaining cores if None
+    :param slots: Page buffers in the ring, enough to keep both stages busy if None
+    :param method: Segmentation method, 'contours' or 'xy_cut'
+    :param trace_path: Optional JSON-lines file receiving the stage timings of every worker
+    :param stats: Optional dictionary updated with PipelineStats.to_dict() as pages are yielded
+    :return: Generator of layout dictionaries (elements, relationships, page_number, timings)
+    """
+    with fitz.open(pdf_path) as doc:
+        pages = resolve_pages(pages, len(doc))
+        slot_bytes = page_buffer_bytes(doc, pages, zoom)
+    render_workers, analyze_workers = _resolve_stage_workers(render_workers, analyze_workers, len(pages))
+    slots = slots or render_workers + SLOTS_PER_ANALYZE_WORKER * analyze_workers
+    lookahead = LOOKAHEAD_PER_SLOT * slots
+    pipeline_stats = PipelineStats(render_workers, analyze_workers, slots, slot_bytes)
+
+    start_time = time.perf_counter()
+    rendering = {}  # future -> (page index, slot)
+    analyzing = {}  # future -> (page index, slot, or None for a page sent by value)
+    render_times = {}  # page index -> render seconds
+    finished = {}  # page index -> layout
+    started = yielded = 0
+    blocked_since = None
+    with SlotRing(slots, slot_bytes) as ring, \
+            ProcessPoolExecutor(max_workers=render_workers, initializer=_init_render_worker,
+                                initargs=(pdf_path, trace_path)) as renderers, \
+            ProcessPoolExecutor(max_workers=analyze_workers, initializer=_init_analyze_worker,
+                                initargs=(trace_path,)) as analyzers:
+        try:
+            while yielded < len(pages):
+                while started < len(pages) and started - yielded < lookahead:
+                    slot = ring.acquire()
+                    if slot is None:
+                        if blocked_since is None:
+                            blocked_since = time.perf_counter()
+                        break
+                    future = renderers.submit(_render_to_slot, pages[started], zoom, ring.name(slot))
+                    rendering[future] = (started, slot)
+                    started += 1
+
+                done, _ = wait(list(rendering) + list(analyzing), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in rendering:
+                        index, slot = rendering.pop(future)
+                        shape, render_times[index], image = future.result()
+                        pipeline_stats.render.add(render_times[index])
+                        if image is None:
+                            future = analyzers.submit(_analyze_slot, ring.name(slot), shape, granularity, method)
+                        else:
+                            pipeline_stats.oversize += 1
+                            instrumentation.count('render_pipeline.oversize')
+                            ring.release(slot)
+                            slot = None
+                            future = analyzers.submit(_analyze_image, image, granularity, method)
+                        analyzing[future] = (index, slot)
+                    else:
+                        index, slot = analyzing.pop(future)
+                        layout, analyze_time = future.result()
+                        pipeline_stats.analyze.add(analyze_time)
+                        if slot is not None:
+                            ring.release(slot)
+                        render_time = render_times.pop(index)
+                        layout.update(page_number=pages[index], cached=False, source='raster',
+                                      elapsed=render_time + analyze_time,
+                                      timings={'render': render_time, 'analyze': analyze_time,
+                                               'total': render_time + analyze_time})
+                        finished[index] = layout
+                if blocked_since is not None and ring.free:
+                    pipeline_stats.slot_wait += time.perf_counter() - blocked_since
+                    blocked_since = None
+
+                while yielded in finished:
+                    layout = finished.pop(yielded)
+                    yielded += 1
+                    if stats is not None:
+                        pipeline_stats.elapsed = time.perf_counter() - start_time
+                        stats.update(pipeline_stats.to_dict())
+                    yield layout
+        finally:
+            for future in list(rendering) + list(analyzing):
+                future.cancel()
+            pipeline_stats.elapsed = time.perf_counter() - start_time
+            if stats is not None:
+                stats.update(pipeline_stats.to_dict())
+
+
+def analyze_document_pipelined(pdf_path, pages=None, zoom=1, granularity=50, render_workers=None,
+                               analyze_workers=None, slots=None, method='contours', trace_path=None):
+    """
+    Analyze many pages with iter_pipelined_layouts and report how busy each stage was.
+
+    :return: Dictionary with the per-page layouts (in page order), throughput
+             figures and the PipelineStats of both stages under 'stages'
+    """
+    stats = {}
+    start_time = time.time()
+    results = list(iter_pipelined_layouts(pdf_path, pages, zoom, granularity, render_workers, analyze_workers,
+                                          slots, method, trace_path, stats))
+    elapsed = time.time() - start_time
+    return {
+        'pdf_path': pdf_path,
+        'pages': results,
+        'elapsed': elapsed,
+        'pages_per_second': len(results) / elapsed if elapsed > 0 else float('inf'),
+        'stages': stats
+    }
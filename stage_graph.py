@@ -0,0 +1,283 @@
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+
+import instrumentation
+from pdf_processor import load_pdf
+from image_analyzer import (LAYOUT_METHODS, ElementTable, analyze_spatial_relationships, classify_bboxes,
+                            contour_bboxes, count_types, detect_layout_elements_xy, granularity_kernel_size,
+                            preprocess_image)
+
+# Stages of a page analysis in dependency order, each with the parameters its result depends on.
+# 'render' is the RGB page for display; 'grayscale' is rendered in gray directly rather than converted
+# from it, which is cheaper and gives batch and GUI the same pixels. 'integral' counts the ink of the
+# binary page for classification at every granularity, and 'reading_order' is the XY-cut tree.
+STAGE_PARAMETERS = OrderedDict([
+    ('render', ('zoom',)),
+    ('grayscale', ('zoom',)),
+    ('binary', ('zoom',)),
+    ('integral', ('zoom',)),
+    ('dilated', ('zoom', 'granularity')),
+    ('contours', ('zoom', 'granularity')),
+    ('elements', ('zoom', 'granularity', 'method')),
+    ('reading_order', ('zoom', 'granularity', 'method')),
+    ('relationships', ('zoom', 'granularity', 'method')),
+])
+STAGES = tuple(STAGE_PARAMETERS)
+# Results kept per stage and page, so sweeping a slider does not hold every granularity
+STAGE_MEMO_ENTRIES = 4
+# Pages whose stages a StageGraph keeps
+DEFAULT_MAX_PAGES = 8
+# Bytes of stage results a StageGraph keeps over all its pages
+DEFAULT_STAGE_BYTES = 256 * 1024 * 1024
+# Stages a StageGraph leaves to pdf_processor.page_cache, which already holds the rendered pages
+RENDER_STAGES = ('render', 'grayscale')
+
+
+class PageStages:
+    """
+    Memoized intermediate results of one page: render, grayscale, binary, dilated, contours, elements, relationships.
+
+    Every stage result is stored under the values of only the parameters it
+    depends on (STAGE_PARAMETERS), so asking for another granularity reuses
+    the render, grayscale and binary images and recomputes the dilated mask
+    and what follows it, and another method reuses the binary image too.
+    Stages are computed outside the lock: two threads asking for the same
+    missing stage may both compute it, and the first result stored wins.
+    nbytes counts the bytes of the results held, and trim() drops the least
+    recently used ones.
+    """
+
+    def __init__(self, render, max_entries=STAGE_MEMO_ENTRIES, memoized=STAGES, on_store=None):
+        """
+        :param render: Callable render(zoom, colorspace) returning the page as an array ('rgb' or 'gray')
+        :param max_entries: Results kept per stage
+        :param memoized: Stages whose results are kept; the others are computed again whenever they are needed
+        :param on_store: Optional callable on_store(stages) called after a result has been stored
+        """
+        self._renderer = render
+        self.max_entries = max_entries
+        self.memoized = frozenset(memoized)
+        self.nbytes = 0
+        self._on_store = on_store
+        self._memo = {stage: OrderedDict() for stage in STAGES}
+        self._used = OrderedDict()  # (stage, key) of every result held, least recently used first
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_image(cls, image, zoom=1, binary=False):
+        """
+        Start from an image that is already rendered.
+
+        :param image: Page image (RGB or grayscale), or the binary page with ink > 0 if binary is True
+        :param zoom: Zoom the image was rendered at, under which its stages are stored
+        :param binary: The image is already binary, so Otsu thresholding is skipped
+        """
+        stages = cls(None)
+        if binary:
+            stages._store('binary', (zoom,), image)
+        else:
+            stages._store('grayscale', (zoom,), cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image)
+        return stages
+
+    def get(self, stage, zoom=1, granularity=50, method='contours'):
+        """
+        Return the result of a stage, computing it and any missing stage before it.
+
+        :param stage: Name from STAGES
+        :param zoom: Render zoom
+        :param granularity: Layout granularity (1-100)
+        :param method: Segmentation method, 'contours' or 'xy_cut'
+        """
+        if stage not in STAGE_PARAMETERS:
+            raise ValueError(f"Invalid stage {stage!r}. Expected one of {list(STAGES)}.")
+        if method not in LAYOUT_METHODS:
+            raise ValueError(f"Invalid method {method!r}. Expected one of {list(LAYOUT_METHODS)}.")
+        parameters = {'zoom': zoom, 'granularity': granularity, 'method': method}
+        key = tuple(parameters[name] for name in STAGE_PARAMETERS[stage])
+        with self._lock:
+            memo = self._memo[stage]
+            if key in memo:
+                memo.move_to_end(key)
+                self._used.move_to_end((stage, key))
+                instrumentation.count('stages.reused', stage=stage)
+                return memo[key]
+        result = getattr(self, '_compute_' + stage)(zoom, granularity, method)
+        instrumentation.count('stages.computed', stage=stage)
+        return self._store(stage, key, result)
+
+    def layout(self, zoom=1, granularity=50, method='contours'):
+        """Return elements and relationships, like analyze_layout, plus the reading order for 'xy_cut'."""
+        with instrumentation.span('analyze_layout', granularity=granularity, zoom=zoom, method=method):
+            layout = {
+                'elements': self.get('elements', zoom, granularity, method),
+                'relationships': self.get('relationships', zoom, granularity, method)
+            }
+            if method == 'xy_cut':
+                layout['reading_order'] = self.get('reading_order', zoom, granularity, method)
+        instrumentation.sample_memory('analyze_layout')
+        return layout
+
+    def computed(self, stage):
+        """Return the parameter values the stage currently holds results for."""
+        with self._lock:
+            return list(self._memo[stage])
+
+    def trim(self, max_bytes):
+        """Drop the least recently used results until at most max_bytes are held."""
+        with self._lock:
+            while self.nbytes > max_bytes and self._used:
+                self._forget(*next(iter(self._used)))
+
+    def _store(self, stage, key, result):
+        if stage not in self.memoized:
+            return result
+        with self._lock:
+            memo = self._memo[stage]
+            if key in memo:
+                return memo[key]  # Another thread got there first
+            memo[key] = result
+            self._used[stage, key] = None
+            self.nbytes += _nbytes(result)
+            while len(memo) > self.max_entries:
+                self._forget(stage, next(iter(memo)))
+        if self._on_store is not None:
+            self._on_store(self)
+        return result
+
+    def _forget(self, stage, key):
+        """Drop a result; the caller holds the lock."""
+        self.nbytes -= _nbytes(self._memo[stage].pop(key))
+        del self._used[stage, key]
+
+    def _rendered(self, zoom, colorspace):
+        if self._renderer is None:
+            raise ValueError(f"This page was given as an image and cannot be rendered at zoom {zoom}")
+        return self._renderer(zoom, colorspace)
+
+    def _compute_render(self, zoom, granularity, method):
+        return self._rendered(zoom, 'rgb')
+
+    def _compute_grayscale(self, zoom, granularity, method):
+        return self._rendered(zoom, 'gray')
+
+    def _compute_binary(self, zoom, granularity, method):
+        return preprocess_image(self.get('grayscale', zoom))
+
+    def _compute_integral(self, zoom, granularity, method):
+        # The integral classify_bboxes would build for itself, in int32 while the sums of 255s fit
+        binary_image = self.get('binary', zoom)
+        return cv2.integral(binary_image, sdepth=cv2.CV_32S if binary_image.size * 255 < 2 ** 31 else cv2.CV_64F)
+
+    def _compute_dilated(self, zoom, granularity, method):
+        binary_image = self.get('binary', zoom)
+        kernel_size = granularity_kernel_size(binary_image.shape, granularity)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+        with instrumentation.span('dilate', kernel_size=kernel_size):
+            return cv2.dilate(binary_image, kernel, iterations=1)
+
+    def _compute_contours(self, zoom, granularity, method):
+        """Bboxes of the external contours of the dilated mask."""
+        dilated = self.get('dilated', zoom, granularity)
+        with instrumentation.span('find_contours'):
+            contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        instrumentation.count('contours', len(contours))
+        return contour_bboxes(contours)
+
+    def _compute_elements(self, zoom, granularity, method):
+        if method == 'xy_cut':
+            return self._cut(zoom, granularity)[0]
+        binary_image = self.get('binary', zoom)
+        bboxes = self.get('contours', zoom, granularity)
+        integral = self.get('integral', zoom)
+        with instrumentation.span('classify_elements', count=len(bboxes)):
+            codes, pixel_density = classify_bboxes(binary_image, bboxes, granularity, integral)
+        count_types(codes)
+        return ElementTable(bboxes, codes, pixel_density)
+
+    def _compute_reading_order(self, zoom, granularity, method):
+        return self._cut(zoom, granularity)[1] if method == 'xy_cut' else None
+
+    def _cut(self, zoom, granularity):
+        """Cut the page into elements and their reading-order tree, storing both."""
+        elements, tree = detect_layout_elements_xy(self.get('binary', zoom), granularity)
+        elements = self._store('elements', (zoom, granularity, 'xy_cut'), elements)
+        return elements, self._store('reading_order', (zoom, granularity, 'xy_cut'), tree)
+
+    def _compute_relationships(self, zoom, granularity, method):
+        return analyze_spatial_relationships(self.get('elements', zoom, granularity, method))
+
+
+def _nbytes(result):
+    """Bytes held by a stage result: an array or a table, while reading-order trees are not counted."""
+    return getattr(result, 'nbytes', 0)
+
+
+class StageGraph:
+    """
+    PageStages of the most recently used pages of any number of PDF files.
+
+    Pages are rendered through pdf_processor.load_pdf, so renders are held by
+    the shared page cache within its byte budget and are not kept here too.
+    The other stage results of all pages share max_bytes: when a page stores
+    a result that exceeds it, the least recently used other pages are dropped,
+    and then the oldest results of that page. Pages are keyed by file modification time as well, so a
+    file that changed on disk starts over.
+    """
+
+    def __init__(self, max_pages=DEFAULT_MAX_PAGES, max_bytes=DEFAULT_STAGE_BYTES):
+        """
+        :param max_pages: Pages whose stages are kept
+        :param max_bytes: Bytes of stage results kept over all pages
+        """
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(self, pdf_path, page_number):
+        """Return the PageStages of a page (0-indexed)."""
+        path = os.path.abspath(pdf_path)
+        key = (path, os.path.getmtime(path), page_number)
+        with self._lock:
+            stages = self._pages.get(key)
+            if stages is None:
+                stages = self._pages[key] = PageStages(
+                    lambda zoom, colorspace: load_pdf(path, page_number, zoom, colorspace)[0],
+                    memoized=[stage for stage in STAGES if stage not in RENDER_STAGES], on_store=self._trim)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+            else:
+                self._pages.move_to_end(key)
+        return stages
+
+    def layout(self, pdf_path, page_number, zoom=1, granularity=50, method='contours'):
+        """Return the layout of a page, reusing every stage already computed for it."""
+        return self.page(pdf_path, page_number).layout(zoom, granularity, method)
+
+    @property
+    def nbytes(self):
+        """Bytes of the stage results held over all pages."""
+        with self._lock:
+            return sum(stages.nbytes for stages in self._pages.values())
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def _trim(self, stages):
+        """Bring the stage results of all pages back within max_bytes after `stages` stored one."""
+        with self._lock:
+            total = sum(page.nbytes for page in self._pages.values())
+            held = False
+            # Least recently used first; the page that stored a result goes last, whatever its position
+            for key, page in list(self._pages.items()):
+                if page is stages:
+                    held = True
+                elif total > self.max_bytes:
+                    del self._pages[key]
+                    total -= page.nbytes
+        if total > self.max_bytes and held:
+            stages.trim(self.max_bytes)
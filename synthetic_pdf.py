@@ -0,0 +1,122 @@
+import random
+
+import fitz  # PyMuPDF
+import numpy as np
+
+# Page sizes in points
+PAGE_SIZES = {
+    'letter': (612, 792),
+    'a4': (595, 842),
+    'a3': (842, 1191),
+    'a0': (2384, 3370)
+}
+
+_WORDS = ("layout analysis document page table figure section report quarterly revenue growth market "
+          "customer product service region total value summary result method system process data model "
+          "review account balance statement invoice order shipping payment amount date number item").split()
+
+MARGIN = 36
+GAP = 12
+
+
+def generate_pdf(pdf_path, pages=10, page_size='letter', text_blocks=6, images=1, rules=3, tables=1, seed=0):
+    """
+    Write a deterministic synthetic PDF for benchmarks.
+
+    Every page gets the requested number of text blocks, raster images,
+    horizontal rules and table-like grids, placed top to bottom in one or two
+    columns. The same arguments always produce the same file.
+
+    :param pdf_path: Path of the PDF file to write
+    :param pages: Number of pages
+    :param page_size: Name from PAGE_SIZES or a (width, height) tuple in points
+    :param text_blocks: Text blocks per page
+    :param images: Raster images per page
+    :param rules: Horizontal rules per page
+    :param tables: Table-like grids per page
+    :param seed: Seed of the random layout and content
+    :return: pdf_path
+    """
+    width, height = PAGE_SIZES[page_size] if isinstance(page_size, str) else page_size
+    doc = fitz.open()
+    for page_number in range(pages):
+        rng = random.Random(seed * 100003 + page_number)
+        page = doc.new_page(width=width, height=height)
+        items = ['text'] * text_blocks + ['image'] * images + ['rule'] * rules + ['table'] * tables
+        rng.shuffle(items)
+        _place_items(page, items, rng)
+    doc.set_metadata({'title': 'Synthetic benchmark document', 'producer': 'synthetic_pdf',
+                      'creationDate': 'D:20240101000000', 'modDate': 'D:20240101000000'})
+    doc.save(pdf_path, garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+    return pdf_path
+
+
+def _place_items(page, items, rng):
+    """Flow the items down the page, in two columns on wide pages."""
+    columns = 2 if page.rect.width >= 500 else 1
+    column_width = (page.rect.width - 2 * MARGIN - (columns - 1) * GAP) / columns
+    # Share the usable height between the items of each column
+    per_column = [items[k::columns] for k in range(columns)]
+    for column, column_items in enumerate(per_column):
+        if not column_items:
+            continue
+        x0 = MARGIN + column * (column_width + GAP)
+        slot = (page.rect.height - 2 * MARGIN) / len(column_items)
+        for k, item in enumerate(column_items):
+            y0 = MARGIN + k * slot
+            item_height = slot - GAP if item != 'rule' else 0
+            rect = fitz.Rect(x0, y0, x0 + column_width * rng.uniform(0.6, 1.0), y0 + item_height)
+            if item == 'text':
+                _draw_text(page, rect, rng)
+            elif item == 'image':
+                _draw_image(page, rect, rng)
+            elif item == 'rule':
+                page.draw_line(rect.tl + (0, slot / 2), rect.tr + (0, slot / 2), width=rng.uniform(0.5, 2))
+            else:
+                _draw_table(page, rect, rng)
+
+
+def _draw_text(page, rect, rng):
+    fontsize = rng.choice([8, 9, 10, 11, 12])
+    # Roughly fill the box; insert_textbox writes nothing when the text
+    # overflows, so drop words until it fits
+    lines = rect.height / (fontsize * 1.2)
+    words = [rng.choice(_WORDS) for _ in range(int(lines * rect.width / (fontsize * 4)) + 1)]
+    while words and page.insert_textbox(rect, " ".join(words), fontsize=fontsize, fontname='helv') < 0:
+        words = words[:int(len(words) * 0.8)]
+
+
+def _draw_image(page, rect, rng):
+    if rect.width < 4 or rect.height < 4:
+        return
+    width, height = max(8, int(rect.width)), max(8, int(rect.height))
+    y, x = np.mgrid[0:height, 0:width]
+    phase = rng.uniform(0, 6.28)
+    red = (127 + 127 * np.sin(x / 11.0 + phase)).astype(np.uint8)
+    green = (127 + 127 * np.cos(y / 7.0 + phase)).astype(np.uint8)
+    blue = ((x * y) % 255).astype(np.uint8)
+    samples = np.ascontiguousarray(np.dstack([red, green, blue])).tobytes()
+    pixmap = fitz.Pixmap(fitz.csRGB, width, height, samples, False)
+    page.insert_image(rect, pixmap=pixmap)
+
+
+def _draw_table(page, rect, rng):
+    rows = rng.randint(3, 12)
+    columns = rng.randint(2, 6)
+    row_height = rect.height / rows
+    column_width = rect.width / columns
+    if row_height < 6 or column_width < 12:
+        return
+    for row in range(rows + 1):
+        y = rect.y0 + row * row_height
+        page.draw_line((rect.x0, y), (rect.x1, y), width=0.5)
+    for column in range(columns + 1):
+        x = rect.x0 + column * column_width
+        page.draw_line((x, rect.y0), (x, rect.y1), width=0.5)
+    fontsize = min(9, row_height * 0.5)
+    for row in range(rows):
+        for column in range(columns):
+            cell = fitz.Rect(rect.x0 + column * column_width + 2, rect.y0 + row * row_height,
+                             rect.x0 + (column + 1) * column_width - 2, rect.y0 + (row + 1) * row_height)
+            page.insert_textbox(cell, str(rng.randint(0, 99999)), fontsize=fontsize, fontname='helv')
@@ -0,0 +1,397 @@
+import math
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import instrumentation
+from pdf_processor import render_page
+from image_analyzer import (ElementTable, analyze_spatial_relationships, elements_from_mask, granularity_kernel_size,
+                            preprocess_image)
+from document_analyzer import resolve_pages, resolve_workers
+from stage_graph import PageStages
+
+# Pages analyzed in full at the start of a document to find its template
+TEMPLATE_SAMPLE_PAGES = 4
+# An element belongs to the template when it recurs on at least this fraction of the sampled pages
+MIN_TEMPLATE_FRACTION = 0.75
+# Recurring elements may move by this many pixels and differ by this many bits of their average hash
+BBOX_TOLERANCE = 2
+HASH_DISTANCE = 4
+# Side of the average hash grid, giving HASH_SIZE ** 2 bits
+HASH_SIZE = 8
+
+
+def average_hash(binary_crop):
+    """Perceptual hash of a binary region: one bit per HASH_SIZE grid cell, set where it is inkier than average."""
+    if binary_crop.size == 0:
+        return np.zeros(HASH_SIZE * HASH_SIZE // 8, dtype=np.uint8)
+    cells = cv2.resize(binary_crop, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return np.packbits(cells > cells.mean())
+
+
+class PageTemplate:
+    """
+    Elements repeated at the same place on many pages of a document: letterheads, footers, rules and logos.
+
+    Every template element keeps its classification and the binary pixels of
+    its box on the page it was first seen on. match() checks which of them a
+    new page repeats, so only the rest of the page has to be segmented.
+    """
+
+    def __init__(self, shape, elements, crops, pages):
+        """
+        :param shape: (height, width) of the pages the template was found on
+        :param elements: ElementTable of the template elements
+        :param crops: Binary pixels of every element's box
+        :param pages: Number of sampled pages every element was found on
+        """
+        self.shape = tuple(shape[:2])
+        self.elements = elements
+        self.crops = crops
+        self.pages = np.asarray(pages, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.elements)
+
+    @classmethod
+    def from_pages(cls, binaries, layouts, min_fraction=MIN_TEMPLATE_FRACTION):
+        """
+        Find the elements that recur on most of the sampled pages.
+
+        Elements are fingerprinted by their box and the average hash of their
+        pixels. Fingerprints within BBOX_TOLERANCE pixels and HASH_DISTANCE bits
+        of each other are the same element.
+
+        :param binaries: Binary images of the sampled pages
+        :param layouts: Layouts of the same pages, as analyze_layout returns them
+        :param min_fraction: Fraction of the sampled pages an element must be found on
+        :return: (PageTemplate, list with a boolean template mask over the elements of every layout)
+        """
+        if not binaries:
+            raise ValueError("At least one sampled page is needed to find a template")
+        shape = binaries[0].shape[:2]
+        # One cluster per distinct fingerprint: its box, hash, first page and element, and the pages it is on
+        boxes, hashes, owners, pages = [], [], [], []
+        members = []  # cluster index of every element of every page
+        with instrumentation.span('find_template', pages=len(binaries)):
+            for page_index, (binary, layout) in enumerate(zip(binaries, layouts)):
+                elements = layout['elements']
+                page_members = np.full(len(elements), -1, dtype=np.int64)
+                if binary.shape[:2] == shape:
+                    for index, (x, y, w, h) in enumerate(elements.bboxes.tolist()):
+                        fingerprint = average_hash(binary[y:y + h, x:x + w])
+                        cluster = -1
+                        if boxes:
+                            near = np.abs(np.array(boxes) - (x, y, w, h)).max(axis=1) <= BBOX_TOLERANCE
+                            for candidate in np.flatnonzero(near).tolist():
+                                distance = np.unpackbits(hashes[candidate] ^ fingerprint).sum()
+                                if distance <= HASH_DISTANCE and pages[candidate][-1] != page_index:
+                                    cluster = candidate
+                                    break
+                        if cluster < 0:
+                            cluster = len(boxes)
+                            boxes.append((x, y, w, h))
+                            hashes.append(fingerprint)
+                            owners.append((page_index, index))
+                            pages.append([])
+                        pages[cluster].append(page_index)
+                        page_members[index] = cluster
+                members.append(page_members)
+
+            required = max(2, math.ceil(min_fraction * len(binaries)))
+            counts = np.array([len(cluster_pages) for cluster_pages in pages], dtype=np.int64)
+            selected = np.flatnonzero(counts >= required) if len(binaries) >= 2 else np.zeros(0, dtype=np.int64)
+            bboxes, types, density, crops = [], [], [], []
+            for cluster in selected.tolist():
+                page_index, index = owners[cluster]
+                elements = layouts[page_index]['elements']
+                x, y, w, h = elements.bboxes[index].tolist()
+                bboxes.append((x, y, w, h))
+                types.append(elements.types[index])
+                density.append(elements.density[index])
+                crops.append(binaries[page_index][y:y + h, x:x + w].copy())
+            template = cls(shape, ElementTable(bboxes, types, density), crops, counts[selected])
+            masks = [np.isin(page_members, selected) for page_members in members]
+        instrumentation.count('template.elements', len(template))
+        return template, masks
+
+    def match(self, binary_image):
+        """Return a boolean mask of the template elements whose boxes hold exactly the same pixels on this page."""
+        matched = np.zeros(len(self), dtype=bool)
+        if binary_image.shape[:2] != self.shape:
+            return matched
+        for index, ((x, y, w, h), crop) in enumerate(zip(self.elements.bboxes.tolist(), self.crops)):
+            # Any difference may move the element's edges, so the hash only groups candidates and pixels decide
+            matched[index] = not cv2.countNonZero(cv2.bitwise_xor(binary_image[y:y + h, x:x + w], crop))
+        return matched
+
+
+def analyze_layout_with_template(image, template, granularity=50):
+    """
+    Analyze a page, reusing the template elements it repeats and segmenting only the rest.
+
+    A template element is reused when the pixels of its box match the template
+    and no other ink comes within a dilation kernel of the box, so dilating the
+    whole page would not have merged it with anything. Everything else is
+    segmented with the kernel of the full page in bands of the remaining ink
+    that blank rows keep out of each other's reach. An element of the rest
+    that encloses a reused one, such as a page border or form box, would have
+    swallowed it as an inner contour, so that element is segmented with the
+    rest of its band again. The result equals analyze_layout's up to the order
+    of the elements.
+
+    :param image: Page image (RGB or grayscale numpy array)
+    :param template: PageTemplate of the document
+    :param granularity: Layout granularity (1-100)
+    :return: Layout dictionary with elements, relationships and a boolean 'template' mask over the elements
+    """
+    with instrumentation.span('analyze_layout_with_template', granularity=granularity, template=len(template)):
+        binary_image = preprocess_image(image)
+        height, width = binary_image.shape[:2]
+        kernel_size = granularity_kernel_size(binary_image.shape, granularity)
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+        margin = kernel_size + 1
+        with instrumentation.span('match_template'):
+            reused = template.match(binary_image)
+            remainder = binary_image.copy()
+            for x, y, w, h in template.elements.bboxes[reused].tolist():
+                remainder[y:y + h, x:x + w] = 0
+        segmented = {}  # (x0, y0, x1, y1) of a band -> its elements
+        restored = []  # Boxes of template elements put back since the bands were last segmented
+        while True:
+            # Put back the template elements that other ink would have merged with, until none is left
+            changed = True
+            while changed:
+                changed = False
+                for index in np.flatnonzero(reused).tolist():
+                    x, y, w, h = template.elements.bboxes[index].tolist()
+                    x0, y0 = max(x - margin, 0), max(y - margin, 0)
+                    x1, y1 = min(x + w + margin, width), min(y + h + margin, height)
+                    if cv2.countNonZero(remainder[y0:y1, x0:x1]):
+                        remainder[y:y + h, x:x + w] = binary_image[y:y + h, x:x + w]
+                        reused[index] = False
+                        restored.append((x, y, w, h))
+                        changed = True
+            # Only the bands holding restored ink are segmented again
+            for band in [band for band in segmented if any(_overlaps(band, box) for box in restored)]:
+                del segmented[band]
+            restored = []
+
+            bands = _ink_bands(remainder, margin)
+            missing = [band for band in bands if band not in segmented]
+            area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in missing)
+            with instrumentation.span('segment_remainder', bands=len(missing), fraction=area / (width * height)):
+                for band in missing:
+                    x0, y0, x1, y1 = band
+                    dilated = cv2.dilate(remainder[y0:y1, x0:x1], kernel, iterations=1)
+                    # Classify on the page itself, as template ink may fall inside the box of another element
+                    table = elements_from_mask(dilated, binary_image[y0:y1, x0:x1], granularity)
+                    table.bboxes[:, 0] += x0
+                    table.bboxes[:, 1] += y0
+                    segmented[band] = table
+            tables = [segmented[band] for band in bands]
+
+            # Template elements inside the box of an element of the rest, as in a frame, are put back
+            kept = np.flatnonzero(reused)
+            boxes = np.concatenate([table.bboxes for table in tables]) if tables else np.zeros((0, 4), np.int32)
+            inner = template.elements.bboxes[kept][:, None, :]
+            outer = boxes[None, :, :]
+            enclosed = ((inner[..., :2] >= outer[..., :2]).all(axis=2) &
+                        (inner[..., :2] + inner[..., 2:] <= outer[..., :2] + outer[..., 2:]).all(axis=2)).any(axis=1)
+            if not enclosed.any():
+                break
+            for index in kept[enclosed].tolist():
+                x, y, w, h = template.elements.bboxes[index].tolist()
+                remainder[y:y + h, x:x + w] = binary_image[y:y + h, x:x + w]
+                reused[index] = False
+                restored.append((x, y, w, h))
+        instrumentation.count('template.reused', int(reused.sum()))
+
+        kept = template.elements[reused]
+        tables.insert(0, kept)
+        elements = ElementTable(np.concatenate([table.bboxes for table in tables]),
+                                np.concatenate([table.types for table in tables]),
+                                np.concatenate([table.density for table in tables]))
+        relationships = analyze_spatial_relationships(elements)
+    return {
+        'elements': elements,
+        'relationships': relationships,
+        'template': np.arange(len(elements)) < len(kept)
+    }
+
+
+def _overlaps(band, box):
+    """Return whether an (x0, y0, x1, y1) band and an (x, y, w, h) box share any pixel."""
+    x0, y0, x1, y1 = band
+    x, y, w, h = box
+    return x < x1 and x0 < x + w and y < y1 and y0 < y + h
+
+
+def _ink_bands(binary_image, margin):
+    """
+    Return (x0, y0, x1, y1) rectangles around the ink that dilation cannot join across.
+
+    Rows of ink are grouped into bands wherever more than 2 * margin blank rows
+    separate them, and every band is trimmed to its ink columns; each rectangle
+    keeps margin pixels of blank page around its ink.
+    """
+    height, width = binary_image.shape[:2]
+    # Summing is several times faster than cv2.REDUCE_MAX over uint8 rows
+    ink_rows = np.flatnonzero(cv2.reduce(binary_image, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel())
+    if not len(ink_rows):
+        return []
+    breaks = np.flatnonzero(np.diff(ink_rows) > 2 * margin)
+    starts = np.concatenate([[ink_rows[0]], ink_rows[breaks + 1]])
+    stops = np.concatenate([ink_rows[breaks], [ink_rows[-1]]]) + 1
+    bands = []
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        y0, y1 = max(start - margin, 0), min(stop + margin, height)
+        ink_columns = np.flatnonzero(cv2.reduce(binary_image[start:stop], 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel())
+        bands.append((max(int(ink_columns[0]) - margin, 0), y0, min(int(ink_columns[-1]) + 1 + margin, width), y1))
+    return bands
+
+
+# Per-process state of the pool workers: the open document and the template found by the parent
+_worker_doc = None
+_worker_template = None
+
+
+def _init_template_worker(pdf_path, template, trace_path=None):
+    global _worker_doc, _worker_template
+    if trace_path:
+        instrumentation.set_sink(instrumentation.JSONLinesSink(trace_path))
+    cv2.setNumThreads(1)
+    _worker_doc = fitz.open(pdf_path)
+    _worker_template = template
+
+
+def _analyze_template_page(page_number, zoom, granularity):
+    start_time = time.perf_counter()
+    with instrumentation.span('page', page_number=page_number, zoom=zoom):
+        with instrumentation.span('render'):
+            image = render_page(_worker_doc.load_page(page_number), zoom, 'gray')
+        render_time = time.perf_counter() - start_time
+        layout = analyze_layout_with_template(image, _worker_template, granularity)
+    elapsed = time.perf_counter() - start_time
+    layout.update(page_number=page_number, source='template', cached=False, elapsed=elapsed,
+                  timings={'render': render_time, 'analyze': elapsed - render_time, 'total': elapsed})
+    return layout
+
+
+def _sample_layouts(doc, pages, zoom, granularity):
+    """Analyze the sampled pages in full and keep their binary images for fingerprinting."""
+    binaries, layouts = [], []
+    for page_number in pages:
+        start_time = time.perf_counter()
+        with instrumentation.span('page', page_number=page_number, zoom=zoom):
+            page = doc.load_page(page_number)
+            stages = PageStages(lambda zoom, colorspace: render_page(page, zoom, colorspace))
+            with instrumentation.span('render'):
+                stages.get('grayscale', zoom)
+            render_time = time.perf_counter() - start_time
+            layout = stages.layout(zoom, granularity)
+        elapsed = time.perf_counter() - start_time
+        binaries.append(stages.get('binary', zoom))
+        layout.update(page_number=page_number, source='raster', cached=False, elapsed=elapsed,
+                      timings={'render': render_time, 'analyze': elapsed - render_time, 'total': elapsed})
+        layouts.append(layout)
+    return binaries, layouts
+
+
+def iter_templated_layouts(pdf_path, pages=None, zoom=1, granularity=50, workers=None,
+                           sample_pages=TEMPLATE_SAMPLE_PAGES, min_fraction=MIN_TEMPLATE_FRACTION, trace_path=None,
+                           template_info=None):
+    """
+    Yield page layouts in page order, segmenting only what each page adds to the document's template.
+
+    The first sample_pages pages are analyzed in full in this process and
+    their recurring elements become the template. The remaining pages are
+    spread over a process pool that reuses the template's elements and
+    segments only the rest of every page. Every layout carries a boolean
+    'template' mask over its elements.
+
+    :param pdf_path: Path to the PDF file
+    :param pages: Iterable of page numbers to analyze (0-indexed), all pages if None
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity, as for analyze_layout
+    :param workers: Number of worker processes, os.cpu_count() if None
+    :param sample_pages: Number of leading pages the template is found on
+    :param min_fraction: Fraction of the sampled pages a template element must be found on
+    :param trace_path: Optional JSON-lines file receiving the stage timings of every worker
+    :param template_info: Optional dictionary that receives the PageTemplate under 'template'
+    :return: Generator of layout dictionaries (elements, relationships, template, page_number, timings, cached)
+    """
+    if sample_pages < 1:
+        raise ValueError(f"sample_pages must be at least 1, got {sample_pages}")
+    with fitz.open(pdf_path) as doc:
+        pages = resolve_pages(pages, len(doc))
+        sampled, remaining = pages[:sample_pages], pages[sample_pages:]
+        binaries, layouts = _sample_layouts(doc, sampled, zoom, granularity)
+    template, masks = PageTemplate.from_pages(binaries, layouts, min_fraction)
+    del binaries
+    if template_info is not None:
+        template_info['template'] = template
+    for layout, mask in zip(layouts, masks):
+        layout['template'] = mask
+        yield layout
+    if not remaining:
+        return
+
+    workers = resolve_workers(workers, len(remaining))
+    lookahead = 2 * workers
+    remaining = iter(remaining)
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_template_worker,
+                             initargs=(pdf_path, template, trace_path)) as executor:
+        try:
+            for page_number in remaining:
+                in_flight.append(executor.submit(_analyze_template_page, page_number, zoom, granularity))
+                if len(in_flight) >= lookahead:
+                    break
+            while in_flight:
+                layout = in_flight.popleft().result()
+                page_number = next(remaining, None)
+                if page_number is not None:
+                    in_flight.append(executor.submit(_analyze_template_page, page_number, zoom, granularity))
+                yield layout
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def analyze_document_templated(pdf_path, pages=None, zoom=1, granularity=50, workers=None,
+                               sample_pages=TEMPLATE_SAMPLE_PAGES, min_fraction=MIN_TEMPLATE_FRACTION,
+                               trace_path=None):
+    """
+    Analyze many pages of a PDF file, finding their shared template once and reusing it.
+
+    :return: Dictionary with the per-page layouts (in page order), throughput figures and a 'template' summary
+    """
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    start_time = time.time()
+    info = {}
+    results = list(iter_templated_layouts(pdf_path, pages, zoom, granularity, workers, sample_pages, min_fraction,
+                                          trace_path, info))
+    elapsed = time.time() - start_time
+    template = info['template']
+    reused = [int(layout['template'].sum()) for layout in results[sample_pages:]]
+    return {
+        'pdf_path': pdf_path,
+        'total_pages': total_pages,
+        'pages': results,
+        'elapsed': elapsed,
+        'pages_per_second': len(results) / elapsed if elapsed > 0 else float('inf'),
+        'template': {
+            'elements': len(template),
+            'bboxes': template.elements.bboxes.tolist(),
+            'types': template.elements.type_names,
+            'sampled_pages': min(sample_pages, len(results)),
+            'pages_reusing': sum(1 for count in reused if count),
+            'reused_elements': sum(reused)
+        }
+    }
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_analyzer import analyze_pdf_page, iter_page_layouts, layout_to_dict, write_layouts_jsonl
+from layout_cache import LayoutCache
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_pdfs', 'sample.pdf')
+
+
+def test_auto_mode_segments_rasterized_pages_with_the_requested_method(tmp_path):
+    raster = analyze_pdf_page(SAMPLE_PDF, 0, granularity=30, method='xy_cut')
+    cache = LayoutCache(str(tmp_path))
+    for cached in (False, True):
+        auto = analyze_pdf_page(SAMPLE_PDF, 0, granularity=30, cache=cache, mode='auto', method='xy_cut')
+        assert auto['cached'] is cached
+        assert np.array_equal(auto['elements'].bboxes, raster['elements'].bboxes)
+        assert np.array_equal(auto['elements'].types, raster['elements'].types)
+        assert layout_to_dict(auto)['reading_order'] == layout_to_dict(raster)['reading_order']
+
+
+def test_vector_mode_rejects_xy_cut():
+    with pytest.raises(ValueError):
+        analyze_pdf_page(SAMPLE_PDF, 0, mode='vector', method='xy_cut')
+
+
+def test_pyramid_layouts_are_cached_and_streamed(tmp_path):
+    cache = LayoutCache(str(tmp_path / 'cache'))
+    first, second = (list(iter_page_layouts(SAMPLE_PDF, [0], zoom=2, workers=1, cache=cache, coarse_scale=0.25))[0]
+                     for _ in range(2))
+    assert (first['cached'], second['cached']) == (False, True)
+    assert first['source'] == 'pyramid'
+    assert np.array_equal(first['elements'].bboxes, second['elements'].bboxes)
+    # Full-resolution layouts of the same page are cached under another key
+    assert analyze_pdf_page(SAMPLE_PDF, 0, zoom=2, cache=cache)['cached'] is False
+
+    output = tmp_path / 'layouts.jsonl'
+    layouts = iter_page_layouts(SAMPLE_PDF, [0], zoom=2, workers=1, coarse_scale=0.25)
+    assert write_layouts_jsonl(layouts, str(output)) == 1
+    assert json.loads(output.read_text())['source'] == 'pyramid'
+
+
+def test_pyramid_rejects_other_modes_and_methods():
+    for mode, method in (('auto', 'contours'), ('raster', 'xy_cut')):
+        with pytest.raises(ValueError):
+            analyze_pdf_page(SAMPLE_PDF, 0, mode=mode, method=method, coarse_scale=0.25)
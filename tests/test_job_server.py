@@ -0,0 +1,118 @@
+import http.client
+import json
+import os
+import sys
+import threading
+
+import fitz  # PyMuPDF
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_analyzer import analyze_pdf_page, layout_to_dict
+from job_server import JobClient, JobService, QueueFull, serve
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_pdfs', 'sample.pdf')
+
+
+def _start(service):
+    """Serve a JobService on an ephemeral port in a background thread."""
+    server = serve(service, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, JobClient(port=server.server_address[1], timeout=60)
+
+
+def _stop(server, service):
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+@pytest.fixture(scope='module')
+def client():
+    # One page in flight at a time, so a job over many pages is still running when it is cancelled
+    service = JobService(workers=1, queue_size=4, lookahead=1)
+    server, job_client = _start(service)
+    yield job_client
+    _stop(server, service)
+
+
+@pytest.fixture(scope='module')
+def long_pdf(tmp_path_factory):
+    path = tmp_path_factory.mktemp('pdfs') / 'long.pdf'
+    with fitz.open() as doc:
+        for page_number in range(60):
+            page = doc.new_page()
+            for line in range(40):
+                page.insert_text((72, 72 + line * 16), f"Page {page_number + 1}, line {line + 1} of the long document")
+        doc.save(str(path))
+    return str(path)
+
+
+def test_results_are_streamed_per_page(client):
+    job = client.submit(SAMPLE_PDF, granularity=30)
+    records = list(client.results(job['job_id']))
+    *pages, summary = records
+    assert [record['page_number'] for record in pages] == [0, 1]
+    for record in pages:
+        expected = layout_to_dict(analyze_pdf_page(SAMPLE_PDF, record['page_number'], granularity=30))
+        assert record['elements'] == expected['elements']
+    assert summary['status'] == 'done'
+    assert summary['pages_done'] == 2
+
+
+def test_uploaded_pdf_is_analyzed(client):
+    with open(SAMPLE_PDF, 'rb') as f:
+        job = client.submit(data=f.read(), pages=[1])
+    *pages, summary = client.results(job['job_id'])
+    assert [record['page_number'] for record in pages] == [1]
+    assert summary['status'] == 'done'
+
+
+def test_cancel_stops_a_running_job(client, long_pdf):
+    job = client.submit(long_pdf, zoom=2)
+    results = client.results(job['job_id'])
+    first = next(results)
+    assert first['page_number'] == 0
+    assert client.cancel(job['job_id'])['job_id'] == job['job_id']
+    *_, summary = results
+    assert summary['status'] == 'cancelled'
+    assert summary['pages_done'] < summary['pages']
+    assert client.status(job['job_id'])['status'] == 'cancelled'
+
+
+def test_metrics_report_jobs_and_latency(client):
+    job = client.submit(SAMPLE_PDF, pages=[0])
+    assert list(client.results(job['job_id']))[-1]['status'] == 'done'
+    metrics = client.metrics()
+    assert metrics['workers'] == 1
+    assert metrics['completed_jobs'] >= 1
+    assert metrics['queue_depth'] == 0
+    assert metrics['queue_capacity'] == 4
+    latency = metrics['latency']
+    assert set(latency) == {'queue_wait', 'render', 'analyze', 'page', 'job'}
+    assert latency['page']['count'] >= 1
+    assert latency['page']['p50'] is not None
+
+
+def test_full_queue_rejects_with_retry_after():
+    service = JobService(workers=1, queue_size=0)
+    server, job_client = _start(service)
+    try:
+        with pytest.raises(QueueFull) as rejected:
+            job_client.submit(SAMPLE_PDF)
+        assert rejected.value.retry_after >= 1
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=60)
+        connection.request('POST', '/jobs', json.dumps({'pdf_path': SAMPLE_PDF}), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+        connection.close()
+        assert response.status == 503
+        assert int(response.getheader('Retry-After')) == payload['retry_after'] >= 1
+        metrics = job_client.metrics()
+        assert metrics['rejected_jobs'] == 2
+        assert metrics['queue_depth'] == 0
+        assert metrics['retry_after'] >= 1
+    finally:
+        _stop(server, service)
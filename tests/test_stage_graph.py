@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stage_graph import StageGraph
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test_pdfs', 'sample.pdf')
+
+
+def test_page_storing_a_result_is_trimmed_rather_than_dropped():
+    one_layout = StageGraph()
+    one_layout.layout(SAMPLE_PDF, 0, granularity=50)
+    graph = StageGraph(max_bytes=one_layout.nbytes + 1024)
+
+    stages = graph.page(SAMPLE_PDF, 0)
+    stages.layout(1, 50)
+    # Another page becomes the most recently used while the first one is still being analyzed
+    graph.page(SAMPLE_PDF, 1)
+    stages.layout(1, 20)
+    assert graph.page(SAMPLE_PDF, 0) is stages
+    assert 0 < stages.nbytes == graph.nbytes <= graph.max_bytes
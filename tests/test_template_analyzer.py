@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+
+import fitz  # PyMuPDF
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_analyzer import analyze_layout
+from main import templated
+from pdf_processor import render_page
+from template_analyzer import iter_templated_layouts
+
+
+def _letterhead_pdf(pdf_path, pages=10, framed=(7,)):
+    """Write pages with the same header and rule, some of them inside a page border."""
+    with fitz.open() as doc:
+        for page_number in range(pages):
+            page = doc.new_page(width=612, height=792)
+            page.insert_text((72, 50), "ACME Corporation - Quarterly Report", fontsize=14)
+            page.draw_line((72, 80), (540, 80), width=1)
+            page.insert_text((72, 400), f"Body text of page {page_number + 1}", fontsize=11)
+            if page_number in framed:
+                page.draw_rect(fitz.Rect(30, 20, 582, 772), width=1)
+        doc.save(pdf_path)
+
+
+def _layout_elements(layout):
+    elements = layout['elements']
+    return sorted(zip(elements.type_names, map(tuple, elements.bboxes.tolist())))
+
+
+def test_template_element_inside_a_frame_matches_full_analysis(tmp_path):
+    pdf_path = str(tmp_path / 'framed.pdf')
+    _letterhead_pdf(pdf_path)
+    layouts = list(iter_templated_layouts(pdf_path, zoom=1, granularity=10, workers=1))
+    with fitz.open(pdf_path) as doc:
+        for layout in layouts:
+            image = render_page(doc.load_page(layout['page_number']), 1, 'gray')
+            assert _layout_elements(layout) == _layout_elements(analyze_layout(image, 10))
+    # The unframed pages reuse the template, the framed one segments the header with its border
+    assert layouts[8]['template'].any()
+    assert not layouts[7]['template'].any()
+
+
+def test_templated_layout_marks_template_elements(tmp_path):
+    pdf_path = str(tmp_path / 'letterhead.pdf')
+    _letterhead_pdf(pdf_path, pages=6, framed=())
+    layouts = list(iter_templated_layouts(pdf_path, zoom=1, granularity=10, workers=1, sample_pages=3))
+    for layout in layouts:
+        assert len(layout['template']) == len(layout['elements'])
+        assert np.count_nonzero(layout['template']) >= 1
+
+
+def test_templated_output_marks_template_elements(tmp_path):
+    pdf_path = str(tmp_path / 'letterhead.pdf')
+    output = str(tmp_path / 'layouts.jsonl')
+    _letterhead_pdf(pdf_path, pages=6, framed=(4,))
+    templated(pdf_path, zoom=1, granularity=10, workers=1, sample_pages=3, output=output)
+    with open(output, encoding='utf-8') as file:
+        records = [json.loads(line) for line in file]
+    layouts = list(iter_templated_layouts(pdf_path, zoom=1, granularity=10, workers=1, sample_pages=3))
+    assert [record['page_number'] for record in records] == list(range(6))
+    for record, layout in zip(records, layouts):
+        assert [element['template'] for element in record['elements']] == layout['template'].tolist()
+    assert any(element['template'] for element in records[5]['elements'])
+    assert not any(element['template'] for element in records[4]['elements'])
@@ -0,0 +1,412 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import instrumentation
+from pdf_processor import document_lock, open_document
+from image_analyzer import ElementTable, analyze_spatial_relationships, classify_features, granularity_kernel_size
+
+# Default memory ceiling for the working set of a tiled analysis
+DEFAULT_MAX_MEMORY = 512 * 1024 * 1024
+# Approximate working memory per tile pixel: the gray, binary and dilated
+# planes, two int32 label planes and the float64 integral of the second pass
+BYTES_PER_TILE_PIXEL = 24
+MIN_TILE_SIZE = 256
+
+
+def analyze_page_tiled(pdf_path, page_number=0, zoom=1, granularity=50, tile_size=None, workers=None,
+                       max_memory=DEFAULT_MAX_MEMORY):
+    """
+    Analyze the layout of a PDF page in tiles without ever rendering the whole page.
+
+    Tiles are rendered through PyMuPDF clip rectangles. MuPDF anti-aliases
+    clipped renders very slightly differently from a full render, so a few
+    pixels can land on the other side of the threshold; use
+    analyze_layout_tiled on a full render to reproduce analyze_layout exactly.
+
+    :param pdf_path: Path to the PDF file
+    :param page_number: Page number to analyze (0-indexed)
+    :param zoom: number by which to multiply the matrix
+    :param granularity: Granularity, as for analyze_layout
+    :param tile_size: Side of the square tiles in pixels, derived from max_memory if None
+    :param workers: Number of tile threads, os.cpu_count() if None
+    :param max_memory: Memory ceiling in bytes for the tile working set
+    :return: Dictionary of elements and relationships in page pixel coordinates
+    """
+    matrix = fitz.Matrix(zoom, zoom)
+    with document_lock():
+        doc, _ = open_document(pdf_path)
+        if page_number < 0 or page_number >= len(doc):
+            raise ValueError(f"Invalid page number. The document has {len(doc)} pages.")
+        page = doc.load_page(page_number)
+        # The display list is built once, so tiles do not re-interpret the page contents
+        display_list = page.get_displaylist()
+        page_pixels = (page.rect * matrix).round()
+        width, height = page_pixels.width, page_pixels.height
+
+    def read_tile(x0, y0, x1, y1):
+        # Clips are given in (rotated) page coordinates. Render one pixel more
+        # on every side and cut the exact rectangle out, since MuPDF rounds the
+        # clip outwards to whole pixels.
+        clip = fitz.Rect(x0 - 1, y0 - 1, x1 + 1, y1 + 1) / zoom
+        with document_lock():
+            pix = display_list.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False, clip=clip)
+        gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w)
+        return gray[y0 - pix.y:y1 - pix.y, x0 - pix.x:x1 - pix.x]
+
+    return _analyze_tiles(read_tile, width, height, granularity, tile_size, workers, max_memory)
+
+
+def analyze_layout_tiled(image, granularity=50, tile_size=None, workers=None, max_memory=DEFAULT_MAX_MEMORY):
+    """
+    Analyze an image in overlapping tiles; gives exactly what analyze_layout gives.
+
+    :param image: Page image (RGB or grayscale numpy array)
+    :param granularity: Granularity, as for analyze_layout
+    :param tile_size: Side of the square tiles in pixels, derived from max_memory if None
+    :param workers: Number of tile threads, os.cpu_count() if None
+    :param max_memory: Memory ceiling in bytes for the tile working set
+    :return: Dictionary of elements and relationships
+    """
+    def read_tile(x0, y0, x1, y1):
+        tile = image[y0:y1, x0:x1]
+        return cv2.cvtColor(tile, cv2.COLOR_RGB2GRAY) if tile.ndim == 3 else tile
+
+    return _analyze_tiles(read_tile, image.shape[1], image.shape[0], granularity, tile_size, workers, max_memory)
+
+
+def otsu_threshold(histogram):
+    """
+    Return the Otsu threshold of a 256-bin histogram.
+
+    Follows OpenCV's implementation step by step, so the value matches what
+    cv2.threshold with THRESH_OTSU picks for an image with this histogram.
+    """
+    scale = 1.0 / histogram.sum()
+    mu = float(np.dot(np.arange(256), histogram)) * scale
+    mu1 = q1 = max_sigma = 0.0
+    max_value = 0
+    epsilon = float(np.finfo(np.float32).eps)
+    for i, count in enumerate(histogram.tolist()):
+        p_i = count * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_value = i
+    return max_value
+
+
+class _UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union_pairs(self, first, second):
+        for a, b in zip(first.tolist(), second.tolist()):
+            root_a, root_b = self.find(a), self.find(b)
+            if root_a != root_b:
+                self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        parent = np.array(self.parent, dtype=np.int64)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+def _tile_grid(width, height, tile_size, halo, workers, max_memory):
+    """Choose the tile size and return it with the (x0, y0, x1, y1) core rectangle of every tile."""
+    packed_bytes = height * math.ceil(width / 8)
+    if tile_size is None:
+        budget = max_memory - packed_bytes
+        if budget <= 0:
+            raise MemoryError(f"A {width}x{height} page does not fit in a memory ceiling of {max_memory} bytes.")
+        tile_size = int(math.sqrt(budget / (workers * BYTES_PER_TILE_PIXEL))) - halo
+        tile_size = max(MIN_TILE_SIZE, tile_size)
+    columns = range(0, width, tile_size)
+    rows = range(0, height, tile_size)
+    return tile_size, [[(x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)) for x0 in columns]
+                       for y0 in rows]
+
+
+def _analyze_tiles(read_tile, width, height, granularity, tile_size, workers, max_memory):
+    with instrumentation.span('analyze_layout_tiled', granularity=granularity, shape=[height, width]):
+        workers = max(1, workers or os.cpu_count() or 1)
+        kernel_size = granularity_kernel_size((height, width), granularity)
+        # cv2.dilate reaches kernel_size // 2 pixels up/left and the rest down/right
+        before, after = kernel_size // 2, kernel_size - 1 - kernel_size // 2
+        tile_size, grid = _tile_grid(width, height, tile_size, before + after, workers, max_memory)
+        tiles = [tile for row in grid for tile in row]
+
+        def expanded(tile):
+            x0, y0, x1, y1 = tile
+            return max(0, x0 - before), max(0, y0 - before), min(width, x1 + after), min(height, y1 + after)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Pass 1: one Otsu threshold for the whole page from the combined histogram.
+            # Rendered tiles are kept for pass 2 when they fit comfortably in the ceiling.
+            keep_tiles = width * height * 2 <= max_memory // 2
+
+            def histogram(tile):
+                x0, y0, x1, y1 = tile
+                ex0, ey0, ex1, ey1 = expanded(tile)
+                gray = read_tile(ex0, ey0, ex1, ey1)
+                core = gray[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+                return np.bincount(core.ravel(), minlength=256), gray if keep_tiles else None
+
+            with instrumentation.span('histogram', tiles=len(tiles)):
+                passes = list(executor.map(histogram, tiles))
+            threshold = otsu_threshold(sum(counts for counts, _ in passes))
+            kept = [gray for _, gray in passes]
+            del passes
+
+            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+
+            def segment(index):
+                tile = tiles[index]
+                x0, y0, x1, y1 = tile
+                ex0, ey0, ex1, ey1 = expanded(tile)
+                gray = kept[index] if kept[index] is not None else read_tile(ex0, ey0, ex1, ey1)
+                kept[index] = None
+                _, binary = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY_INV)
+                dilated = cv2.dilate(binary, kernel, iterations=1)
+                core = (slice(y0 - ey0, y1 - ey0), slice(x0 - ex0, x1 - ex0))
+                return _segment_tile(tile, np.ascontiguousarray(binary[core]),
+                                     np.ascontiguousarray(dilated[core]), width, height)
+
+            with instrumentation.span('segment_tiles', tiles=len(tiles), tile_size=tile_size):
+                records = list(executor.map(segment, range(len(tiles))))
+
+            with instrumentation.span('merge_seams'):
+                bboxes, first_pixels = _merge_tiles(grid, records, width)
+            order = np.argsort(-first_pixels, kind='stable')  # findContours lists the last-found contour first
+            bboxes = bboxes[order]
+
+            with instrumentation.span('measure_density', elements=len(bboxes)):
+                ink = sum(executor.map(lambda record: _tile_ink(record, bboxes), records))
+        instrumentation.count('contours', len(bboxes))
+
+        def read_roi(x0, y0, roi_width, roi_height):
+            return _read_binary(records, x0, y0, x0 + roi_width, y0 + roi_height)
+
+        x, y, w, h = bboxes.T
+        pixel_density = ink / (w * h * 255) if len(bboxes) else np.zeros(0)
+        codes = classify_features(bboxes, pixel_density, granularity, read_roi)
+        elements = ElementTable(bboxes, codes, pixel_density)
+        relationships = analyze_spatial_relationships(elements)
+    return {
+        'elements': elements,
+        'relationships': relationships
+    }
+
+
+def _segment_tile(tile, binary, dilated, width, height):
+    """Label one tile and keep what the seam merge needs, plus the packed binary pixels."""
+    x0, y0, x1, y1 = tile
+    fg_count, fg, stats, _ = cv2.connectedComponentsWithStats(dilated, connectivity=8)
+    bg_count, bg = cv2.connectedComponents(cv2.compare(dilated, 0, cv2.CMP_EQ), connectivity=4)
+
+    # First pixel of every component in raster order, as a page-wide flat index
+    flat = fg.ravel()
+    ink_pixels = np.flatnonzero(flat)
+    first = np.full(fg_count, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, flat[ink_pixels], ink_pixels)
+    first = first[1:]
+    first = (first // (x1 - x0) + y0) * width + first % (x1 - x0) + x0
+
+    # Component bboxes in page coordinates
+    bboxes = stats[1:, :4].astype(np.int64) + np.array([x0, y0, 0, 0])
+    fg_on_border = ((bboxes[:, 0] == 0) | (bboxes[:, 1] == 0) |
+                    (bboxes[:, 0] + bboxes[:, 2] == width) | (bboxes[:, 1] + bboxes[:, 3] == height))
+
+    # Background components that touch the page border surround everything else
+    border_bg = []
+    if y0 == 0:
+        border_bg.append(bg[0])
+    if y1 == height:
+        border_bg.append(bg[-1])
+    if x0 == 0:
+        border_bg.append(bg[:, 0])
+    if x1 == width:
+        border_bg.append(bg[:, -1])
+    bg_on_border = np.unique(np.concatenate(border_bg)) if border_bg else np.zeros(0, dtype=np.int32)
+
+    # Which foreground components touch which background components inside the tile
+    pairs = []
+    for fg_side, bg_side in ((fg[:, :-1], bg[:, 1:]), (fg[:, 1:], bg[:, :-1]),
+                             (fg[:-1], bg[1:]), (fg[1:], bg[:-1])):
+        touching = (fg_side > 0) & (bg_side > 0)
+        pairs.append(fg_side[touching].astype(np.int64) * bg_count + bg_side[touching])
+    pairs = np.unique(np.concatenate(pairs))
+
+    return {
+        'tile': tile,
+        'fg_count': fg_count - 1,
+        'bg_count': bg_count - 1,
+        'bboxes': bboxes,
+        'first': first,
+        'fg_on_border': fg_on_border,
+        'bg_on_border': bg_on_border[bg_on_border > 0] - 1,
+        'adjacent': (pairs // bg_count - 1, pairs % bg_count - 1),
+        'fg_edges': (fg[0].copy(), fg[-1].copy(), fg[:, 0].copy(), fg[:, -1].copy()),
+        'bg_edges': (bg[0].copy(), bg[-1].copy(), bg[:, 0].copy(), bg[:, -1].copy()),
+        'packed': np.packbits(binary > 0, axis=1)
+    }
+
+
+def _seam_pairs(fg_a, fg_b, bg_a, bg_b, fg_offset_a, fg_offset_b, bg_offset_a, bg_offset_b):
+    """Return the unions and the foreground/background contacts across one seam between two tiles."""
+    fg_first, fg_second = [], []
+    for shift in (-1, 0, 1):  # Foreground is 8-connected, so diagonal neighbours count
+        a = fg_a[max(0, -shift):len(fg_a) - max(0, shift)]
+        b = fg_b[max(0, shift):len(fg_b) - max(0, -shift)]
+        joined = (a > 0) & (b > 0)
+        fg_first.append(a[joined] - 1 + fg_offset_a)
+        fg_second.append(b[joined] - 1 + fg_offset_b)
+    joined = (bg_a > 0) & (bg_b > 0)  # Background is 4-connected
+    bg_pairs = (bg_a[joined] - 1 + bg_offset_a, bg_b[joined] - 1 + bg_offset_b)
+    contact_fg, contact_bg = [], []
+    for fg_side, bg_side, fg_offset, bg_offset in ((fg_a, bg_b, fg_offset_a, bg_offset_b),
+                                                   (fg_b, bg_a, fg_offset_b, bg_offset_a)):
+        touching = (fg_side > 0) & (bg_side > 0)
+        contact_fg.append(fg_side[touching] - 1 + fg_offset)
+        contact_bg.append(bg_side[touching] - 1 + bg_offset)
+    return ((np.concatenate(fg_first), np.concatenate(fg_second)), bg_pairs,
+            (np.concatenate(contact_fg), np.concatenate(contact_bg)))
+
+
+def _merge_tiles(grid, records, width):
+    """
+    Join components cut by tile seams and keep the ones cv2.findContours(RETR_EXTERNAL) reports.
+
+    A component is external when it touches the page border or a background
+    component that does; components inside holes of others are dropped.
+    Returns their bboxes and first raster pixels.
+    """
+    rows, columns = len(grid), len(grid[0])
+    fg_offsets = np.cumsum([0] + [record['fg_count'] for record in records])
+    bg_offsets = np.cumsum([0] + [record['bg_count'] for record in records])
+    fg_total, bg_total = int(fg_offsets[-1]), int(bg_offsets[-1])
+
+    fg_unions, bg_unions, contacts = [], [], []
+    on_border_bg = [record['bg_on_border'] + bg_offsets[k] for k, record in enumerate(records)]
+    for k, record in enumerate(records):
+        fg_adjacent, bg_adjacent = record['adjacent']
+        contacts.append((fg_adjacent + fg_offsets[k], bg_adjacent + bg_offsets[k]))
+
+    def join(k, m, fg_a, fg_b, bg_a, bg_b):
+        fg_pairs, bg_pairs, contact = _seam_pairs(fg_a, fg_b, bg_a, bg_b, fg_offsets[k], fg_offsets[m],
+                                                  bg_offsets[k], bg_offsets[m])
+        fg_unions.append(fg_pairs)
+        bg_unions.append(bg_pairs)
+        contacts.append(contact)
+
+    for r in range(rows):
+        for c in range(columns):
+            k = r * columns + c
+            top, bottom, left, right = records[k]['fg_edges']
+            bg_top, bg_bottom, bg_left, bg_right = records[k]['bg_edges']
+            if c + 1 < columns:
+                m = k + 1
+                join(k, m, right, records[m]['fg_edges'][2], bg_right, records[m]['bg_edges'][2])
+            if r + 1 < rows:
+                m = k + columns
+                join(k, m, bottom, records[m]['fg_edges'][0], bg_bottom, records[m]['bg_edges'][0])
+                # Diagonal contacts across the corners of four tiles
+                if c + 1 < columns:
+                    m = k + columns + 1
+                    a, b = bottom[-1], records[m]['fg_edges'][0][0]
+                    if a > 0 and b > 0:
+                        fg_unions.append((np.array([a - 1 + fg_offsets[k]]), np.array([b - 1 + fg_offsets[m]])))
+                if c > 0:
+                    m = k + columns - 1
+                    a, b = bottom[0], records[m]['fg_edges'][0][-1]
+                    if a > 0 and b > 0:
+                        fg_unions.append((np.array([a - 1 + fg_offsets[k]]), np.array([b - 1 + fg_offsets[m]])))
+
+    def unique_pairs(pairs, total):
+        if not pairs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = np.unique(np.concatenate([a.astype(np.int64) * max(total, 1) + b for a, b in pairs]))
+        return keys // max(total, 1), keys % max(total, 1)
+
+    components = _UnionFind(fg_total + bg_total)
+    components.union_pairs(*unique_pairs(fg_unions, fg_total + bg_total))
+    first_bg, second_bg = unique_pairs(bg_unions, fg_total + bg_total)
+    components.union_pairs(first_bg + fg_total, second_bg + fg_total)
+    roots = components.roots()
+
+    outer = np.zeros(fg_total + bg_total, dtype=bool)
+    outer[roots[np.concatenate(on_border_bg).astype(np.int64) + fg_total]] = True
+    contact_fg, contact_bg = unique_pairs(contacts, fg_total + bg_total)
+    external = np.zeros(fg_total + bg_total, dtype=bool)
+    external[roots[contact_fg[outer[roots[contact_bg + fg_total]]]]] = True
+    fg_roots = roots[:fg_total]
+    external[fg_roots[np.concatenate([record['fg_on_border'] for record in records])]] = True
+
+    # Union of the piece bboxes and earliest first pixel of every external component
+    bboxes = np.concatenate([record['bboxes'] for record in records])
+    firsts = np.concatenate([record['first'] for record in records])
+    keep = external[fg_roots]
+    pieces, piece_boxes, piece_firsts = fg_roots[keep], bboxes[keep], firsts[keep]
+    elements, index = np.unique(pieces, return_inverse=True)
+    count = len(elements)
+    left = np.full(count, np.iinfo(np.int64).max)
+    top = np.full(count, np.iinfo(np.int64).max)
+    right = np.zeros(count, dtype=np.int64)
+    bottom = np.zeros(count, dtype=np.int64)
+    first = np.full(count, np.iinfo(np.int64).max)
+    np.minimum.at(left, index, piece_boxes[:, 0])
+    np.minimum.at(top, index, piece_boxes[:, 1])
+    np.maximum.at(right, index, piece_boxes[:, 0] + piece_boxes[:, 2])
+    np.maximum.at(bottom, index, piece_boxes[:, 1] + piece_boxes[:, 3])
+    np.minimum.at(first, index, piece_firsts)
+    return np.stack([left, top, right - left, bottom - top], axis=1), first
+
+
+def _tile_ink(record, bboxes):
+    """Sum the binary pixel values of every bbox inside one tile."""
+    x0, y0, x1, y1 = record['tile']
+    ix0 = np.clip(bboxes[:, 0], x0, x1) - x0
+    iy0 = np.clip(bboxes[:, 1], y0, y1) - y0
+    ix1 = np.clip(bboxes[:, 0] + bboxes[:, 2], x0, x1) - x0
+    iy1 = np.clip(bboxes[:, 1] + bboxes[:, 3], y0, y1) - y0
+    ink = np.zeros(len(bboxes))
+    inside = (ix1 > ix0) & (iy1 > iy0)
+    if inside.any():
+        binary = np.unpackbits(record['packed'], axis=1, count=x1 - x0) * np.uint8(255)
+        integral = cv2.integral(binary, sdepth=cv2.CV_64F)
+        ix0, iy0, ix1, iy1 = ix0[inside], iy0[inside], ix1[inside], iy1[inside]
+        ink[inside] = integral[iy1, ix1] - integral[iy0, ix1] - integral[iy1, ix0] + integral[iy0, ix0]
+    return ink
+
+
+def _read_binary(records, x0, y0, x1, y1):
+    """Assemble the binary pixels of a page rectangle from the packed tiles."""
+    roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    for record in records:
+        tx0, ty0, tx1, ty1 = record['tile']
+        ix0, iy0, ix1, iy1 = max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1)
+        if ix1 > ix0 and iy1 > iy0:
+            rows = np.unpackbits(record['packed'][iy0 - ty0:iy1 - ty0], axis=1, count=tx1 - tx0)
+            roi[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = rows[:, ix0 - tx0:ix1 - tx0] * 255
+    return roi
@@ -0,0 +1,131 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check() inside work whose request has been superseded."""
+
+
+class CancelToken:
+    """
+    Generation token of one request on a scheduler channel.
+
+    The token turns cancelled as soon as a newer request is submitted on the
+    same channel (or the channel is cancelled). Long work calls check()
+    between its stages so that abandoned work stops at the next stage boundary.
+    """
+
+    def __init__(self, scheduler, channel, generation):
+        self.scheduler = scheduler
+        self.channel = channel
+        self.generation = generation
+
+    @property
+    def cancelled(self):
+        return not self.scheduler.is_current(self)
+
+    def check(self):
+        """Raise Cancelled if a newer request has superseded this one."""
+        if self.cancelled:
+            raise Cancelled(f"{self.channel} request {self.generation} was superseded")
+
+
+class LatestWinsScheduler:
+    """
+    Runs GUI work on one bounded thread pool where only the newest request of each channel counts.
+
+    Submitting on a channel ('render', 'analysis', ...) supersedes the earlier
+    request of that channel: if it has not started it is cancelled, if it is
+    running its token turns cancelled so it can stop at its next check(), and
+    its result is dropped either way. Callbacks of the newest request are
+    handed to `deliver`, typically a function scheduling them on the UI
+    thread, and are skipped if the request has been superseded by then.
+    """
+
+    def __init__(self, workers=2, deliver=None):
+        """
+        :param workers: Number of worker threads shared by all channels
+        :param deliver: Callable run with a zero-argument function to call it on the UI thread;
+                        callbacks run on the worker thread if None
+        """
+        self.deliver = deliver
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ui-scheduler')
+        self._lock = threading.Lock()
+        self._generations = {}  # channel -> newest generation
+        self._futures = {}  # channel -> Future of the newest request
+
+    def submit(self, channel, function, *args, on_done=None, on_error=None, **kwargs):
+        """
+        Run function(token, *args, **kwargs) on the pool, superseding the channel's earlier request.
+
+        :param channel: Name of the channel; requests on different channels do not supersede each other
+        :param on_done: Called with the result if this is still the newest request of its channel
+        :param on_error: Called with the exception (other than Cancelled) under the same condition
+        :return: CancelToken of the request
+        """
+        with self._lock:
+            generation = self._generations.get(channel, 0) + 1
+            self._generations[channel] = generation
+            previous = self._futures.pop(channel, None)
+            token = CancelToken(self, channel, generation)
+            future = self._executor.submit(self._run, token, function, args, kwargs)
+            self._futures[channel] = future
+        if previous is not None and previous.cancel():
+            instrumentation.count('ui_scheduler.cancelled', channel=channel)
+        future.add_done_callback(lambda f: self._finished(f, token, on_done, on_error))
+        return token
+
+    def cancel(self, channel):
+        """Supersede the channel's request without submitting a new one."""
+        with self._lock:
+            self._generations[channel] = self._generations.get(channel, 0) + 1
+            previous = self._futures.pop(channel, None)
+        if previous is not None and previous.cancel():
+            instrumentation.count('ui_scheduler.cancelled', channel=channel)
+
+    def is_current(self, token):
+        """Return whether token belongs to the newest request of its channel."""
+        with self._lock:
+            return self._generations.get(token.channel) == token.generation
+
+    def shutdown(self):
+        """Supersede every request and stop the threads once running work has stopped."""
+        with self._lock:
+            for channel in self._generations:
+                self._generations[channel] += 1
+            self._futures.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _run(token, function, args, kwargs):
+        token.check()  # Superseded while it waited for a thread
+        return function(token, *args, **kwargs)
+
+    def _finished(self, future, token, on_done, on_error):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, Cancelled) or token.cancelled:
+            instrumentation.count('ui_scheduler.dropped', channel=token.channel)
+            return
+        with self._lock:
+            if self._futures.get(token.channel) is future:
+                del self._futures[token.channel]
+        if error is not None:
+            callback, value = on_error, error
+        else:
+            callback, value = on_done, future.result()
+        if callback is None:
+            return
+
+        def call():
+            # A newer request may have arrived while the callback was queued for the UI thread
+            if not token.cancelled:
+                callback(value)
+
+        if self.deliver is None:
+            call()
+        else:
+            self.deliver(call)
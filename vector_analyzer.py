@@ -0,0 +1,232 @@
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+import instrumentation
+from pdf_processor import render_page
+from image_analyzer import ELEMENT_TYPES, ElementTable, analyze_layout, analyze_spatial_relationships, \
+    classification_thresholds, granularity_kernel_size
+
+# Analysis modes: always render, always read the object model, or decide per page
+ANALYSIS_MODES = ('raster', 'vector', 'auto')
+# A page whose images cover this fraction of it and that has no visible text is a scan
+SCANNED_IMAGE_COVERAGE = 0.5
+# Pages with larger content streams (maps, plans, outlined text) render faster than they parse
+MAX_VECTOR_CONTENT_BYTES = 256 * 1024
+# Paths at most this many points thick are rules: table borders, separators, underlines
+RULE_THICKNESS = 3
+
+# Primitive kinds, in the order of the per-element counts
+_TEXT, _IMAGE, _HORIZONTAL_RULE, _VERTICAL_RULE, _FILL, _PATH = range(6)
+_BBOXLOG_KINDS = {'fill-image': _IMAGE, 'fill-imgmask': _IMAGE, 'fill-shade': _IMAGE, 'fill-path': _FILL,
+                  'stroke-path': _PATH}
+
+
+def page_kind(page, bboxlog=None):
+    """
+    Return 'scanned' for a page that is essentially one picture, 'digital' otherwise.
+
+    Invisible text, such as an OCR layer over a scan, does not make a page digital.
+
+    :param page: fitz.Page
+    :param bboxlog: page.get_bboxlog() if the caller already has it
+    """
+    bboxlog = page.get_bboxlog() if bboxlog is None else bboxlog
+    page_area = abs(page.rect) or 1
+    image_area = 0
+    for kind, rect in bboxlog:
+        if kind in ('fill-text', 'stroke-text'):
+            return 'digital'
+        if _BBOXLOG_KINDS.get(kind) == _IMAGE:
+            image_area += abs(fitz.Rect(rect) & page.mediabox)
+    return 'scanned' if image_area >= SCANNED_IMAGE_COVERAGE * page_area else 'digital'
+
+
+def choose_method(page, mode='auto'):
+    """
+    Return 'vector' or 'raster', the analysis path to use for a page in the given mode.
+
+    In 'auto' mode scanned pages, and pages whose content streams are so
+    large that reading their object model costs more than rendering them,
+    are rasterized.
+    """
+    return _choose_method(page, mode)[0]
+
+
+def _choose_method(page, mode):
+    """Return the method and the bboxlog read to choose it, if any, for the vector path to reuse."""
+    if mode not in ANALYSIS_MODES:
+        raise ValueError(f"Unknown analysis mode {mode!r}, expected one of {ANALYSIS_MODES}")
+    if mode != 'auto':
+        return mode, None
+    if len(page.read_contents()) > MAX_VECTOR_CONTENT_BYTES:
+        return 'raster', None
+    bboxlog = page.get_bboxlog()
+    return ('vector' if page_kind(page, bboxlog) == 'digital' else 'raster'), bboxlog
+
+
+def analyze_page(page, zoom=1, granularity=50, mode='auto', method='contours'):
+    """
+    Analyze a page on the raster or vector path, as chosen by choose_method().
+
+    :param page: fitz.Page
+    :param zoom: Zoom factor; bboxes are in pixels of the page rendered at this zoom either way
+    :param granularity: Layout granularity
+    :param mode: 'raster', 'vector' or 'auto'
+    :param method: Segmentation of rendered pages, 'contours' or 'xy_cut'; the vector path only groups by contours
+    :return: Layout dictionary with elements, relationships and the 'source' path used, plus the reading order
+             of pages segmented by 'xy_cut'
+    """
+    if mode == 'vector' and method != 'contours':
+        raise ValueError(f"Method {method!r} segments rendered pages and cannot be combined with mode 'vector'")
+    source, bboxlog = _choose_method(page, mode)
+    if source == 'vector':
+        layout = analyze_page_vector(page, zoom, granularity, bboxlog)
+    else:
+        with instrumentation.span('render'):
+            image = render_page(page, zoom, 'gray')
+        layout = analyze_layout(image, granularity, method)
+    layout['source'] = source
+    return layout
+
+
+def analyze_page_vector(page, zoom=1, granularity=50, bboxlog=None):
+    """
+    Build the layout of a born-digital page from its text, images and drawings, without rendering it.
+
+    Word boxes, image placements and path bounds stand in for the ink of the
+    raster path. They are grown by the dilation radius of the granularity and
+    grouped into elements with the same external contour search, and every
+    element is typed from the primitives it contains rather than from pixel
+    densities.
+
+    :param page: fitz.Page
+    :param zoom: Zoom factor of the pixel coordinates
+    :param granularity: Layout granularity
+    :param bboxlog: page.get_bboxlog() if the caller already has it
+    :return: Dictionary with elements and relationships, like analyze_layout
+    """
+    with instrumentation.span('analyze_page_vector', granularity=granularity):
+        with instrumentation.span('read_primitives'):
+            boxes, kinds = _page_primitives(page, zoom, bboxlog)
+        pixmap_rect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+        width, height = pixmap_rect.width, pixmap_rect.height
+        kernel_size = granularity_kernel_size((height, width), granularity)
+        with instrumentation.span('group_primitives', primitives=len(boxes)):
+            # Group on blocks of about one point, the precision of the primitives
+            bboxes, labels = _group_primitives(boxes, width, height, (kernel_size - 1) // 2, max(1, int(zoom)))
+        instrumentation.count('contours', len(bboxes))
+        codes = _classify_groups(bboxes, boxes, kinds, labels, granularity)
+        elements = ElementTable(bboxes, codes)
+        relationships = analyze_spatial_relationships(elements)
+    return {
+        'elements': elements,
+        'relationships': relationships
+    }
+
+
+def _page_primitives(page, zoom, bboxlog=None):
+    """Return the (n, 4) x0, y0, x1, y1 pixel boxes of the words, images and paths of a page, and their kinds."""
+    bboxlog = page.get_bboxlog() if bboxlog is None else bboxlog
+    rects = [word[:4] for word in page.get_text('words')]
+    kinds = [_TEXT] * len(rects)
+    if not rects:
+        # Text without extractable words (e.g. Type 3 fonts) still shows up as text runs
+        text_runs = [rect for kind, rect in bboxlog if kind in ('fill-text', 'stroke-text')]
+        rects.extend(text_runs)
+        kinds.extend([_TEXT] * len(text_runs))
+    for kind, rect in bboxlog:
+        primitive = _BBOXLOG_KINDS.get(kind)
+        if primitive is None:
+            continue
+        x0, y0, x1, y1 = rect
+        if primitive != _IMAGE and min(x1 - x0, y1 - y0) <= RULE_THICKNESS:
+            primitive = _HORIZONTAL_RULE if x1 - x0 >= y1 - y0 else _VERTICAL_RULE
+        rects.append(rect)
+        kinds.append(primitive)
+    if not rects:
+        return np.zeros((0, 4), dtype=np.float64), np.zeros(0, dtype=np.int64)
+    # Page coordinates are unrotated; map them onto the rendered pixmap. The
+    # rotation is a multiple of 90 degrees, so opposite corners stay opposite.
+    a, b, c, d, e, f = page.rotation_matrix * fitz.Matrix(zoom, zoom)
+    rects = np.array(rects, dtype=np.float64).reshape(-1, 4)
+    xs = a * rects[:, [0, 2]] + c * rects[:, [1, 3]] + e
+    ys = b * rects[:, [0, 2]] + d * rects[:, [1, 3]] + f
+    boxes = np.column_stack([xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)])
+    return boxes, np.array(kinds, dtype=np.int64)
+
+
+def _group_primitives(boxes, width, height, radius, cell=1):
+    """
+    Merge primitive boxes closer than the dilation diameter into elements.
+
+    The boxes are grown by the radius and painted onto a mask of cell x cell
+    pixel blocks, whose external contours give the elements. Returns the
+    (x, y, width, height) pixel bboxes of the elements and, for every
+    primitive, the index of the element containing it. Primitives inside the
+    holes of another element, such as the text in the cells of a ruled table,
+    belong to that element.
+    """
+    if not len(boxes):
+        return np.zeros((0, 4), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    grid_width, grid_height = -(-width // cell), -(-height // cell)
+    corners = np.empty((len(boxes), 4), dtype=np.int64)
+    corners[:, :2] = np.floor((boxes[:, :2] - radius) / cell)
+    corners[:, 2:] = np.ceil((boxes[:, 2:] + radius) / cell) - 1
+    corners[:, [0, 2]] = np.clip(corners[:, [0, 2]], 0, grid_width - 1)
+    corners[:, [1, 3]] = np.clip(corners[:, [1, 3]], 0, grid_height - 1)
+    mask = np.zeros((grid_height, grid_width), dtype=np.uint8)
+    for x0, y0, x1, y1 in corners.tolist():
+        mask[y0:y1 + 1, x0:x1 + 1] = 255
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    bboxes = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.int64).reshape(-1, 4) * cell
+    bboxes[:, 2] = np.minimum(bboxes[:, 2], width - bboxes[:, 0])
+    bboxes[:, 3] = np.minimum(bboxes[:, 3], height - bboxes[:, 1])
+
+    # Paint every element with its filled outer contour, holes included
+    owners = np.zeros((grid_height, grid_width), dtype=np.int32)
+    for index in range(len(contours)):
+        cv2.drawContours(owners, contours, index, index + 1, thickness=cv2.FILLED)
+    return bboxes, owners[(corners[:, 1] + corners[:, 3]) // 2, (corners[:, 0] + corners[:, 2]) // 2] - 1
+
+
+def _classify_groups(bboxes, boxes, kinds, labels, granularity):
+    """Type every element from the kinds and areas of the primitives it contains. Returns type codes."""
+    count = len(bboxes)
+    if not count:
+        return []
+    valid = labels >= 0
+    labels, kinds, boxes = labels[valid], kinds[valid], boxes[valid]
+    counts = np.zeros((count, 6), dtype=np.int64)
+    np.add.at(counts, (labels, kinds), 1)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    image_area = np.bincount(labels, weights=areas * (kinds == _IMAGE), minlength=count)
+    fill_area = np.bincount(labels, weights=areas * (kinds == _FILL), minlength=count)
+
+    line_thickness_threshold, min_size_threshold, area_threshold, table_size_threshold = \
+        classification_thresholds(granularity)
+    x, y, w, h = bboxes.T
+    area = w * h
+    aspect_ratio = w / h
+    rules = counts[:, _HORIZONTAL_RULE] + counts[:, _VERTICAL_RULE]
+    only_rules = rules == counts.sum(axis=1)
+    has_text = counts[:, _TEXT] > 0
+
+    is_image = (image_area >= 0.5 * area) & (np.minimum(w, h) > min_size_threshold)
+    is_table = ((counts[:, _HORIZONTAL_RULE] >= 2) & (counts[:, _VERTICAL_RULE] >= 2) &
+                (w > table_size_threshold) & (h > table_size_threshold))
+    is_line = only_rules & (((aspect_ratio > 10) & (h < line_thickness_threshold)) |
+                            ((aspect_ratio < 0.1) & (w < line_thickness_threshold)))
+    is_filled = (fill_area > 0.5 * area) & (np.minimum(w, h) > min_size_threshold)
+    is_text_block = has_text & ((area > area_threshold) | (w > h * 3))
+
+    codes = np.select(
+        [is_image, is_table, is_line, is_filled, is_text_block, has_text],
+        [ELEMENT_TYPES.index(name) for name in ('image', 'table', 'line', 'image', 'text_block', 'short_text')],
+        default=ELEMENT_TYPES.index('unknown')
+    ).astype(np.int8)
+    if instrumentation.enabled():
+        for code, total in enumerate(np.bincount(codes, minlength=len(ELEMENT_TYPES)).tolist()):
+            if total:
+                instrumentation.count(f'elements.{ELEMENT_TYPES[code]}', total)
+    return codes.tolist()
@@ -0,0 +1,123 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import instrumentation
+
+# Cut directions: 'horizontal' cuts split a region into stacked rows, 'vertical' ones into side-by-side columns
+HORIZONTAL = 'horizontal'
+VERTICAL = 'vertical'
+
+
+@dataclass
+class XYNode:
+    """
+    Node of an XY-cut tree.
+
+    Leaves are layout elements: element is their index in the layout and
+    children is empty. Inner nodes list their children in reading order,
+    top to bottom for horizontal cuts and left to right for vertical ones.
+    """
+    bbox: Tuple[int, int, int, int]  # x, y, width, height
+    direction: Optional[str] = None
+    children: List['XYNode'] = field(default_factory=list)
+    element: Optional[int] = None
+
+    def leaves(self):
+        """Yield the leaves below this node in reading order."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                yield node
+
+    def to_dict(self):
+        if not self.children:
+            return {'bbox': list(self.bbox), 'element': self.element}
+        return {'bbox': list(self.bbox), 'direction': self.direction,
+                'children': [child.to_dict() for child in self.children]}
+
+
+def xy_cut(binary_image, x_threshold, y_threshold, integral=None):
+    """
+    Split a binary page recursively on whitespace gaps.
+
+    Row and column ink profiles of any region are read from an integral image
+    of the page in O(height + width), so every recursion step costs the
+    perimeter of its region rather than its area. A region is first trimmed
+    to its ink, then cut at every gap of blank rows at least y_threshold
+    high, or of blank columns at least x_threshold wide, whichever direction
+    has the widest qualifying gap; regions without one are leaves.
+
+    :param binary_image: Binary image with ink > 0
+    :param x_threshold: Minimum width in pixels of a blank column gap that separates columns
+    :param y_threshold: Minimum height in pixels of a blank row gap that separates rows
+    :param integral: Integral image of the ink (any scale), computed here if None
+    :return: Root XYNode (None for a blank page); leaves are numbered in reading order
+    """
+    if integral is None:
+        integral = cv2.integral(binary_image, sdepth=cv2.CV_64F)
+    height, width = binary_image.shape[:2]
+    x_threshold, y_threshold = max(1, int(x_threshold)), max(1, int(y_threshold))
+    with instrumentation.span('xy_cut', x_threshold=x_threshold, y_threshold=y_threshold):
+        root = _cut(integral, 0, 0, width, height, x_threshold, y_threshold)
+        leaves = 0
+        if root is not None:
+            for leaves, leaf in enumerate(root.leaves(), 1):
+                leaf.element = leaves - 1
+        instrumentation.count('xy_cut.leaves', leaves)
+    return root
+
+
+def _cut(integral, x0, y0, x1, y1, x_threshold, y_threshold):
+    # Ink per row of the region and per column, from the integral image
+    rows = np.diff(integral[y0:y1 + 1, x1] - integral[y0:y1 + 1, x0])
+    columns = np.diff(integral[y1, x0:x1 + 1] - integral[y0, x0:x1 + 1])
+    ink_rows = np.flatnonzero(rows)
+    ink_columns = np.flatnonzero(columns)
+    if not len(ink_rows):
+        return None
+    # Trim the blank margins; the profiles of the trimmed region are slices of these
+    top, bottom = int(ink_rows[0]), int(ink_rows[-1]) + 1
+    left, right = int(ink_columns[0]), int(ink_columns[-1]) + 1
+    x0, y0, x1, y1 = x0 + left, y0 + top, x0 + right, y0 + bottom
+    row_gaps = _gaps(ink_rows - top, y_threshold)
+    column_gaps = _gaps(ink_columns - left, x_threshold)
+    node = XYNode((x0, y0, x1 - x0, y1 - y0))
+    if not len(row_gaps) and not len(column_gaps):
+        return node
+
+    widest_row = (row_gaps[:, 1] - row_gaps[:, 0]).max() if len(row_gaps) else 0
+    widest_column = (column_gaps[:, 1] - column_gaps[:, 0]).max() if len(column_gaps) else 0
+    if widest_row >= widest_column:
+        node.direction = HORIZONTAL
+        bounds = _pieces(row_gaps, y1 - y0)
+        pieces = [(x0, y0 + start, x1, y0 + stop) for start, stop in bounds]
+    else:
+        node.direction = VERTICAL
+        bounds = _pieces(column_gaps, x1 - x0)
+        pieces = [(x0 + start, y0, x0 + stop, y1) for start, stop in bounds]
+    for piece in pieces:
+        child = _cut(integral, *piece, x_threshold, y_threshold)
+        if child is not None:
+            node.children.append(child)
+    return node
+
+
+def _gaps(ink, threshold):
+    """Return the (start, stop) blank runs between consecutive ink positions that are at least threshold long."""
+    starts = ink[:-1] + 1
+    stops = ink[1:]
+    keep = stops - starts >= threshold
+    return np.stack([starts[keep], stops[keep]], axis=1)
+
+
+def _pieces(gaps, length):
+    """Return the (start, stop) extents left between the gaps of a run of the given length."""
+    starts = np.concatenate([[0], gaps[:, 1]])
+    stops = np.concatenate([gaps[:, 0], [length]])
+    return list(zip(starts.tolist(), stops.tolist()))